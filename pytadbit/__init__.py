@@ -4,3 +4,7 @@ from pytadbit.tadbit import tadbit, batch_tadbit
 from pytadbit.chromosome import Chromosome
 from pytadbit.experiment import Experiment
 from pytadbit.chromosome import load_chromosome
+from pytadbit.genome import Genome
+from pytadbit.parsers.chromosome_store import write_chromosome_store
+from pytadbit.parsers.chromosome_store import load_chromosome_store
+from pytadbit.parsers.chromosome_store import compact_chromosome_store
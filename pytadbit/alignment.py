@@ -9,6 +9,7 @@ from random import random, shuffle
 from sys import stdout
 from pytadbit.boundary_aligner.aligner import align
 from numpy import linspace, sin, pi
+import numpy as np
 from warnings import warn
 
 try:
@@ -306,25 +307,21 @@ class Alignment(object):
                 warn("WARNING: weights not available, TAD's height fixed to 1")
                 norms = None
             diags = []
-            sp1 = siz + 1
-            if norms:
+            if norms is not None:
+                # norms[i + siz * j] is the cell in row j and column i
+                norms = np.array(norms, dtype=float).reshape(siz, siz)
+                norms[list(zeros or []), :] = 0.
+                norms[:, list(zeros or [])] = 0.
                 for k in xrange(1, siz):
-                    s_k = siz * k
-                    diags.append(sum([norms[i * sp1 + s_k]
-                                     if not (i in zeros
-                                             or (i + k) in zeros) else 0.
-                                      for i in xrange(siz - k)]) / (siz - k))
+                    diags.append(float(np.diagonal(norms, -k).sum()) / (siz - k))
             for tad in xpr.tads:
                 start, end = (int(xpr.tads[tad]['start']) + 1,
                               int(xpr.tads[tad]['end']) + 1)
-                if norms:
-                    matrix = sum([norms[i + siz * j]
-                                 if not (i in zeros
-                                         or j in zeros) else 0.
-                                  for i in xrange(start - 1, end - 1)
-                                  for j in xrange(i + 1, end - 1)])
+                if norms is not None:
+                    matrix = np.tril(norms[start - 1:end - 1,
+                                           start - 1:end - 1], -1).sum()
                 try:
-                    if norms:
+                    if norms is not None:
                         height = float(matrix) / sum(
                             [diags[i-1] * (end - start - i)
                              for i in xrange(1, end - start)])
@@ -421,7 +418,12 @@ class TAD(dict):
     """
     def __init__(self, thing, i, exp):
         super(TAD, self).__init__(thing)
-        idx = [t for t in exp.tads if exp.tads[t]['start']==self['start']][0]
+        if exp.crm is not None:
+            idx = exp.crm.tad_index.tad_at(self['start'] * exp.resolution,
+                                           [exp.name])[exp.name]
+        else:
+            idx = [t for t in exp.tads
+                   if exp.tads[t]['start']==self['start']][0]
         self.update(dict((('pos', i),('exp', exp), ('index', idx))))
         
     def __repr__(self):
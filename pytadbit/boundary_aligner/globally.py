@@ -4,6 +4,7 @@
 global aligner for Topologically Associated Domains
 """
 from math import log
+import numpy as np
 
 
 def needleman_wunsch(tads1, tads2, penalty=-6., ext_pen=-5.6,
@@ -27,25 +28,8 @@ def needleman_wunsch(tads1, tads2, penalty=-6., ext_pen=-5.6,
     tads2 = [0.0] + tads2
     l_tads1  = len(tads1)
     l_tads2  = len(tads2)
-    max_dist = log(1. / (abs(max_dist) + 1))
     dister = lambda x, y: log(1. / (abs(x - y) + 1))
-    scores = virgin_score(penalty, l_tads1, l_tads2)
-    pen = penalty
-    for i in xrange(1, l_tads1):
-        for j in xrange(1, l_tads2):
-            d_dist = dister(tads2[j], tads1[i])
-            match  = d_dist + scores[i-1][j-1]
-            insert = scores[i-1][j] + pen
-            delete = scores[i][j-1] + pen
-            if d_dist < max_dist:
-                scores[i][j] = max((insert, delete))
-                pen = ext_pen
-            else:
-                if match >= max(insert, delete):
-                    pen = ext_pen
-                else:
-                    pen = ext_pen
-                scores[i][j] = max((match, insert, delete))
+    scores = score_matrix(tads1, tads2, penalty, ext_pen, max_dist).tolist()
     align1 = []
     align2 = []
     i = l_tads1 -1
@@ -58,25 +42,25 @@ def needleman_wunsch(tads1, tads2, penalty=-6., ext_pen=-5.6,
         d_dist     = dister(tads2[j], tads1[i])
         value      = scores[i-1][j-1] + d_dist
         if equal(score, value):
-            align1.insert(0, tads1[i])
-            align2.insert(0, tads2[j])
+            align1.append(tads1[i])
+            align2.append(tads2[j])
             i -= 1
             j -= 1
         elif equal(score, scores[i-1][j] + penalty):
-            align1.insert(0, tads1[i])
-            align2.insert(0, '-')
+            align1.append(tads1[i])
+            align2.append('-')
             i -= 1
         elif equal(score, scores[i-1][j] + ext_pen):
-            align1.insert(0, tads1[i])
-            align2.insert(0, '-')
+            align1.append(tads1[i])
+            align2.append('-')
             i -= 1
         elif equal(score, scores[i][j-1] + penalty):
-            align1.insert(0, '-')
-            align2.insert(0, tads2[j])
+            align1.append('-')
+            align2.append(tads2[j])
             j -= 1
         elif equal(score, scores[i][j-1] + ext_pen):
-            align1.insert(0, '-')
-            align2.insert(0, tads2[j])
+            align1.append('-')
+            align2.append(tads2[j])
             j -= 1
         else:
             for scr in scores: 
@@ -84,13 +68,16 @@ def needleman_wunsch(tads1, tads2, penalty=-6., ext_pen=-5.6,
             raise Exception('Something  is failing and it is my fault...',
                             i, j, tads1[i], tads2[j])
     while i:
-        align1.insert(0, tads1[i])
-        align2.insert(0, '-')
+        align1.append(tads1[i])
+        align2.append('-')
         i -= 1
     while j:
-        align1.insert(0, '-')
-        align2.insert(0, tads2[j])
+        align1.append('-')
+        align2.append(tads2[j])
         j -= 1
+    # the traceback goes from the end of the alignment to its start
+    align1.reverse()
+    align2.reverse()
         
     if verbose:
         print '\n Alignment:'
@@ -101,13 +88,57 @@ def needleman_wunsch(tads1, tads2, penalty=-6., ext_pen=-5.6,
     return [align1, align2], max_score
 
 
-def virgin_score(penalty, l_tads1, l_tads2):
+def score_matrix(tads1, tads2, penalty, ext_pen, max_dist):
     """
-    create empty matrix
+    Fill the Needleman-Wunsch score matrix by anti-diagonals: the cells of an
+    anti-diagonal only depend on the two previous ones, and are computed at
+    once. The distance between two boundaries is only evaluated if they are
+    close enough to be matched (within max_dist).
+
+    Only the first cell uses the gap opening penalty, the others the gap
+    extension penalty.
+
+    :param tads1: list of boundaries, starting with 0
+    :param tads2: list of boundaries, starting with 0
+    :param penalty: penalty to open a gap
+    :param ext_pen: penalty to extend a gap
+    :param max_dist: distance from which match are denied
+
+    :returns: the score matrix as a numpy array of len(tads1) rows and
+       len(tads2) columns
     """
-    zeros    = [0.0 for _ in xrange(l_tads2)]
-    return [[penalty * j for j in xrange(l_tads2)]] + \
-           [[penalty * i] + zeros for i in xrange(1, l_tads1)]
+    l_tads1  = len(tads1)
+    l_tads2  = len(tads2)
+    # log-distances of the pairs of boundaries that can be matched (the
+    # band is slightly wider than max_dist, the log-distances decide)
+    dists  = abs(np.array(tads2, dtype=float)[None] -
+                 np.array(tads1, dtype=float)[:, None]).ravel()
+    band   = np.flatnonzero(dists <= (abs(max_dist) + 1) * (1 + 1e-6))
+    d_dist = np.log(1. / (dists[band] + 1))
+    keep   = d_dist >= log(1. / (abs(max_dist) + 1))
+    match  = np.empty(l_tads1 * l_tads2)
+    match.fill(-np.inf)
+    match[band[keep]] = d_dist[keep]
+    # flat matrix, first row and column with gap penalties
+    scores = np.zeros(l_tads1 * l_tads2)
+    scores[:l_tads2]  = penalty * np.arange(l_tads2)
+    scores[::l_tads2] = penalty * np.arange(l_tads1)
+    if l_tads1 == 1 or l_tads2 == 1:
+        return scores.reshape(l_tads1, l_tads2)
+    # the cells of an anti-diagonal are equally spaced in the flat matrix
+    step = l_tads2 - 1
+    pen  = penalty
+    for diag in xrange(2, l_tads1 + l_tads2 - 1):
+        beg = max(1, diag - step) * step + diag
+        end = min(l_tads1 - 1, diag - 1) * step + diag + 1
+        cells = slice(beg, end, step)
+        insert = scores[beg - l_tads2:end - l_tads2:step] + pen
+        delete = scores[beg - 1:end - 1:step] + pen
+        np.maximum(insert, delete, insert)
+        np.maximum(match[cells] + scores[beg - l_tads2 - 1:end - l_tads2 - 1:
+                                         step], insert, scores[cells])
+        pen = ext_pen
+    return scores.reshape(l_tads1, l_tads2)
 
 
 def equal(a, b, cut_off=1e-9):
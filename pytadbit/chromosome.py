@@ -8,12 +8,15 @@ from os.path                           import exists
 from pytadbit.boundary_aligner.aligner import align
 from pytadbit                          import tadbit
 from pytadbit.experiment               import Experiment
+from pytadbit.parsers.hic_parser       import compact_matrix
 from string                            import ascii_lowercase as letters
 from warnings                          import warn
 from copy                              import deepcopy as copy
-from cPickle                           import load, dump
+from cPickle                           import load, dump, HIGHEST_PROTOCOL
 from pytadbit.alignment                import Alignment, randomization_test
+from pytadbit.utils.tad_index          import TADIndex
 from numpy                             import log2
+import numpy as np
 from random                            import random
 
 try:
@@ -39,15 +42,15 @@ def load_chromosome(in_f, fast=2):
 
     TODO: remove first try/except type error... this is loading old experiments
     """
-    dico = load(open(in_f))
+    dico = load(open(in_f, 'rb'))
     name = ''
     crm = Chromosome(dico['name'])
     for name in dico['experiments']:
         xpr = Experiment(name, dico['experiments'][name]['resolution'], 
                          no_warn=True)
         xpr.tads       = dico['experiments'][name]['tads']
-        xpr.norm       = dico['experiments'][name]['wght']
-        xpr.hic_data   = dico['experiments'][name]['hi-c']
+        xpr.norm       = _compact(dico['experiments'][name]['wght'])
+        xpr.hic_data   = _compact(dico['experiments'][name]['hi-c'])
         xpr.conditions = dico['experiments'][name]['cond']
         xpr.size       = dico['experiments'][name]['size']
         try:
@@ -61,19 +64,30 @@ def load_chromosome(in_f, fast=2):
     crm._centromere     = dico['_centromere']
     if type(dico['experiments'][name]['hi-c']) == str or fast!= int(2):
         try:
-            dicp = load(open(in_f + '_hic'))
+            dicp = load(open(in_f + '_hic', 'rb'))
         except IOError:
             raise Exception('ERROR: file %s not found\n' % (
                 dico['experiments'][name]['hi-c']))
         for name in dico['experiments']:
-            crm.get_experiment(name).hic_data = dicp[name]['hi-c']
+            crm.get_experiment(name).hic_data = _compact(dicp[name]['hi-c'])
             if fast != 1:
-                crm.get_experiment(name).norm = dicp[name]['wght']
+                crm.get_experiment(name).norm = _compact(dicp[name]['wght'])
     elif not fast:
         warn('WARNING: data not saved correctly for fast loading.\n')
     return crm
 
 
+def _compact(matrices):
+    """
+    Hi-C data and weights saved with older versions are lists of tuples,
+    convert them into numpy arrays.
+    """
+    if type(matrices) is not list:
+        return matrices
+    return [compact_matrix(m) if type(m) in (tuple, list) else m
+            for m in matrices]
+
+
 class Chromosome(object):
     """
     A Chromosome object designed to deal with Topologically Associating Domains
@@ -127,6 +141,8 @@ class Chromosome(object):
         self.experiments      = ExperimentList([], self)
         self._centromere      = None
         self.alignment        = AlignmentDict()
+        self._tad_index       = None
+        self._tad_index_of    = None
         
         self._search_centromere = centromere_search
         if experiment_tads:
@@ -178,9 +194,32 @@ class Chromosome(object):
             for pos in xrange(int(self._centromere[0]),
                               int(self._centromere[1])):
                 self.forbidden[pos] = 'Centromere'
+        # TADs may have been cut at the centromere
+        self._tad_index = None
         self.__update_size(xpr)
 
 
+    @property
+    def tad_index(self):
+        """
+        Index of the TADs of all the experiments (see
+        :class:`pytadbit.utils.tad_index.TADIndex`), to find TADs by genomic
+        position. It is built when first needed, and again once TADs are
+        loaded or found, or experiments added.
+        """
+        # the TADs of each experiment are replaced, not modified, by
+        # Experiment.load_tad_def (which also resets the index)
+        tads_of = [(xpr, xpr.tads, len(xpr.tads)) for xpr in self.experiments]
+        if (self._tad_index is None or
+            len(tads_of) != len(self._tad_index_of) or
+            any(xpr1 is not xpr2 or tads1 is not tads2 or len1 != len2
+                for (xpr1, tads1, len1), (xpr2, tads2, len2)
+                in zip(tads_of, self._tad_index_of))):
+            self._tad_index = TADIndex(self.experiments)
+            self._tad_index_of = tads_of
+        return self._tad_index
+
+
     def get_experiment(self, name):
         """
         This can also be done directly with Chromosome.experiments[name].
@@ -244,12 +283,12 @@ class Chromosome(object):
         dico['max_tad_size']    = self.max_tad_size
         dico['forbidden']       = self.forbidden
         dico['_centromere']     = self._centromere
-        out = open(out_f, 'w')
-        dump(dico, out)
+        out = open(out_f, 'wb')
+        dump(dico, out, HIGHEST_PROTOCOL)
         out.close()
-        if not fast:
-            out = open(out_f + '_hic', 'w')
-            dump(dicp, out)
+        if divide and not fast:
+            out = open(out_f + '_hic', 'wb')
+            dump(dicp, out, HIGHEST_PROTOCOL)
             out.close()
 
 
@@ -325,7 +364,8 @@ class Chromosome(object):
         :param resolution: resolution of the experiment (needed if name is not
            an Experiment object)
         :param None hic_data: whether a file or a list of lists corresponding to
-           the Hi-C data
+           the Hi-C data (see :class:`pytadbit.Experiment` for other accepted
+           formats)
         :param None tad_def: a file or a dict with precomputed TADs for this
            experiment
         :param False replace: overwrite the experiments loaded under the same
@@ -369,7 +409,8 @@ class Chromosome(object):
 
     def find_tad(self, experiments, name=None, n_cpus=1, verbose=True,
                  max_tad_size="auto", no_heuristic=False, batch_mode=False,
-                 use_visibility=False):
+                 use_visibility=False, window=None, overlap=None,
+                 coarse_resolution=None, llik_cache=None):
         """
         Call the :func:`pytadbit.tadbit.tadbit` function to calculate the
         position of Topologically Associated Domains
@@ -388,6 +429,20 @@ class Chromosome(object):
            found are stored under the name 'batch' plus a concatenation of the
            experiment names passed (e.g.: if experiments=['exp1', 'exp2'], the
            name would be: 'batch_exp1_exp2').
+        :param None window: if given, TADs are searched in overlapping windows
+           of this number of bins (see :func:`pytadbit.tadbit.tadbit`), which
+           bounds the memory used on large chromosomes
+        :param None overlap: number of bins shared by consecutive windows
+        :param None coarse_resolution: if given (a multiple of the resolution
+           of the experiments), TADs are first searched on the Hi-C data
+           summed at this resolution (see
+           :func:`pytadbit.experiment.Experiment.set_resolution`), and only
+           the TADs starting and ending close to the boundaries found are
+           evaluated at the resolution of the experiments (not used in
+           batch mode)
+        :param None llik_cache: path to a directory where log-likelihoods are
+           kept between runs on the same Hi-C data (see
+           :func:`pytadbit.tadbit.tadbit`)
 
         TODO: check option -> name for batch mode... some dirty changes....
 
@@ -416,7 +471,9 @@ class Chromosome(object):
                                      max_tad_size=max_tad_size,
                                      no_heuristic=no_heuristic,
                                      get_weights=True,
-                                     use_visibility=use_visibility)
+                                     use_visibility=use_visibility,
+                                     window=window, overlap=overlap,
+                                     llik_cache=llik_cache)
             experiment = Experiment(name, resolution, hic_data=matrix,
                                     tad_def=result, weights=weights)
             self.add_experiment(experiment)
@@ -426,17 +483,60 @@ class Chromosome(object):
         for experiment in experiments:
             if not type(experiment) == Experiment:
                 xpr = self.get_experiment(experiment)
-            result, weights = tadbit(xpr.hic_data,
-                                     n_cpus=n_cpus, verbose=verbose,
-                                     max_tad_size=max_tad_size,
-                                     no_heuristic=no_heuristic,
-                                     get_weights=True,
-                                     use_visibility=use_visibility)
+            result, weights = self._experiment_tads(
+                xpr, n_cpus=n_cpus, verbose=verbose,
+                max_tad_size=max_tad_size, no_heuristic=no_heuristic,
+                use_visibility=use_visibility, window=window,
+                overlap=overlap, coarse_resolution=coarse_resolution,
+                llik_cache=llik_cache)
             xpr.load_tad_def(result, weights=weights)
             if self._search_centromere:
                 self._get_forbidden_region(xpr)
 
 
+    def _experiment_tads(self, xpr, n_cpus=1, verbose=True,
+                         max_tad_size="auto", no_heuristic=False,
+                         use_visibility=False, window=None, overlap=None,
+                         coarse_resolution=None, llik_cache=None):
+        """
+        TADs and weights found on the Hi-C data of one experiment (see
+        :func:`Chromosome.find_tad`), without storing them.
+        """
+        boundaries, radius = None, 2
+        if coarse_resolution:
+            boundaries, radius = self.__coarse_boundaries(
+                xpr, coarse_resolution, n_cpus=n_cpus, verbose=verbose,
+                max_tad_size=max_tad_size, no_heuristic=no_heuristic,
+                use_visibility=use_visibility, llik_cache=llik_cache)
+        return tadbit(xpr.hic_data, n_cpus=n_cpus, verbose=verbose,
+                      max_tad_size=max_tad_size, no_heuristic=no_heuristic,
+                      get_weights=True, use_visibility=use_visibility,
+                      window=window, overlap=overlap, boundaries=boundaries,
+                      radius=radius, llik_cache=llik_cache)
+
+
+    def __coarse_boundaries(self, xpr, resolution, **kwargs):
+        """
+        Boundaries of the TADs found at a coarser resolution, in bins of the
+        current resolution of the experiment, and the distance to them at
+        which boundaries are searched (one coarse bin).
+        """
+        fine = xpr.resolution
+        if resolution % fine:
+            raise Exception('Coarse resolution should be a multiple of the ' +
+                            'resolution of the experiment.\n')
+        ratio = resolution / fine
+        xpr.set_resolution(resolution)
+        try:
+            result = tadbit(xpr.hic_data, **kwargs)
+        finally:
+            xpr.set_resolution(fine)
+        # middle of the coarse bins ending each TAD (but the last one)
+        boundaries = [min(int(end) * ratio + ratio / 2, xpr.size - 1)
+                      for end in result['end'][:-1]]
+        return boundaries, ratio
+
+
     def __update_size(self, xpr):
         """
         Update the chromosome size and relative size after loading new Hi-C
@@ -451,6 +551,20 @@ class Chromosome(object):
         self.r_size = RelativeChromosomeSize(self.size)
 
 
+    def __normalized_region(self, xper, beg, end, vmin):
+        """
+        Get the normalized Hi-C data of a region, with filtered rows/columns
+        set to vmin. Weights are applied to each row of the region at once.
+        """
+        size = xper.size
+        matrix = np.array([xper.norm[0][beg + size * j:end + size * j]
+                           for j in xrange(beg, end)], dtype=float)
+        zeros = [z - beg for z in (xper._zeros or []) if beg <= z < end]
+        matrix[zeros, :] = vmin
+        matrix[:, zeros] = vmin
+        return matrix
+
+
     def visualize(self, name, tad=None, focus=None, paint_tads=False, axe=None,
                   show=True, logarithm=True, normalized=False, relative=True,
                   decorate=True):
@@ -514,33 +628,28 @@ class Chromosome(object):
         if relative:
             if normalized:
                 # find minimum, if value is non-zero... for logarithm
-                mini = min([i for i in xper.norm[0] if i])
+                norm = np.asarray(xper.norm[0])
+                mini = norm[norm != 0].min()
                 if mini == int(mini):
-                    vmin = min(xper.norm[0])
+                    vmin = norm.min()
                 else:
                     vmin = mini
                 vmin = fun(vmin or (1 if logarithm else 0))
-                vmax = fun(max(xper.norm[0]))
+                vmax = fun(norm.max())
             else:
-                vmin = fun(min(xper.hic_data[0]) or (1 if logarithm else 0))
-                vmax = fun(max(xper.hic_data[0]))
+                hic = xper.get_hic_matrix()
+                vmin = fun(hic.min() or (1 if logarithm else 0))
+                vmax = fun(hic.max())
         if not axe:
             plt.figure(figsize=(8, 6))
             axe = plt.subplot(111)
         if tad or focus:
             if start > -1:
                 if normalized:
-                    matrix = [
-                        [xper.norm[0][i+size*j]
-                         if (not i in xper._zeros
-                             and not j in xper._zeros) else vmin
-                         for i in xrange(start - 1, end)]
-                        for j in xrange(start - 1, end)]
+                    matrix = self.__normalized_region(xper, start - 1, end,
+                                                      vmin)
                 else:
-                    matrix = [
-                        [xper.hic_data[0][i+size*j]
-                         for i in xrange(start - 1, end)]
-                        for j in xrange(start - 1, end)]
+                    matrix = xper.get_region(start - 1, end - 1)[0]
             elif type(tad) is list:
                 if normalized:
                     warn('List passed, not going to be normalized.')
@@ -550,15 +659,9 @@ class Chromosome(object):
                 pass
         else:
             if normalized:
-                matrix = [[xper.norm[0][i+size*j]
-                           if (not i in xper._zeros
-                               and not j in xper._zeros) else vmin
-                           for i in xrange(size)]
-                          for j in xrange(size)]
+                matrix = self.__normalized_region(xper, 0, size, vmin)
             else:
-                matrix = [[xper.hic_data[0][i+size*j]\
-                           for i in xrange(size)] \
-                          for j in xrange(size)]
+                matrix = xper.get_hic_matrix()
         if relative:
             img = axe.imshow(fun(matrix), origin='lower', vmin=vmin, vmax=vmax,
                              interpolation="nearest",
@@ -589,7 +692,15 @@ class Chromosome(object):
             if show:
                 plt.show()
             return img
-        for i, tad in xper.tads.iteritems():
+        if start:
+            # TADs overlapping the focus
+            tads = self.tad_index.overlapping(
+                (start - 1) * xper.resolution, end * xper.resolution,
+                [xper.name]).get(xper.name, [])
+        else:
+            tads = xper.tads.keys()
+        for i in tads:
+            tad = xper.tads[i]
             if start:
                 print int(tad['start']) + 1, start
                 print int(tad['end']) + 1, end
@@ -640,16 +751,13 @@ class Chromosome(object):
         beg, end = int(tad['start']), int(tad['end'])
         xpr = self.get_experiment(x_name)
         size = xpr.size
-        matrix = [[0 for _ in xrange(beg, end)]\
-                  for _ in xrange(beg, end)]
-        for i, tadi in enumerate(xrange(beg, end)):
-            tadi = tadi * size
-            for j, tadj in enumerate(xrange(beg, end)):
-                if normed:
-                    matrix[j][i] = xpr.hic_data[matrix_num][tadi + tadj]
-                else:
-                    matrix[j][i] = xpr.norm[0][tadi + tadj]
-        return matrix
+        if normed:
+            hic = xpr.hic_data[matrix_num]
+        else:
+            hic = xpr.norm[0]
+        # each row of the TAD is read with one (strided) slice
+        return [list(hic[beg * size + tadj:end * size + tadj:size])
+                for tadj in xrange(beg, end)]
 
 
     def iter_tads(self, x_name, normed=True):
@@ -701,9 +809,10 @@ class Chromosome(object):
         best = (0, 0, 0)
         pos = 0
         for pos, raw in enumerate(xrange(0, size * size, size)):
-            if sum(hic[raw:raw + size]) == 0 and not beg:
+            empty = not np.asarray(hic[raw:raw + size]).any()
+            if empty and not beg:
                 beg = float(pos)
-            if sum(hic[raw:raw + size]) != 0 and beg:
+            if not empty and beg:
                 end = float(pos)
                 if (end - beg) > best[0]:
                     best = ((end - beg), beg, end)
@@ -4,13 +4,23 @@
 
 """
 
-from pytadbit.parsers.hic_parser         import read_matrix
+from pytadbit.parsers.hic_parser         import read_matrix, compact_matrix
+from pytadbit.parsers.hic_parser         import SparseHiC
+from pytadbit.parsers.hic_store          import HiCStore, is_hic_store
 from pytadbit.utils.extraviews           import nicer
-from pytadbit.utils.tadmaths             import zscore
+from pytadbit.utils.tadmaths             import _zscore_stats, _zscore_chunk
+from pytadbit.utils.tadmaths             import ZScores
 from pytadbit.utils.hic_filtering        import hic_filtering_for_modelling
+from pytadbit.utils.hic_normalization    import NormalizedHiC, hic_to_sparse
+from pytadbit.utils.hic_normalization    import iterative_correction
+from pytadbit.utils.hic_normalization    import knight_ruiz
 from pytadbit.parsers.tad_parser         import parse_tads
 from warnings                            import warn
-from math                                import sqrt
+from math                                import sqrt, ceil
+from collections                         import OrderedDict
+from itertools                           import chain, izip
+from gzip                                import GzipFile
+import numpy as np
 from pytadbit.imp.CONFIG                 import CONFIG
 
 try:
@@ -19,6 +29,15 @@ try:
 except ImportError:
     warn('IMP not found, check PYTHONPATH\n')
 
+# maximum memory (in bytes) used by the resolution pyramid of an Experiment
+PYRAMID_BUDGET = 2**30
+
+# maximum number of regions for which z-scores are kept by an Experiment
+REGION_CACHE_SIZE = 128
+
+# number of interacting pairs processed at once when writing them
+PAIRS_BLOCK = 100000
+
 class Experiment(object):
     """
     Hi-C experiment.
@@ -27,7 +46,12 @@ class Experiment(object):
     :param resolution: the resolution of the experiment (size of a bin in
        bases)
     :param None hic_data: whether a file or a list of lists corresponding to
-       the Hi-C data
+       the Hi-C data. Files may contain the list of interacting pairs instead
+       of the full matrix, and sparse matrices (see
+       :func:`pytadbit.parsers.hic_parser.read_sparse_matrix`) are accepted.
+       Binary Hi-C stores (see
+       :func:`pytadbit.parsers.hic_store.write_hic_store`) are memory-mapped
+       instead of being loaded
     :param None tad_def: a file or a dict with precomputed TADs for this
        experiment
     :param None parser: a parser function that returns a tuple of lists 
@@ -51,6 +75,9 @@ class Experiment(object):
        the TADs
     :param True filter_columns: filter the columns with unexpectedly high 
        content of low values
+    :param PYRAMID_BUDGET pyramid_budget: maximum memory (in bytes) used to
+       keep Hi-C data at resolutions other than the original one (see
+       :func:`pytadbit.Experiment.set_resolution`)
 
     TODO: doc conditions
     TODO: normalization
@@ -59,26 +86,33 @@ class Experiment(object):
 
     def __init__(self, name, resolution, hic_data=None, tad_def=None,
                  parser=None, no_warn=False, weights=None,
-                 conditions=None, filter_columns=True):
+                 conditions=None, filter_columns=True,
+                 pyramid_budget=PYRAMID_BUDGET):
         self.name            = name
         self.resolution      = resolution
         self.crm             = None
         self._ori_resolution = resolution
         self.hic_data        = None
         self._ori_hic        = None
+        self._ori_size       = None
+        self._pyramid        = OrderedDict()
+        self.pyramid_budget  = pyramid_budget
+        self._region_zscores = OrderedDict()
+        self.region_cache_size = REGION_CACHE_SIZE
         self.conditions      = sorted(conditions) if conditions else []
         self.size            = None
         self.tads            = {}
         self.norm            = None
+        self.bias            = None
         self._normalization  = None
         self._zeros          = None
         self._zscores        = {}
-        if hic_data:
+        if hic_data is not None:
             self.load_hic_data(hic_data, parser,
                                filter_columns=filter_columns)
         if tad_def:
             self.load_tad_def(tad_def, weights=weights)
-        elif not hic_data and not no_warn:
+        elif hic_data is None and not no_warn:
             warn('WARNING: this is an empty shell, no data here.\n')
 
 
@@ -92,20 +126,14 @@ class Experiment(object):
         """
         sum Hi-C data of experiments into a new one.
         """
-        reso1, reso2 = self.resolution, other.resolution
-        if self.resolution == other.resolution:
-            resolution = self.resolution
-        else:
-            resolution = max(reso1, reso2)
-            self.set_resolution(resolution)
-            other.set_resolution(resolution)
-            
+        resolution = max(self.resolution, other.resolution)
+        # coarser levels are taken from the resolution pyramids, without
+        # changing the current resolution of the experiments summed
+        hic1, _ = self._get_level(resolution)
+        hic2, _ = other._get_level(resolution)
         xpr = Experiment(name='%s+%s' % (self.name, other.name),
                          resolution=resolution,
-                         hic_data=tuple([i + j for i, j in zip(
-                             self.hic_data[0], other.hic_data[0])]))
-        self.set_resolution(reso1)
-        other.set_resolution(reso2)
+                         hic_data=np.asarray(hic1[0]) + np.asarray(hic2[0]))
         xpr.crm = self.crm
         return xpr
 
@@ -117,9 +145,15 @@ class Experiment(object):
         with the data corresponding to new data 
         (:func:`pytadbit.Chromosome.compare_condition`).
 
+        Each resolution computed is kept in a pyramid of resolutions, so that
+        switching back to it is immediate. When the memory used by the
+        pyramid exceeds Experiment.pyramid_budget, the least recently used
+        resolutions are discarded (see also :func:`build_pyramid`).
+
         :param resolution: an integer representing the resolution. This number
            must be a multiple of the original resolution, and higher than it
-        :param True keep_original: either to keep or not the original data
+        :param True keep_original: either to keep or not the original data.
+           If False, the new resolution becomes the original one
 
         """
         if resolution < self._ori_resolution:
@@ -129,39 +163,63 @@ class Experiment(object):
                             '  otherwise it is too complicated for me :P')
         if resolution == self.resolution:
             return
-        # if we want to go back to original resolution
-        if resolution == self._ori_resolution:
-            self.hic_data   = self._ori_hic
-            self.size       = self.resolution / self._ori_resolution * self.size
-            self.resolution = self._ori_resolution
-            return
-        # if current resolution is the original one
-        if self.resolution == self._ori_resolution:
-            self._ori_hic = self.hic_data[:]
+        self.hic_data, self.size = self._get_level(resolution)
         self.resolution = resolution
-        fact = self.resolution / self._ori_resolution
-        # super for!
-        size = int(sqrt(len(self._ori_hic[0])))
-        self.hic_data = [[]]
-        self.size     = size / fact
-        rest = size % fact
-        if rest:
-            self.size += 1
-        for i in xrange(0, size, fact):
-            for j in xrange(0, size, fact):
-                val = 0
-                for k in xrange(fact):
-                    if i + k >= size:
-                        break
-                    for l in  xrange(fact):
-                        if j + l >= size:
-                            break
-                        val += self._ori_hic[0][(i + k) * size + j + l]
-                self.hic_data[0].append(val)
-        # hic_data needs always to be stored as tuple
-        self.hic_data[0] = tuple(self.hic_data[0])
+        self._region_zscores.clear()
         if not keep_original:
-            del(self._ori_hic)
+            self._ori_hic        = self.hic_data
+            self._ori_size       = self.size
+            self._ori_resolution = resolution
+            self._pyramid.clear()
+
+
+    def build_pyramid(self, resolutions):
+        """
+        Compute the Hi-C data at several resolutions at once, each of them
+        being summed from the closest resolution already computed (e.g.: with
+        [20000, 40000, 100000], 40 kb are computed from 20 kb, and 100 kb from
+        20 kb). The current resolution of the experiment is not changed.
+
+        :param resolutions: list of resolutions, all multiples of the original
+           resolution
+        """
+        for resolution in sorted(resolutions):
+            if resolution % self._ori_resolution:
+                raise Exception('Resolution %s is not a multiple of the ' %
+                                resolution + 'original one.\n')
+            self._get_level(resolution)
+
+
+    def _get_level(self, resolution):
+        """
+        get the Hi-C data at a given resolution from the pyramid, computing it
+        if needed.
+
+        :returns: the Hi-C data and its size
+        """
+        if self._ori_hic is None:
+            # current data is the original one
+            self._ori_hic  = self.hic_data
+            self._ori_size = self.size
+        if resolution == self._ori_resolution:
+            return self._ori_hic, self._ori_size
+        if resolution in self._pyramid:
+            level = self._pyramid.pop(resolution)
+            self._pyramid[resolution] = level
+            return level
+        # start from the coarsest level from which this one can be summed
+        base = max([reso for reso in self._pyramid if not resolution % reso]
+                   + [self._ori_resolution])
+        hic, size = self._get_level(base)
+        level = ([coarsen_matrix(hic[0], size, resolution / base)],
+                 int(ceil(float(size) / (resolution / base))))
+        self._pyramid[resolution] = level
+        # free least recently used levels
+        used = sum(lvl[0][0].nbytes for lvl in self._pyramid.values())
+        while used > self.pyramid_budget and len(self._pyramid) > 1:
+            _, old = self._pyramid.popitem(last=False)
+            used -= old[0][0].nbytes
+        return level
 
 
     def load_hic_data(self, hic_data, parser=None, wanted_resolution=None,
@@ -197,9 +255,18 @@ class Experiment(object):
            of low values
         
         """
+        if type(hic_data) is str and is_hic_store(hic_data):
+            hic_data = HiCStore(hic_data)
+        if isinstance(hic_data, HiCStore):
+            # resolution is stored together with the data
+            wanted_resolution = wanted_resolution or self.resolution
+            data_resolution = data_resolution or hic_data.resolution
         nums, size = read_matrix(hic_data, parser=parser)
         self.hic_data = nums
         self.size     = size
+        self._ori_hic = None
+        self._pyramid.clear()
+        self._region_zscores.clear()
         self._ori_resolution = self.resolution = data_resolution or self._ori_resolution
         wanted_resolution = wanted_resolution or self.resolution
         self.set_resolution(wanted_resolution, keep_original=False)
@@ -207,7 +274,15 @@ class Experiment(object):
         #     xrange(0, self.size**2, self.size))
         #                  if sum(self.hic_data[0][raw:raw + self.size]) <= 100]
         if filter_columns:
-            self._zeros = hic_filtering_for_modelling(self.get_hic_matrix())
+            hic = self.hic_data[0]
+            if isinstance(hic, (HiCStore, SparseHiC)):
+                # only the sums of the columns are needed, the full matrix is
+                # not built
+                self._zeros = hic_filtering_for_modelling(
+                    None, sums=hic.row_sums())
+            else:
+                self._zeros = hic_filtering_for_modelling(
+                    self.get_hic_matrix())
         
 
     def load_tad_def(self, tad_def, weights=None):
@@ -225,21 +300,29 @@ class Experiment(object):
         tads, norm = parse_tads(tad_def)
         self.tads = tads
         self.norm  = weights or norm
+        self._region_zscores.clear()
+        if self.crm is not None:
+            self.crm._tad_index = None
         
 
-    def normalize_hic(self, method='visibility'):
+    def normalize_hic(self, method='visibility', tol=None, max_iter=None,
+                      band=None):
         """
         Normalize the Hi-C data. This normalization step does the same of
         the :func:`pytadbit.tadbit.tadbit` function (default parameters),
 
-        It fills the Experiment.norm variable with the Hi-C values divided by
-        the calculated weight.
+        It fills the Experiment.bias variable with one bias per row/column of
+        the Hi-C matrix, and the Experiment.norm variable with a view of the
+        Hi-C values divided by the calculated weight (see
+        :class:`pytadbit.utils.hic_normalization.NormalizedHiC`). The weight
+        of a cell is the product of the biases of its row and of its column.
 
         The weight of a given cell in column i and row j corresponds to the
         square root of the product of the sum of column i by the sum of row
         j.
 
-        :param visibility method: either 'sqrt' or 'visibility'. Depending on
+        :param visibility method: either 'sqrt', 'visibility', 'ice' or
+           'kr'. Depending on
            this parameter, the weight of the Hi-C count in row I, column J of
            the Hi-C matrix will be, under 'sqrt':
            ::
@@ -274,45 +357,67 @@ class Experiment(object):
            Note that the default behavior (also used in
            :func:`pytadbit.tadbit.tadbit`)
            corresponds to method='sqrt'.
+
+           Under 'ice' and 'kr' the weights are found by matrix balancing,
+           so that all the rows of the normalized matrix sum to the same
+           value, using iterative correction
+           (:func:`pytadbit.utils.hic_normalization.iterative_correction`)
+           or the faster algorithm of Knight and Ruiz
+           (:func:`pytadbit.utils.hic_normalization.knight_ruiz`).
+        :param None tol: tolerance of the matrix balancing ('ice' and 'kr'
+           methods only). Defaults to 1e-5 for 'ice' and 1e-6 for 'kr'
+        :param None max_iter: maximum number of iterations of the matrix
+           balancing ('ice' and 'kr' methods only). Defaults to 200 for 'ice'
+           and 100 for 'kr'
+        :param None band: if given, only interactions between bins closer
+           than this number of bins are used for matrix balancing ('ice' and
+           'kr' methods only)
         """
         if not self.hic_data:
             raise Exception('ERROR: No Hi-C data loaded\n')
-        if not method in ['sqrt', 'visibility']:
-            raise LookupError('Only "sqrt" and "visibility" methods are implemented')
+        if not method in ['sqrt', 'visibility', 'ice', 'kr']:
+            raise LookupError('Only "sqrt", "visibility", "ice" and "kr" ' +
+                              'methods are implemented')
         if self.norm:
             warn('WARNING: removing previous weights\n')
+        size = self.size
+        hic  = self.hic_data[0]
         # removes columns where there is no data in the diagonal
-        forbidden = [i for i in xrange(self.size)
-                     if not self.hic_data[0][i*self.size+i]]
-        size_range = [i for i in xrange(self.size) if not i in forbidden]
-        rowsums = []
-        for i in xrange(self.size):
-            i *= self.size
-            rowsums.append(0)
-            if i in forbidden:
-                continue
-            for j in size_range:
-                rowsums[-1] += self.hic_data[0][i + j]
-        self.norm = [[0. for _ in xrange(self.size * self.size)]]
-        if method == 'visibility':
-            total = sum(rowsums)
-            func = lambda x, y: float(rowsums[x] * rowsums[y]) / total
-        elif method == 'sqrt':
-            func = lambda x, y: sqrt(rowsums[x] * rowsums[y])
-        for i in size_range:
-            for j in size_range:
-                try:
-                    self.norm[0][i * self.size + j] = (
-                        self.hic_data[0][i * self.size + j] / func(i, j))
-                except ZeroDivisionError:
-                    continue
+        forbidden = np.array([i for i in xrange(size) if not hic[i*size+i]],
+                             dtype=int)
+        if method in ['ice', 'kr']:
+            balance = iterative_correction if method == 'ice' else knight_ruiz
+            kwargs = {}
+            if tol is not None:
+                kwargs['tol'] = tol
+            if max_iter is not None:
+                kwargs['max_iter'] = max_iter
+            bias = balance(hic_to_sparse(hic, size, band=band,
+                                         forbidden=forbidden), **kwargs)
+        else:
+            allowed = np.ones(size, dtype=bool)
+            allowed[forbidden] = False
+            rowsums = np.array([
+                np.asarray(hic[i * size:(i + 1) * size])[allowed].sum()
+                for i in xrange(size)], dtype=float)
+            if method == 'visibility':
+                bias = rowsums / sqrt(rowsums.sum())
+            else:
+                bias = np.sqrt(rowsums)
+            bias[forbidden] = 0
+        self.bias = bias
+        self.norm = [NormalizedHiC(hic, bias, size)]
         self._normalization = method
+        self._region_zscores.clear()
 
 
     def get_hic_zscores(self, normalized=True, zscored=True, remove_zeros=True):
         """
         Normalize the Hi-C raw data. The result will be stored into
-        the private Experiment._zscore list.
+        the private Experiment._zscores, a
+        :class:`pytadbit.utils.tadmaths.ZScores` object holding the upper
+        triangle of the matrix as a float32 array (it can also be read as a
+        dictionary of dictionaries, i.e.: Experiment._zscores['3']['10']).
 
         :param True normalized: whether to normalize the result using the
            weights (see :func:`normalize_hic`)
@@ -320,48 +425,15 @@ class Experiment(object):
         :param True remove_zeros: remove null interactions
         
         """
-        values = []
-        zeros = {}
-        self._zscores = {}
-        if normalized:
-            for i in xrange(self.size):
-                # zeros are rows or columns having a zero in the diagonal
-                if i in self._zeros:
-                    continue
-                for j in xrange(i + 1, self.size):
-                    if j in self._zeros:
-                        continue
-                    if (not self.hic_data[0][i * self.size + j] 
-                        or not self.hic_data[0][i * self.size + j])\
-                        and remove_zeros:
-                        zeros[(i, j)] = None
-                        continue
-                    values.append(self.norm[0][i * self.size + j])
-        else:
-            for i in xrange(self.size):
-                if i in self._zeros:
-                    continue
-                for j in xrange(i + 1, self.size):
-                    if j in self._zeros:
-                        continue
-                    values.append(self.hic_data[0][i * self.size + j])
-        # compute Z-score
-        if zscored:
-            zscore(values, self.size)
-        iterval = values.__iter__()
-        for i in xrange(self.size):
-            if i in self._zeros:
-                continue
-            for j in xrange(i + 1, self.size):
-                if j in self._zeros:
-                    continue
-                if (i, j) in zeros and remove_zeros:
-                    continue
-                zsc = iterval.next()
-                self._zscores.setdefault(str(i), {})
-                self._zscores[str(i)][str(j)] = zsc
-                # self._zscores.setdefault(j, {})
-                # self._zscores[j][i] = zsc
+        size = self.size
+        zeros = self._zeros or {}
+        bins = np.array([i for i in xrange(size) if not i in zeros], dtype=int)
+        hic = self.hic_data[0]
+        norm = self.norm[0] if normalized else None
+        self._zscores = _triangle_zscores(
+            lambda i: np.asarray(hic[i * size:(i + 1) * size]),
+            lambda i: np.asarray(norm[i * size:(i + 1) * size], dtype=float),
+            bins, size, normalized, zscored, remove_zeros)
 
 
     def model_region(self, start, end, n_models=5000, n_keep=1000, n_cpus=1,
@@ -511,67 +583,93 @@ class Experiment(object):
                 matrix)
 
     
+    def get_region(self, start, end):
+        """
+        Get the Hi-C data of a region of the experiment. Data is not copied
+        when the Hi-C matrix is stored as a numpy array, and only the cells of
+        the region are read otherwise.
+
+        :param start: first bin of the region (bin number, starting at 0)
+        :param end: last bin of the region (included)
+
+        :returns: a tuple with:
+
+           - a square numpy array with the Hi-C counts of the region
+           - a square numpy array with the normalized Hi-C data of the region
+             (None if the experiment was not normalized)
+           - the list of filtered rows/columns (numbers relative to start)
+        """
+        end += 1
+        raw = _region(self.hic_data[0], self.size, start, end)
+        norm = None
+        if self.norm and isinstance(self.norm[0], NormalizedHiC):
+            # weights are applied only to the region
+            bias = self.norm[0].bias[start:end]
+            weights = np.outer(bias, bias)
+            norm = np.zeros(raw.shape)
+            good = weights != 0
+            norm[good] = raw[good] / weights[good]
+        elif self.norm:
+            norm = _region(self.norm[0], self.size, start, end)
+        zeros = [z - start for z in sorted(self._zeros or []) if start <= z < end]
+        return raw, norm, zeros
+
+
     def _sub_experiment_zscore(self, start, end):
         """
         Get the z-score of a sub-region of an  experiment.
 
-        TODO: find a nicer way to do this...
+        Results are kept in a cache of up to Experiment.region_cache_size
+        regions, emptied when the Hi-C data or its normalization change. As
+        they are shared between calls, they are read-only.
 
         :param start: first bin to model (bin number)
         :param end: first bin to model (bin number)
 
-        :returns: z-score and raw values of the experiment
+        :returns: z-score (:class:`pytadbit.utils.tadmaths.ZScores`) and
+           normalized values of the experiment (square read-only numpy array,
+           NaN for missing values)
         """
         if self._normalization != 'visibility':
             warn('WARNING: normalizing according to visibility method')
             self.normalize_hic(method='visibility')
-        from pytadbit import Chromosome
-        matrix = self.get_hic_matrix()
-        end += 1
-        new_matrix = [[] for _ in range(end-start)]
-        for i in xrange(start, end):
-            for j in xrange(start, end):
-                new_matrix[i - start].append(matrix[i][j])
-                
-        tmp = Chromosome('tmp')
-        tmp.add_experiment('exp1', hic_data=[new_matrix],
-                           resolution=self.resolution, filter_columns=False)
-        exp = tmp.experiments[0]
-        # We want the weights and zeros calculated in the full chromosome
-        siz = self.size
-        exp.norm = [[self.norm[0][i + siz * j] for i in xrange(start, end)
-                     for j in xrange(start, end)]]
-        exp._zeros = dict([(z - start, None) for z in self._zeros
-                           if start <= z <= end])
-        if len(exp._zeros) == (end + 1 - start):
+        if (start, end) in self._region_zscores:
+            result = self._region_zscores.pop((start, end))
+            self._region_zscores[(start, end)] = result
+            return result
+        # We want the weights and zeros calculated in the full chromosome...
+        raw, norm, zeros = self.get_region(start, end)
+        size = len(raw)
+        if len(zeros) == size:
             raise Exception('ERROR: no interaction found in selected regions')
+        bins = np.array([i for i in xrange(size) if not i in zeros], dtype=int)
         # ... but the z-scores in this particular region
-        exp.get_hic_zscores(remove_zeros=True)
-        values = [[float('nan') for _ in xrange(exp.size)]
-                  for _ in xrange(exp.size)]
-        for i in xrange(exp.size):
-            # zeros are rows or columns having a zero in the diagonal
-            if i in exp._zeros:
-                continue
-            for j in xrange(i + 1, exp.size):
-                if j in exp._zeros:
-                    continue
-                if (not exp.hic_data[0][i * exp.size + j] 
-                    or not exp.hic_data[0][i * exp.size + j]):
-                    continue
-                values[i][j] = exp.norm[0][i * exp.size + j]
-                values[j][i] = exp.norm[0][i * exp.size + j]
-        return exp._zscores, values
+        zscores = _triangle_zscores(lambda i: raw[i], lambda i: norm[i],
+                                    bins, size, True, True, True)
+        values = np.empty((size, size))
+        values.fill(float('nan'))
+        kept = np.ix_(bins, bins)
+        values[kept] = np.where(raw[kept] != 0, norm[kept], float('nan'))
+        values[np.diag_indices(size)] = float('nan')
+        zscores.triangle.flags.writeable = False
+        values.flags.writeable = False
+        result = zscores, values
+        self._region_zscores[(start, end)] = result
+        while len(self._region_zscores) > self.region_cache_size:
+            self._region_zscores.popitem(last=False)
+        return result
         
 
     def write_interaction_pairs(self, fname, normalized=True, zscored=True,
                                 diagonal=False, cutoff=None, header=False,
                                 true_position=False, uniq=True,
-                                remove_zeros=False, focus=None):
+                                remove_zeros=False, focus=None,
+                                file_format='tsv'):
         """
         Creates a tab separated file with all the pairwise interactions.
         
-        :param fname: file name where to write the  pairwise interactions 
+        :param fname: file name where to write the  pairwise interactions. If
+           it ends with '.gz', the file is compressed with gzip
         :param True zscored: computes the z-score of the log10(data)
         :param True normalized: use the weights to normalize the data
         :param None cutoff: if defined, only the zscores above the cutoff will
@@ -581,67 +679,127 @@ class Experiment(object):
            otherwise, genomic bin.
         :param None focus: writes interactions between the start and stop bin
            passed to this parameter.
+        :param tsv file_format: either 'tsv' or 'npz'. With 'npz', the pairs
+           are stored as numpy arrays (named elt1, elt2 and value) in a
+           compressed binary file (see :py:func:`numpy.load`)
            
         """
-        if not self._zscores and zscored:
-            for i in xrange(self.size):
-                for j in xrange(self.size):
-                    self._zscores.setdefault(i, {})
-                    self._zscores[i][j] = self.hic_data[0][i * self.size + j]
         if not self.norm:
             raise Exception('Experiment not normalized.')
+        blocks = self._interaction_blocks(
+            normalized=normalized, zscored=zscored, diagonal=diagonal,
+            cutoff=cutoff, true_position=true_position, uniq=uniq,
+            remove_zeros=remove_zeros, focus=focus)
+        if file_format == 'npz':
+            blocks = list(blocks)
+            np.savez_compressed(fname, **dict(
+                [(key, np.concatenate([blk[k] for blk in blocks])
+                  if blocks else np.zeros(0))
+                 for k, key in enumerate(['elt1', 'elt2', 'value'])]))
+            return
+        if file_format != 'tsv':
+            raise NotImplementedError('Only "tsv" and "npz" formats are ' +
+                                      'implemented')
         # write to file
-        out = open(fname, 'w')
+        out = GzipFile(fname, 'w') if fname.endswith('.gz') else open(fname, 'w')
         if header:
             out.write('elt1\telt2\t%s\n' % ('zscore' if zscored else 
                                             'normalized hi-c' if normalized 
                                             else 'raw hi-c'))
+        for elt1, elt2, vals in blocks:
+            # a whole block of lines is formatted at once
+            out.write(('%s\t%s\t%s\n' * len(vals)) % tuple(chain.from_iterable(
+                izip(elt1.tolist(), elt2.tolist(), vals.tolist()))))
+        out.close()
+
+
+    def iter_interaction_pairs(self, normalized=True, zscored=True,
+                               diagonal=False, cutoff=None,
+                               true_position=False, uniq=True,
+                               remove_zeros=False, focus=None):
+        """
+        Iterate over the pairwise interactions, as they are written by
+        :func:`write_interaction_pairs` (parameters are the same).
+
+        :returns: a generator of tuples with the two interacting elements and
+           the value of their interaction
+        """
+        for elt1, elt2, vals in self._interaction_blocks(
+            normalized=normalized, zscored=zscored, diagonal=diagonal,
+            cutoff=cutoff, true_position=true_position, uniq=uniq,
+            remove_zeros=remove_zeros, focus=focus):
+            for pair in izip(elt1.tolist(), elt2.tolist(), vals.tolist()):
+                yield pair
+
+
+    def _interaction_blocks(self, normalized=True, zscored=True,
+                            diagonal=False, cutoff=None, true_position=False,
+                            uniq=True, remove_zeros=False, focus=None):
+        """
+        Generator of the pairwise interactions, by blocks of about
+        PAIRS_BLOCK pairs. Each block is a tuple of three numpy arrays (first
+        element, second element and value of the interactions).
+        """
+        size = self.size
         if focus:
             start, end = focus[0], focus[1] + 1
         else:
-            start, end = 0, self.size
+            start, end = 0, size
+        kept = np.ones(size, dtype=bool)
+        kept[[z for z in (self._zeros or []) if z < size]] = False
+        with_zscores = zscored and isinstance(self._zscores, ZScores)
+        block = []
+        nvals = 0
         for i in xrange(start, end):
-            if i in self._zeros:
+            if not kept[i]:
                 continue
             newstart = i if uniq else 0
-            for j in xrange(newstart, end):
-                if j in self._zeros:
-                    continue
-                if not diagonal and i == j:
-                    continue
-                if zscored:
-                    try:
-                        if self._zscores[i][j] < cutoff:
-                            continue
-                        if self._zscores[i][j] == -99:
-                            continue
-                    except KeyError:
-                        continue
-                    val = self._zscores[i][j]
-                elif normalized:
-                    val = self.norm[0][self.size*i+j]
-                else:
-                    val = self.hic_data[0][self.size*i+j]
-                if remove_zeros and not val:
-                    continue
-                if true_position:
-                    out.write('%s\t%s\t%s\n' % (self.resolution * (i + 1),
-                                                self.resolution * (j + 1), val))
-                else:
-                    out.write('%s\t%s\t%s\n' % (i + 1 - start, j + 1 - start, val))
-        out.close()
+            cols = np.arange(newstart, end)
+            if with_zscores:
+                vals = self._zscores.row(i)[newstart:end]
+            elif normalized and not zscored:
+                vals = np.asarray(self.norm[0][size * i + newstart:
+                                               size * i + end])
+            else:
+                # also used as z-scores when they were not computed
+                vals = np.asarray(self.hic_data[0][size * i + newstart:
+                                                   size * i + end])
+            good = kept[newstart:end].copy()
+            if not diagonal and newstart <= i < end:
+                good[i - newstart] = False
+            if with_zscores:
+                good &= ~np.isnan(vals)
+                good &= vals != -99
+            if zscored and cutoff is not None:
+                good &= vals >= cutoff
+            if remove_zeros:
+                good &= vals != 0
+            cols, vals = cols[good], vals[good]
+            if true_position:
+                block.append((np.repeat(self.resolution * (i + 1), len(cols)),
+                              self.resolution * (cols + 1), vals))
+            else:
+                block.append((np.repeat(i + 1 - start, len(cols)),
+                              cols + 1 - start, vals))
+            nvals += len(cols)
+            if nvals >= PAIRS_BLOCK:
+                yield tuple(np.concatenate(arrays) for arrays in zip(*block))
+                block = []
+                nvals = 0
+        if block:
+            yield tuple(np.concatenate(arrays) for arrays in zip(*block))
 
 
     def get_hic_matrix(self):
         """
         Return the Hi-C matrix.
 
-        :returns: list of lists representing the Hi-C data matrix of the
-           current experiment
+        :returns: a square numpy array representing the Hi-C data matrix of
+           the current experiment (matrix[i][j] is the interaction between
+           bins i and j). When the Hi-C data is stored as a numpy array, the
+           matrix returned is a view of it, not a copy
         """
-        siz = self.size
-        hic = self.hic_data[0]
-        return [[hic[i+siz * j] for i in xrange(siz)] for j in xrange(siz)]
+        return _region(self.hic_data[0], self.size, 0, self.size)
 
 
     def print_hic_matrix(self, print_it=True):
@@ -672,3 +830,76 @@ class Experiment(object):
     #     for i in self.size:
     #         dens[i] = self.resolution
     #     return dens
+
+
+def coarsen_matrix(hic, size, fact):
+    """
+    Sum the cells of a flat Hi-C matrix by squares of fact x fact cells. If
+    the size of the matrix is not a multiple of fact, the last row/column of
+    the new matrix contains the sum of the remaining ones.
+
+    Rows are processed by blocks of fact rows, so that only a small part of
+    the matrix is loaded at once when it is stored on disk.
+
+    :param hic: a flat Hi-C matrix (tuple, numpy array or
+       :class:`pytadbit.parsers.hic_store.HiCStore`)
+    :param size: number of rows/columns of the matrix
+    :param fact: number of rows/columns to be summed together
+
+    :returns: a flat numpy array (see
+       :func:`pytadbit.parsers.hic_parser.compact_matrix`)
+    """
+    starts = np.arange(0, size, fact)
+    new    = np.empty((len(starts), len(starts)),
+                      dtype=np.int64 if np.asarray(hic[:1]).dtype.kind in 'iub'
+                      else np.float64)
+    for i, beg in enumerate(starts):
+        rows = np.asarray(hic[beg * size:min(beg + fact, size) * size])
+        new[i] = np.add.reduceat(rows.reshape(-1, size).sum(axis=0), starts)
+    return compact_matrix(new)
+
+
+
+def _region(hic, size, start, end):
+    """
+    square region of a flat matrix, as a numpy array. This is a view of the
+    matrix if it is itself a numpy array.
+    """
+    if isinstance(hic, np.ndarray):
+        return hic.reshape(size, size)[start:end, start:end]
+    return np.array([hic[i * size + start:i * size + end]
+                     for i in xrange(start, end)])
+
+
+def _triangle_zscores(raw_row, norm_row, bins, size, normalized, zscored,
+                      remove_zeros):
+    """
+    compute the z-scores of the upper triangle of the kept bins of a matrix,
+    read row by row (raw_row and norm_row return the raw and normalized values
+    of a given row). Removed cells are set to NaN. Raw values keep their type,
+    as it changes the minimum used for null values (see
+    :func:`pytadbit.utils.tadmaths.zscore`).
+
+    :returns: a :class:`pytadbit.utils.tadmaths.ZScores` object
+    """
+    def rows():
+        for a, i in enumerate(bins):
+            cols = bins[a + 1:]
+            if normalized:
+                vals = np.array(norm_row(i), dtype=float)[cols]
+                if remove_zeros:
+                    vals[raw_row(i)[cols] == 0] = np.nan
+                yield vals
+            else:
+                yield np.asarray(raw_row(i))[cols]
+    # a single float32 triangle is allocated, and filled row by row, with the
+    # z-scores computed from the mean and deviation of a first pass on the rows
+    triangle = np.empty(len(bins) * (len(bins) - 1) / 2, dtype=np.float32)
+    if zscored:
+        stats = _zscore_stats(rows(), size)
+    start = 0
+    for vals in rows():
+        triangle[start:start + len(vals)] = (
+            _zscore_chunk(vals, size, *stats) if zscored else vals)
+        start += len(vals)
+    return ZScores(triangle, bins, size)
@@ -0,0 +1,189 @@
+"""
+18 Oct 2013
+
+Genome objects, holding the Chromosome objects of a genome and searching
+TADs in all of them at once.
+"""
+
+from pytadbit.chromosome              import Chromosome
+from pytadbit.utils.hic_normalization import NormalizedHiC
+from multiprocessing                  import Pool, cpu_count
+from traceback                        import format_exc
+from time                             import time
+from sys                              import stderr
+from os                               import getpid
+
+# (Chromosome, Experiment) pairs of the running Genome.find_tad. The worker
+# processes are forked once it is set, so that they read the Hi-C data of the
+# parent process (without copying or pickling it), and only receive the index
+# of their jobs.
+_JOBS = []
+
+
+class Genome(object):
+    """
+    A Genome object holds the Chromosome objects of a genome (e.g. of one
+    cell line), and searches the TADs of all their experiments at once (see
+    :func:`Genome.find_tad`).
+
+    :param name: name of the genome
+    :param None chromosomes: :py:func:`list` of
+       :class:`pytadbit.chromosome.Chromosome` objects (or of names of new
+       chromosomes)
+
+    """
+    def __init__(self, name, chromosomes=None):
+        self.name        = name
+        self.chromosomes = []
+        for crm in chromosomes or []:
+            self.add_chromosome(crm)
+
+
+    def __repr__(self):
+        return ('Genome %s:\n' % self.name +
+                '   %-2s chromosomes: %s\n' % (
+                    len(self.chromosomes),
+                    ', '.join([crm.name for crm in self.chromosomes])))
+
+
+    def __iter__(self):
+        return iter(self.chromosomes)
+
+
+    def __len__(self):
+        return len(self.chromosomes)
+
+
+    def add_chromosome(self, crm):
+        """
+        Add a chromosome to the genome.
+
+        :param crm: a :class:`pytadbit.chromosome.Chromosome` object, or the
+           name of a new (empty) chromosome
+
+        :returns: the :class:`pytadbit.chromosome.Chromosome` added
+        """
+        if not isinstance(crm, Chromosome):
+            crm = Chromosome(crm)
+        if crm.name in [c.name for c in self.chromosomes]:
+            raise Exception('ERROR: chromosome %s already in genome\n' % (
+                crm.name))
+        self.chromosomes.append(crm)
+        return crm
+
+
+    def get_chromosome(self, name):
+        """
+        :param name: name of the chromosome to select
+
+        :returns: :class:`pytadbit.chromosome.Chromosome`
+        """
+        for crm in self.chromosomes:
+            if crm.name == name:
+                return crm
+        raise Exception('ERROR: chromosome %s not found\n' % (name))
+
+
+    def find_tad(self, chromosomes=None, experiments=None, n_cpus=1,
+                 verbose=True, **kwargs):
+        """
+        Call the :func:`pytadbit.tadbit.tadbit` function on the Hi-C data of
+        every experiment of every chromosome, in parallel (each experiment in
+        its own process, with one thread). The results are stored in the
+        experiments as with :func:`pytadbit.chromosome.Chromosome.find_tad`.
+
+        Jobs are started from the largest to the smallest (the cost of a job
+        being estimated as the square of the number of rows/columns of the
+        experiment, times its number of matrices), so that the small ones
+        fill the gaps left at the end. The worker processes are forked after
+        the jobs are defined, and read the Hi-C data of this process instead
+        of receiving a copy of it.
+
+        A job that fails does not stop the others: the experiment keeps its
+        previous TADs, and the error is reported.
+
+        :param None chromosomes: names of the chromosomes to process (all by
+           default)
+        :param None experiments: names of the experiments to process (all the
+           experiments with Hi-C data by default)
+        :param 1 n_cpus: number of processes to run at once. If n_cpus='max'
+           the total number of CPUs will be used
+        :param True verbose: print a line per job as they end
+        :param kwargs: other arguments are passed to
+           :func:`pytadbit.chromosome.Chromosome.find_tad` (max_tad_size,
+           no_heuristic, use_visibility, window, overlap, coarse_resolution,
+           llik_cache)
+
+        :returns: a report, as a :py:func:`list` of dicts (one per job, in
+           the order in which they ended) with the names of the 'chromosome'
+           and of the 'experiment', the 'size' (rows/columns) and estimated
+           'cost' of the job, its wall 'time' in seconds, the 'pid' of the
+           process that ran it, and the 'error' (the traceback of the
+           exception raised, or None)
+        """
+        global _JOBS
+        crms = ([self.get_chromosome(name) for name in chromosomes]
+                if chromosomes else self.chromosomes)
+        _JOBS = [(crm, xpr) for crm in crms for xpr in crm.experiments
+                 if xpr.hic_data and (experiments is None or
+                                      xpr.name in experiments)]
+        costs = [len(xpr.hic_data) * xpr.size**2 for _, xpr in _JOBS]
+        order = sorted(xrange(len(_JOBS)), key=lambda j: -costs[j])
+        kwargs = dict(kwargs, verbose=False, n_cpus=1)
+        n_cpus = cpu_count() if n_cpus == 'max' else n_cpus
+        pool = None
+        report = []
+        try:
+            if n_cpus > 1 and len(order) > 1:
+                pool = Pool(min(n_cpus, len(order)))
+                # one job at a time, so that they start in order
+                done = pool.imap_unordered(_find_tad_job,
+                                           [(j, kwargs) for j in order],
+                                           chunksize=1)
+            else:
+                done = (_find_tad_job((j, kwargs)) for j in order)
+            for j, result, weights, elapsed, error, pid in done:
+                crm, xpr = _JOBS[j]
+                if error is None:
+                    if weights and type(weights[0]) is tuple:
+                        weights = [NormalizedHiC(xpr.hic_data[k], bias,
+                                                 xpr.size)
+                                   for k, bias in weights]
+                    xpr.load_tad_def(result, weights=weights)
+                    if crm._search_centromere:
+                        crm._get_forbidden_region(xpr)
+                report.append({'chromosome': crm.name,
+                               'experiment': xpr.name,
+                               'size'      : xpr.size,
+                               'cost'      : costs[j],
+                               'time'      : elapsed,
+                               'pid'       : pid,
+                               'error'     : error})
+                if verbose:
+                    stderr.write('%s %s (%d bins): %s in %.1fs\n' % (
+                        crm.name, xpr.name, xpr.size,
+                        'FAILED' if error else 'done', elapsed))
+        finally:
+            if pool is not None:
+                pool.close()
+                pool.join()
+            _JOBS = []
+        return report
+
+
+def _find_tad_job(args):
+    """
+    Run the job number 'job' of _JOBS. The weights defined as views of the
+    Hi-C data are returned as the (matrix number, biases) pairs needed to
+    build them again, instead of being pickled with the Hi-C data.
+    """
+    job, kwargs = args
+    crm, xpr = _JOBS[job]
+    start = time()
+    try:
+        result, weights = crm._experiment_tads(xpr, **kwargs)
+    except Exception:
+        return job, None, None, time() - start, format_exc(), getpid()
+    if weights and isinstance(weights[0], NormalizedHiC):
+        weights = [(k, w.bias) for k, w in enumerate(weights)]
+    return job, result, weights, time() - start, None, getpid()
@@ -0,0 +1,287 @@
+"""
+18 Oct 2013
+
+Directory-based storage of Chromosome objects.
+
+A store is a directory with an index (the attributes of the chromosome and
+the description of its experiments) and one sub-directory per experiment
+holding its Hi-C data, weights and TADs in separate files. Experiments can
+thus be added, replaced and loaded one at a time:
+
+ - the index is written aside and renamed, so that readers always find a
+   complete index, even while another process writes the store;
+ - the files of an experiment are written before the index refers to them,
+   and are never modified (a replaced experiment gets a new sub-directory);
+ - the files of replaced experiments are kept, as readers may still be
+   loading them, until the store is compacted with
+   :func:`compact_chromosome_store`;
+ - processes writing the same store wait for each other.
+"""
+
+from pytadbit.chromosome          import Chromosome
+from pytadbit.experiment          import Experiment
+from pytadbit.parsers.hic_store   import write_hic_store, load_hic_store
+from pytadbit.parsers.hic_store   import HiCStore
+from pytadbit.parsers.hic_parser  import SparseHiC
+from pytadbit.utils.hic_normalization import NormalizedHiC
+from cPickle                      import load, dump, HIGHEST_PROTOCOL
+from os                           import path, mkdir, rename, getpid, listdir
+from shutil                       import rmtree
+from fcntl                        import flock, LOCK_EX, LOCK_UN
+import numpy as np
+
+INDEX  = 'index.pik'
+LOCK   = 'lock'
+FIELDS = ('hic_data', 'norm', 'tads')
+
+
+def write_chromosome_store(crm, directory, experiments=None):
+    """
+    Write a Chromosome object into a store directory, that can be loaded with
+    :func:`load_chromosome_store`. If the store already exists, only the
+    experiments given are written (added, or replacing the experiments with
+    the same name) and the files of the others are left untouched. The files
+    of replaced experiments are removed by :func:`compact_chromosome_store`.
+
+    Hi-C data of integer counts are written as Hi-C stores (see
+    :func:`pytadbit.parsers.hic_store.write_hic_store`), other matrices and
+    weights as numpy arrays.
+
+    :param crm: a :class:`pytadbit.chromosome.Chromosome` object
+    :param directory: path to the store (created if needed)
+    :param None experiments: names of the experiments to write (all by
+       default)
+    """
+    if not path.exists(directory):
+        mkdir(directory)
+    lock = open(path.join(directory, LOCK), 'a')
+    flock(lock, LOCK_EX)
+    try:
+        index = _read_index(directory) or {'experiments': [], 'next': 0}
+        index.setdefault('replaced', [])
+        names = experiments or [xpr.name for xpr in crm.experiments]
+        for name in names:
+            xpr = crm.get_experiment(name)
+            # (directories left by an interrupted writer are not reused)
+            while path.exists(path.join(directory, 'xpr%d' % index['next'])):
+                index['next'] += 1
+            meta = _write_experiment(xpr, directory, 'xpr%d' % index['next'])
+            for i, other in enumerate(index['experiments']):
+                if other['name'] == name:
+                    index['replaced'].append(other['dir'])
+                    index['experiments'][i] = meta
+                    break
+            else:
+                index['experiments'].append(meta)
+        index['name']         = crm.name
+        index['size']         = crm.size
+        index['r_size']       = crm.r_size
+        index['max_tad_size'] = crm.max_tad_size
+        index['forbidden']    = crm.forbidden
+        index['_centromere']  = crm._centromere
+        _write_index(index, directory)
+    finally:
+        flock(lock, LOCK_UN)
+        lock.close()
+
+
+def compact_chromosome_store(directory):
+    """
+    Remove the files of the experiments replaced in a store directory written
+    with :func:`write_chromosome_store`. Chromosome objects loaded from the
+    store before their experiments were replaced may refer to these files, and
+    should not be used anymore, nor should the store be loaded meanwhile.
+
+    :param directory: path to the store
+
+    :returns: the number of experiments removed
+    """
+    lock = open(path.join(directory, LOCK), 'a')
+    flock(lock, LOCK_EX)
+    try:
+        index = _read_index(directory)
+        if index is None:
+            raise IOError('ERROR: %s is not a chromosome store.\n' %
+                          directory)
+        replaced = index.get('replaced', [])
+        index['replaced'] = []
+        _write_index(index, directory)
+        for dirname in replaced:
+            rmtree(path.join(directory, dirname), ignore_errors=True)
+    finally:
+        flock(lock, LOCK_UN)
+        lock.close()
+    return len(replaced)
+
+
+def load_chromosome_store(directory, experiments=None, fields=FIELDS):
+    """
+    Load a Chromosome object from a store directory written with
+    :func:`write_chromosome_store`.
+
+    Only the files of the experiments and fields asked for are opened, and
+    Hi-C data and weights are memory-mapped: their values are read from disk
+    when accessed.
+
+    :param directory: path to the store
+    :param None experiments: names of the experiments to load (all by
+       default)
+    :param ('hic_data','norm','tads') fields: fields of the experiments to
+       load, the others are left empty
+
+    :returns: a :class:`pytadbit.chromosome.Chromosome` object
+    """
+    index = _read_index(directory)
+    if index is None:
+        raise IOError('ERROR: %s is not a chromosome store.\n' % directory)
+    crm = Chromosome(index['name'])
+    for meta in index['experiments']:
+        if experiments is not None and meta['name'] not in experiments:
+            continue
+        xpr = Experiment(meta['name'], meta['resolution'], no_warn=True)
+        xpr.conditions = meta['cond']
+        xpr.size       = meta['size']
+        xpr_dir = path.join(directory, meta['dir'])
+        if 'hic_data' in fields or 'norm' in fields:
+            hic_data = [_load_array(xpr_dir, blob) for blob in meta['hi-c']]
+            if 'hic_data' in fields:
+                xpr.hic_data = hic_data or None
+        if 'norm' in fields and meta['wght'] is not None:
+            xpr.norm = [NormalizedHiC(hic_data[blob[2]],
+                                      _load_array(xpr_dir, blob[:2]),
+                                      xpr.size)
+                        if blob[0] == 'bias' else _load_array(xpr_dir, blob)
+                        for blob in meta['wght']]
+        if 'tads' in fields:
+            xpr.tads = load(open(path.join(xpr_dir, meta['tads']), 'rb'))
+        crm.experiments.append(xpr)
+    crm.size         = index['size']
+    crm.r_size       = index['r_size']
+    crm.max_tad_size = index['max_tad_size']
+    crm.forbidden    = index['forbidden']
+    crm._centromere  = index['_centromere']
+    return crm
+
+
+def is_chromosome_store(directory):
+    """
+    :param directory: path to a directory
+
+    :returns: True if the directory was written with
+       :func:`write_chromosome_store`
+    """
+    return path.isdir(directory) and INDEX in listdir(directory)
+
+
+def _read_index(directory):
+    """
+    Index of a store, None if there is none.
+    """
+    try:
+        f_h = open(path.join(directory, INDEX), 'rb')
+    except IOError:
+        return None
+    index = load(f_h)
+    f_h.close()
+    return index
+
+
+def _write_index(index, directory):
+    """
+    Write the index of a store aside and rename it, so that it is replaced at
+    once.
+    """
+    tmp = path.join(directory, '%s.%d' % (INDEX, getpid()))
+    out = open(tmp, 'wb')
+    dump(index, out, HIGHEST_PROTOCOL)
+    out.close()
+    rename(tmp, path.join(directory, INDEX))
+
+
+def _write_experiment(xpr, directory, dirname):
+    """
+    Write the files of an experiment into a new sub-directory of the store.
+
+    :returns: the description of the experiment in the index
+    """
+    xpr_dir = path.join(directory, dirname)
+    mkdir(xpr_dir)
+    meta = {'name'      : xpr.name,
+            'dir'       : dirname,
+            'size'      : xpr.size,
+            'cond'      : xpr.conditions,
+            'resolution': xpr.resolution,
+            'hi-c'      : [],
+            'wght'      : None,
+            'tads'      : 'tads.pik'}
+    hic_data = xpr.hic_data or []
+    for k, hic in enumerate(hic_data):
+        meta['hi-c'].append(_write_array(xpr_dir, 'hic_%d' % k, hic, xpr))
+    if xpr.norm is not None:
+        meta['wght'] = []
+        for k, norm in enumerate(xpr.norm):
+            # views of the Hi-C data are stored as biases
+            views = [i for i, hic in enumerate(hic_data)
+                     if isinstance(norm, NormalizedHiC) and
+                     _same_data(norm.hic, hic)]
+            if views:
+                fnam = 'bias_%d.npy' % k
+                np.save(path.join(xpr_dir, fnam), norm.bias)
+                meta['wght'].append(('bias', fnam, views[0]))
+            else:
+                meta['wght'].append(_write_array(xpr_dir, 'wght_%d' % k,
+                                                 norm))
+    out = open(path.join(xpr_dir, meta['tads']), 'wb')
+    dump(xpr.tads, out, HIGHEST_PROTOCOL)
+    out.close()
+    return meta
+
+
+def _same_data(hic1, hic2):
+    """
+    Whether two flat matrices are the same (numpy arrays may be distinct
+    views of the same data).
+    """
+    if hic1 is hic2:
+        return True
+    if isinstance(hic1, HiCStore) and isinstance(hic2, HiCStore):
+        return path.samefile(hic1.f_name, hic2.f_name)
+    return (isinstance(hic1, np.ndarray) and isinstance(hic2, np.ndarray) and
+            hic1.shape == hic2.shape and hic1.dtype == hic2.dtype and
+            hic1.__array_interface__['data'] ==
+            hic2.__array_interface__['data'])
+
+
+def _write_array(xpr_dir, name, values, xpr=None):
+    """
+    Write a flat matrix, as a Hi-C store if it holds integer counts of an
+    experiment, as a numpy array otherwise.
+
+    :returns: the kind of file and its name
+    """
+    if isinstance(values, (HiCStore, SparseHiC)) and xpr is not None:
+        fnam = name + '.hic'
+        write_hic_store(path.join(xpr_dir, fnam), values, xpr.size,
+                        xpr.resolution, dtype=values.dtype)
+        return ('store', fnam)
+    values = np.asarray(values[:] if isinstance(values, NormalizedHiC)
+                        else values)
+    if xpr is not None and np.issubdtype(values.dtype, np.integer):
+        fnam = name + '.hic'
+        # (counts overflowing 32 bits are kept as 64 bits integers)
+        write_hic_store(path.join(xpr_dir, fnam), values, xpr.size,
+                        xpr.resolution, dtype=values.dtype)
+        return ('store', fnam)
+    fnam = name + '.npy'
+    np.save(path.join(xpr_dir, fnam), values)
+    return ('npy', fnam)
+
+
+def _load_array(xpr_dir, blob):
+    """
+    Memory-mapped matrix or vector written by _write_array.
+    """
+    kind, fnam = blob[:2]
+    if kind == 'store':
+        return load_hic_store(path.join(xpr_dir, fnam))
+    return np.load(path.join(xpr_dir, fnam), mmap_mode='r')
@@ -4,45 +4,319 @@
 
 """
 
-from math import sqrt
+from math         import sqrt
+from gzip         import GzipFile
+from itertools    import islice
+from scipy.sparse import coo_matrix, issparse
+from pytadbit.parsers.hic_store import HiCStore, is_hic_store
+import numpy as np
 
-def _read_matrix(f_h):
+# number of rows parsed at once by the matrix reader
+CHUNK_SIZE = 512
+
+# largest value stored in 32 bits integers
+INT32_MAX = 2**31 - 1
+
+
+def _open_file(f_name):
+    """
+    Open a file for reading, transparently decompressing it if gzipped.
+
+    :param f_name: path to the file
+
+    :returns: a file handler
+    """
+    f_h = open(f_name, 'rb')
+    magic = f_h.read(2)
+    f_h.seek(0)
+    if magic == '\x1f\x8b':
+        return GzipFile(fileobj=f_h)
+    return f_h
+
+
+def _data_lines(f_h):
+    """
+    iterate over the lines of a file, skipping empty lines and comments
+    """
+    for line in f_h:
+        values = line.split()
+        if values and not values[0].startswith('#'):
+            yield line
+
+
+def _read_matrix(f_h, dtype=np.int32, chunk_size=CHUNK_SIZE, sparse=None):
     """
     reads from file
+
+    Rows are parsed in chunks of chunk_size lines and written directly into a
+    contiguous buffer, no intermediate python list is built.
+
+    :param f_h: file handler (plain or gzipped)
+    :param numpy.int32 dtype: type of the values stored (numpy.int32 or
+       numpy.float32). As with previous versions, float values are truncated
+       when stored as integers
+    :param 512 chunk_size: number of rows to parse at once
+    :param None sparse: whether the file contains the list of interacting
+       pairs (see :func:`_read_sparse_matrix`) instead of the full matrix. By
+       default, files whose lines hold two bin numbers and a count are read as
+       sparse, unless they have exactly three lines (a 3x3 matrix without
+       headers)
+
+    :returns: the matrix concatenated into a flat numpy array, and the number
+       of rows (or a :py:class:`scipy.sparse.csr_matrix` for sparse files)
     """
-    nums = []
-    while True:
-        values = f_h.next().split()
-        if values[0].startswith('#'):
-            # skip comments
-            continue
-        break
+    lines = _data_lines(f_h)
+    first = list(islice(lines, 1))
+    if not first:
+        raise Exception('ERROR: no data found in file.\n')
+    values = first[0].split()
+    # sparse files contain one interaction per line: bin1, bin2, count
+    if sparse is None:
+        sparse = (len(values) == 3 and values[0].isdigit() and
+                  values[1].isdigit())
+        if sparse:
+            first.extend(islice(lines, 3))
+            sparse = len(first) != 3
+    if sparse:
+        return _read_sparse_matrix(f_h, lines=first)
     # check if we have headers/row-names in the file
-    start = 1
     if values[0].isdigit():
-        try:
-            nums.append([int(v) for v in values])
-        except ValueError:
-            nums.append([int(float(v)) for v in values])
         start = 0
-    # parse the rest of the file
+        size  = len(values)
+    else:
+        start = 1
+        size  = len(values)
+        first = first[1:]
+    # the buffer is stored column by column, filling it row by row in
+    # Fortran order gives the flat layout expected by tadbit without copying
+    matrix = np.empty((size, size), dtype=dtype, order='F')
+    row = 0
+    chunk = first
     for line in f_h:
-        values = line.split()[start:]
-        try:
-            nums.append([int(v) for v in values])
-        except ValueError:
-            nums.append([int(float(v)) for v in values])
+        chunk.append(line)
+        if len(chunk) < chunk_size:
+            continue
+        row = _fill_rows(matrix, row, chunk, start, size)
+        chunk = []
+    if chunk:
+        row = _fill_rows(matrix, row, chunk, start, size)
     f_h.close()
-    size = len(nums)
-    return tuple([nums[j][i] for i in xrange(size) for j in xrange(size)]), size
+    if row != size:
+        raise AttributeError('ERROR: matrix should be square.\n')
+    return matrix.reshape(-1, order='F'), size
+
+
+def _fill_rows(matrix, row, lines, start, size):
+    """
+    parse a chunk of lines and store them into the matrix starting at row.
+
+    :returns: the index of the next row to fill
+    """
+    if start:
+        lines = [l.split(None, 1)[1] for l in lines if l.strip()]
+    else:
+        lines = [l for l in lines if l.strip()]
+    if row + len(lines) > size:
+        raise AttributeError('ERROR: matrix should be square.\n')
+    values = np.fromstring(' '.join(lines), dtype=float, sep=' ')
+    if len(values) != len(lines) * size:
+        raise AttributeError('ERROR: matrix should be square.\n')
+    matrix[row:row + len(lines)] = values.reshape(len(lines), size)
+    return row + len(lines)
+
+
+def _read_sparse_matrix(f_h, size=None, first_bin=1, dtype=np.int32,
+                        chunk_size=CHUNK_SIZE, lines=None):
+    """
+    reads a sparse matrix from file
+
+    Each line of the file contains the two bins of an interacting pair and the
+    corresponding count, separated by spaces or tabs (as written by
+    :func:`pytadbit.experiment.Experiment.write_interaction_pairs`):
+
+    ::
+
+      1	1	629
+      1	2	164
+      1	3	88
+      2	2	612
+
+    Only one of the two symmetric cells needs to be present (usually the upper
+    triangle). Pairs appearing more than once are summed.
+
+    :param f_h: file handler (plain or gzipped)
+    :param None size: number of bins of the matrix. By default the highest bin
+       found in the file
+    :param 1 first_bin: number of the first bin in the file (1 or 0)
+    :param numpy.int32 dtype: type of the values stored
+    :param 512 chunk_size: number of lines to parse at once
+    :param None lines: lines already read from the file handler
+
+    :returns: a symmetric :py:class:`scipy.sparse.csr_matrix`, and the number
+       of rows
+    """
+    bins1 = []
+    bins2 = []
+    counts = []
+    chunk = lines or []
+    def parse(chunk):
+        vals = np.fromstring(' '.join([l for l in chunk
+                                       if not l.startswith('#')]),
+                             dtype=float, sep=' ')
+        if len(vals) % 3:
+            raise AttributeError('ERROR: sparse matrix should have three ' +
+                                 'columns (bin1, bin2, count).\n')
+        vals = vals.reshape(-1, 3)
+        bins1.append(vals[:, 0].astype(np.int64) - first_bin)
+        bins2.append(vals[:, 1].astype(np.int64) - first_bin)
+        counts.append(vals[:, 2].astype(dtype))
+    for line in f_h:
+        chunk.append(line)
+        if len(chunk) < chunk_size:
+            continue
+        parse(chunk)
+        chunk = []
+    if chunk:
+        parse(chunk)
+    f_h.close()
+    bins1  = np.concatenate(bins1)
+    bins2  = np.concatenate(bins2)
+    counts = np.concatenate(counts)
+    if len(bins1) and min(bins1.min(), bins2.min()) < 0:
+        raise AttributeError('ERROR: bin numbers should start at %s.\n' % (
+            first_bin))
+    if size is None:
+        size = int(max(bins1.max(), bins2.max())) + 1 if len(bins1) else 0
+    # store both symmetric cells, the diagonal only once
+    offdiag = bins1 != bins2
+    rows = np.concatenate((bins1, bins2[offdiag]))
+    cols = np.concatenate((bins2, bins1[offdiag]))
+    vals = np.concatenate((counts, counts[offdiag]))
+    matrix = coo_matrix((vals, (rows, cols)), shape=(size, size), dtype=dtype)
+    return matrix.tocsr(), size
+
+
+def read_sparse_matrix(thing, size=None, first_bin=1):
+    """
+    Read a Hi-C matrix stored as a list of interacting pairs (see
+    :func:`_read_sparse_matrix`) without building the dense matrix. The
+    result can be passed directly to :func:`pytadbit.tadbit.tadbit` or used
+    as hic_data of :class:`pytadbit.Experiment`.
+
+    :param thing: file name (optionally gzipped) or file handler
+    :param None size: number of bins of the matrix. By default the highest bin
+       found in the file
+    :param 1 first_bin: number of the first bin in the file (1 or 0)
 
+    :returns: a symmetric :py:class:`scipy.sparse.csr_matrix`, and the number
+       of rows
+    """
+    if type(thing) is str:
+        thing = _open_file(thing)
+    return _read_sparse_matrix(thing, size=size, first_bin=first_bin)
+
+
+class SparseHiC(object):
+    """
+    Read-only Hi-C matrix backed by a scipy sparse matrix, as read from lists
+    of interacting pairs (see :func:`read_sparse_matrix`).
+
+    It behaves like the flat matrices stored in Experiment.hic_data: the value
+    of the cell in row i and column j is obtained with hic[i * size + j], and
+    slices return numpy arrays. Only the cells accessed are expanded.
+
+    :param matrix: a square and symmetric scipy sparse matrix
 
-def read_matrix(things, parser=None):
+    """
+    def __init__(self, matrix):
+        self.matrix = matrix.tocsr()
+        self.size   = self.matrix.shape[0]
+        self.dtype  = self.matrix.dtype
+
+
+    def __repr__(self):
+        return 'SparseHiC (size: %s, non-zero cells: %s)' % (
+            self.size, self.matrix.nnz)
+
+
+    def __len__(self):
+        return self.size * self.size
+
+
+    def __getitem__(self, k):
+        if isinstance(k, slice):
+            beg, end, step = k.indices(len(self))
+            if step != 1:
+                ks = np.arange(beg, end, step, dtype=np.int64)
+                return np.asarray(
+                    self.matrix[ks / self.size, ks % self.size]).ravel()
+            if end <= beg:
+                return np.zeros(0, dtype=self.dtype)
+            # expand only the rows overlapping the slice
+            first = beg / self.size
+            block = self.matrix[first:(end - 1) / self.size + 1].toarray()
+            off   = first * self.size
+            return block.ravel()[beg - off:end - off]
+        if k < 0:
+            k += len(self)
+        if not 0 <= k < len(self):
+            raise IndexError('Hi-C matrix index out of range')
+        return self.matrix[k / self.size, k % self.size]
+
+
+    def __iter__(self):
+        for i in xrange(self.size):
+            for val in self.row(i):
+                yield val
+
+
+    def __array__(self, dtype=None):
+        return np.asarray(self[:], dtype=dtype)
+
+
+    def row(self, i):
+        """
+        :param i: row number
+
+        :returns: a numpy array with the values of row i
+        """
+        return self.matrix[i].toarray().ravel()
+
+
+    def row_sums(self):
+        """
+        :returns: a numpy array with the sum of each row (equal to the sum of
+           each column)
+        """
+        return np.asarray(self.matrix.sum(axis=1)).ravel()
+
+
+    @property
+    def triangle(self):
+        """
+        upper triangle of the matrix, row after row (as stored in Hi-C
+        stores), expanded by blocks of rows
+        """
+        out = np.empty(self.size * (self.size + 1) / 2, dtype=self.dtype)
+        pos = 0
+        for beg in xrange(0, self.size, CHUNK_SIZE):
+            block = self.matrix[beg:beg + CHUNK_SIZE].toarray()
+            for i, row in enumerate(block, beg):
+                out[pos:pos + self.size - i] = row[i:]
+                pos += self.size - i
+        return out
+
+
+def read_matrix(things, parser=None, sparse=None):
     """
     Read and checks a matrix from a file or a list.
 
     :param things: might be either a file name, a file handler, a list of them
-        or a list of list (all with same length)
+        or a list of list (all with same length). Files may contain either
+        the full matrix or the list of interacting pairs (see
+        :func:`_read_sparse_matrix`), or be binary Hi-C stores (see
+        :func:`pytadbit.parsers.hic_store.write_hic_store`). Sparse matrices
+        (as returned by :func:`read_sparse_matrix`) are also accepted
     :param None parser: a parser function that returns a tuple of lists representing the data matrix,
         with this file example.tsv:
         ::
@@ -57,44 +331,73 @@ def read_matrix(things, parser=None):
         ``([629, 86, 159, 100, 164, 612, 216, 111, 88, 175, 437, 146, 105, 110,
         105, 278])``
 
+    :param None sparse: whether the files read by the default parser contain
+        the list of interacting pairs (see :func:`_read_matrix`). By default
+        it is guessed from their content
 
-    :returns: the corresponding matrix concatenated into a huge list, also
-        returns number or rows
+    :returns: the corresponding matrix concatenated into a flat numpy array
+        (see :func:`compact_matrix`; sparse matrices are kept sparse, as
+        :class:`SparseHiC`), also returns number or rows
 
     """
-    parser = parser or _read_matrix
+    parser = parser or (lambda f_h: _read_matrix(f_h, sparse=sparse))
     if type(things) is not list:
         things = [things]
     matrices = []
     sizes    = []
     for thing in things:
-        if type(thing) is file:
+        if type(thing) is file or isinstance(thing, GzipFile):
             matrix, size = parser(thing)
-            matrices.append(matrix)
+            matrices.append(compact_matrix(matrix))
             sizes.append(size)
+        elif type(thing) is str and is_hic_store(thing):
+            matrices.append(HiCStore(thing))
+            sizes.append(matrices[-1].size)
         elif type(thing) is str:
-            matrix, size = parser(open(thing))
-            matrices.append(matrix)
+            matrix, size = parser(_open_file(thing))
+            matrices.append(compact_matrix(matrix))
             sizes.append(size)
+        elif isinstance(thing, (HiCStore, SparseHiC)):
+            matrices.append(thing)
+            sizes.append(thing.size)
+        elif issparse(thing):
+            row, col = thing.shape
+            if row != col:
+                raise AttributeError('ERROR: matrix should be square.\n')
+            matrices.append(compact_matrix(thing))
+            sizes.append(row)
         elif type(thing) is list:
             if all([len(thing)==len(l) for l in thing]):
-                matrices.append(reduce(lambda x, y: x+y, thing))
+                matrices.append(compact_matrix(thing))
                 sizes.append(len(thing))
             else:
                 raise Exception('must be list of lists, all with same length.')
         elif type(thing) is tuple:
             # case we know what we are doing and passing directly list of tuples
-            matrices.append(thing)
+            matrices.append(compact_matrix(thing))
+            siz = sqrt(len(thing))
+            if int(siz) != siz:
+                raise AttributeError('ERROR: matrix should be square.\n')
+            sizes.append(int(siz))
+        elif isinstance(thing, np.ndarray) and thing.ndim == 1:
+            # flat buffer, as returned by the default parser
             siz = sqrt(len(thing))
             if int(siz) != siz:
                 raise AttributeError('ERROR: matrix should be square.\n')
+            matrices.append(compact_matrix(thing))
             sizes.append(int(siz))
+        elif isinstance(thing, np.ndarray) and thing.ndim == 2:
+            row, col = thing.shape
+            if row != col:
+                raise AttributeError('ERROR: matrix should be square.\n')
+            matrices.append(compact_matrix(thing.reshape(-1, order='F')))
+            sizes.append(row)
         elif 'matrix' in str(type(thing)):
             try:
                 row, col = thing.shape
                 if row != col:
                     raise Exception('matrix needs to be square.')
-                matrices.append(thing.reshape(-1).tolist()[0])
+                matrices.append(compact_matrix(thing.reshape(-1)))
                 sizes.append(row)
             except Exception as exc:
                 print 'Error found:', exc
@@ -107,10 +410,53 @@ def read_matrix(things, parser=None):
                     '(same chromosome and same bins).')
 
 
+def compact_matrix(matrix):
+    """
+    Store a flat Hi-C matrix into a contiguous numpy array of 32 bits integers
+    (using 4 bytes per cell, instead of about 30 for a tuple of Python
+    integers). Matrices with values not fitting in 32 bits are stored as 64
+    bits integers, and matrices with non-integer values as 64 bits floats.
+    Hi-C stores (:class:`pytadbit.parsers.hic_store.HiCStore`) are returned
+    unchanged, and scipy sparse matrices are wrapped into a
+    :class:`SparseHiC` without being expanded.
+
+    :param matrix: a flat Hi-C matrix (tuple, list, numpy array), a list of
+       lists, or a square scipy sparse matrix
+
+    :returns: a flat numpy array
+    """
+    if isinstance(matrix, (HiCStore, SparseHiC)):
+        return matrix
+    if issparse(matrix):
+        return SparseHiC(matrix)
+    matrix = np.asarray(matrix)
+    if matrix.dtype.kind in 'iub':
+        if matrix.size and (matrix.max() > INT32_MAX or
+                            matrix.min() < -INT32_MAX - 1):
+            return np.ascontiguousarray(matrix, dtype=np.int64).reshape(-1)
+        return np.ascontiguousarray(matrix, dtype=np.int32).reshape(-1)
+    return np.ascontiguousarray(matrix, dtype=float).reshape(-1)
+
+
 def __check_hic(hic, size):
     """
     check if hi-c data is symmetric
     """
+    if isinstance(hic, HiCStore):
+        # only the upper triangle is stored
+        return True
+    if isinstance(hic, SparseHiC):
+        if (hic.matrix != hic.matrix.T).nnz:
+            raise AttributeError('ERROR: matrix should be square.\n')
+        return True
+    if isinstance(hic, np.ndarray):
+        hic = hic.reshape(size, size)
+        # compare by blocks of rows to avoid a second matrix in memory
+        for beg in xrange(0, size, CHUNK_SIZE):
+            if not (hic[beg:beg + CHUNK_SIZE] ==
+                    hic[:, beg:beg + CHUNK_SIZE].T).all():
+                raise AttributeError('ERROR: matrix should be square.\n')
+        return True
     for i in xrange(size):
         for j in xrange(i + 1, size):
             if not hic[i * size + j] == hic[j * size + i]:
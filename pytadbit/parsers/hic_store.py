@@ -0,0 +1,195 @@
+"""
+18 Oct 2013
+
+Binary on-disk storage of Hi-C matrices.
+
+Only the upper triangle of the (symmetric) Hi-C matrix is stored, row after
+row, after a small header containing the number of bins, the resolution and
+the type of the values. Files are opened with :py:mod:`mmap`, so that only
+the regions of the matrix accessed are actually read from disk.
+"""
+
+from struct import pack, unpack, calcsize
+import numpy as np
+
+MAGIC  = 'TADBITHC'
+HEADER = '<8sqq4s4x'
+
+# number of rows expanded at once from the upper triangle
+ROWS_CHUNK = 512
+
+
+def write_hic_store(f_name, hic, size, resolution, dtype=np.int32):
+    """
+    Write a Hi-C matrix into a binary file that can be opened with
+    :func:`load_hic_store`.
+
+    :param f_name: path to the file to write
+    :param hic: a flat Hi-C matrix, as stored in Experiment.hic_data (i.e.: a
+       tuple or a numpy array of size*size values)
+    :param size: number of rows/columns of the matrix
+    :param resolution: resolution of the Hi-C data
+    :param numpy.int32 dtype: type of the values stored (e.g. numpy.int32,
+       numpy.int64 or numpy.float32)
+    """
+    dtype = np.dtype(dtype)
+    out = open(f_name, 'wb')
+    out.write(pack(HEADER, MAGIC, size, resolution, dtype.str[1:]))
+    for i in xrange(size):
+        # rows are equal to columns by symmetry
+        row = np.asarray(hic[i * size + i:(i + 1) * size], dtype=dtype)
+        out.write(row.astype(dtype.newbyteorder('<')).tostring())
+    out.close()
+
+
+def load_hic_store(f_name):
+    """
+    Open a Hi-C matrix stored with :func:`write_hic_store`.
+
+    :param f_name: path to the file
+
+    :returns: a :class:`HiCStore` object
+    """
+    return HiCStore(f_name)
+
+
+def is_hic_store(f_name):
+    """
+    :param f_name: path to a file
+
+    :returns: True if the file was written with :func:`write_hic_store`
+    """
+    try:
+        return open(f_name, 'rb').read(len(MAGIC)) == MAGIC
+    except IOError:
+        return False
+
+
+class HiCStore(object):
+    """
+    Read-only Hi-C matrix backed by a memory-mapped binary file (see
+    :func:`write_hic_store`).
+
+    It behaves like the flat matrices stored in Experiment.hic_data: the value
+    of the cell in row i and column j is obtained with hic[i * size + j], and
+    slices return numpy arrays.
+
+    :param f_name: path to the file
+
+    """
+    def __init__(self, f_name):
+        self.f_name = f_name
+        f_h = open(f_name, 'rb')
+        magic, size, resolution, dtype = unpack(
+            HEADER, f_h.read(calcsize(HEADER)))
+        f_h.close()
+        if magic != MAGIC:
+            raise IOError('ERROR: %s is not a Hi-C store file.\n' % f_name)
+        self.size       = int(size)
+        self.resolution = int(resolution)
+        self.dtype      = np.dtype('<' + dtype.strip('\x00'))
+        self.triangle   = np.memmap(f_name, dtype=self.dtype, mode='r',
+                                    offset=calcsize(HEADER),
+                                    shape=(self.size * (self.size + 1) / 2,))
+
+
+    def __repr__(self):
+        return 'HiCStore %s (size: %s, resolution: %s)' % (
+            self.f_name, self.size, self.resolution)
+
+
+    def __reduce__(self):
+        # only the path is pickled, data is mapped again when loaded
+        return (HiCStore, (self.f_name, ))
+
+
+    def __len__(self):
+        return self.size * self.size
+
+
+    def _index(self, i, j):
+        """
+        position of the cell (i, j) in the upper triangle
+        """
+        low  = np.minimum(i, j)
+        high = np.maximum(i, j)
+        return low * (2 * self.size - low + 1) / 2 + high - low
+
+
+    def __getitem__(self, k):
+        if isinstance(k, slice):
+            beg, end, step = k.indices(len(self))
+            if (beg, end, step) == (0, len(self), 1):
+                return self._full().reshape(-1)
+            if step != 1:
+                ks = np.arange(beg, end, step, dtype=np.int64)
+                return self.triangle[self._index(ks / self.size,
+                                                 ks % self.size)]
+            if end <= beg:
+                return np.zeros(0, dtype=self.dtype)
+            # contiguous cells are gathered row by row
+            first = beg / self.size
+            last  = (end - 1) / self.size + 1
+            rows = np.empty((last - first, self.size), dtype=self.dtype)
+            for i in xrange(first, last):
+                rows[i - first] = self.row(i)
+            off = first * self.size
+            return rows.reshape(-1)[beg - off:end - off]
+        if k < 0:
+            k += len(self)
+        if not 0 <= k < len(self):
+            raise IndexError('Hi-C store index out of range')
+        return self.triangle[self._index(k / self.size, k % self.size)]
+
+
+    def __iter__(self):
+        for i in xrange(self.size):
+            for val in self.row(i):
+                yield val
+
+
+    def __array__(self, dtype=None):
+        return np.asarray(self[:], dtype=dtype)
+
+
+    def row(self, i):
+        """
+        :param i: row number
+
+        :returns: a numpy array with the values of row i
+        """
+        beg = self._index(i, i)
+        before = self.triangle[self._index(np.arange(i), i)]
+        return np.concatenate((before, self.triangle[beg:beg + self.size - i]))
+
+
+    def row_sums(self):
+        """
+        :returns: a numpy array with the sum of each row (equal to the sum of
+           each column), computed in one pass over the upper triangle
+        """
+        acc = np.int64 if self.dtype.kind in 'iub' else np.float64
+        sums = np.zeros(self.size, dtype=acc)
+        for i in xrange(self.size):
+            beg = self._index(i, i)
+            row = self.triangle[beg:beg + self.size - i]
+            # row i from the diagonal, and column i above it
+            sums[i] += row.sum(dtype=acc)
+            sums[i + 1:] += row[1:]
+        return sums
+
+
+    def _full(self):
+        """
+        square matrix, expanded from the upper triangle by blocks of rows
+        """
+        size = self.size
+        full = np.empty((size, size), dtype=self.dtype)
+        for beg in xrange(0, size, ROWS_CHUNK):
+            end = min(beg + ROWS_CHUNK, size)
+            rows, cols = np.triu_indices(end - beg, m=size - beg)
+            vals = self.triangle[self._index(beg, beg):
+                                 self._index(beg, beg) + len(rows)]
+            full[rows + beg, cols + beg] = vals
+            full[cols + beg, rows + beg] = vals
+        return full
@@ -0,0 +1,127 @@
+"""
+18 Oct 2013
+
+Binning of mapped read pairs into Hi-C interaction matrices.
+"""
+
+from itertools                  import islice
+from scipy.sparse                import coo_matrix
+from pytadbit.parsers.hic_parser import _open_file
+import numpy as np
+
+# number of read pairs parsed at once
+PAIRS_CHUNK = 100000
+
+
+def bin_pairs(f_names, resolutions, columns=(0, 1, 2, 3), chr_sizes=None,
+              chunk_size=PAIRS_CHUNK):
+    """
+    Build Hi-C interaction matrices from files of mapped read pairs.
+
+    Files are read by chunks of lines, each chunk being binned at all the
+    requested resolutions at once. Counts are accumulated as sparse
+    matrices (one cell per pair of bins seen), and each dense matrix is
+    allocated only once, at its final size. Only pairs of reads mapped on the
+    same chromosome are used.
+
+    With the default value of columns, each line of the input files would
+    look like:
+
+    ::
+
+      chr2L	12100	chr2L	14350
+      chr2L	12210	chr2L	355432
+
+    :param f_names: path to a file (optionally gzipped), or list of paths
+    :param resolutions: an integer or a list of resolutions (in bases)
+    :param (0, 1, 2, 3) columns: position of the columns (counting from 0)
+       containing the chromosome name of the first read, its position, the
+       chromosome name of the second read, and its position
+    :param None chr_sizes: a dict with chromosome names as keys and their
+       length in bases as values. If given, matrices will be sized to the
+       full chromosomes, otherwise to the last bin with interactions
+    :param 100000 chunk_size: number of lines read at once
+
+    :returns: a dict with chromosome names as keys, and as values a dict
+       with resolutions as keys and flat Hi-C matrices (numpy arrays) as
+       values. These matrices can be passed directly as hic_data to
+       :class:`pytadbit.Experiment` or to
+       :func:`pytadbit.Chromosome.add_experiment`. E.g.:
+
+       ::
+
+         matrices = bin_pairs('reads.tsv.gz', [10000, 100000])
+         crm = Chromosome('chr2L')
+         crm.add_experiment('exp1', 100000,
+                            hic_data=matrices['chr2L'][100000])
+    """
+    if type(f_names) is str:
+        f_names = [f_names]
+    if type(resolutions) is int:
+        resolutions = [resolutions]
+    chr_sizes = chr_sizes or {}
+    counts = {}
+    for f_name in f_names:
+        f_h = _open_file(f_name)
+        while True:
+            lines = list(islice(f_h, chunk_size))
+            if not lines:
+                break
+            chunk = [line.split() for line in lines
+                     if not line.startswith('#') and line.strip()]
+            if chunk:
+                _bin_chunk(chunk, columns, resolutions, counts)
+        f_h.close()
+    matrices = {}
+    for crm in counts:
+        matrices[crm] = {}
+        for reso in counts[crm]:
+            size = counts[crm][reso].shape[0]
+            if crm in chr_sizes:
+                size = max(size, chr_sizes[crm] / reso + 1)
+            matrices[crm][reso] = _dense_matrix(counts[crm][reso], size)
+    return matrices
+
+
+def _bin_chunk(chunk, columns, resolutions, counts):
+    """
+    add the pairs of a chunk of lines to the counts (updated in place).
+    Counts are stored as sparse matrices holding the upper triangle, sized
+    to the last bin with interactions.
+    """
+    crm1, pos1, crm2, pos2 = [np.array([line[c] for line in chunk])
+                              for c in columns]
+    cis  = crm1 == crm2
+    crms = crm1[cis]
+    pos1 = pos1[cis].astype(np.int64)
+    pos2 = pos2[cis].astype(np.int64)
+    for crm in np.unique(crms):
+        here = crms == crm
+        for reso in resolutions:
+            bin1 = pos1[here] / reso
+            bin2 = pos2[here] / reso
+            low  = np.minimum(bin1, bin2)
+            high = np.maximum(bin1, bin2)
+            size = int(high.max()) + 1
+            # pairs falling in the same cell are summed by the conversion
+            new = coo_matrix((np.ones(len(low), dtype=np.int32),
+                              (low, high)), shape=(size, size)).tocsr()
+            old = counts.setdefault(str(crm), {}).get(reso)
+            if old is not None:
+                size = max(size, old.shape[0])
+                old.resize((size, size))
+                new.resize((size, size))
+                new = old + new
+            counts[str(crm)][reso] = new
+
+
+def _dense_matrix(counts, size):
+    """
+    flat symmetric int32 matrix of size*size cells from the sparse counts of
+    its upper triangle
+    """
+    counts = counts.tocoo()
+    matrix = np.zeros((size, size), dtype=np.int32)
+    matrix[counts.row, counts.col] = counts.data
+    matrix[counts.col, counts.row] = counts.data
+    return matrix.reshape(-1)
@@ -4,13 +4,23 @@
 
 """
 
-from os import path, listdir
-from pytadbit.parsers.hic_parser import read_matrix
+from os import path, listdir, rename, fdopen
+from tempfile import mkstemp
+from hashlib import sha1
+from sys import stderr
+from pytadbit.parsers.hic_parser import read_matrix, SparseHiC
+from pytadbit.parsers.hic_store  import HiCStore
+from pytadbit.utils.hic_normalization import NormalizedHiC
 from pytadbit.tadbit_py import _tadbit_wrapper
+from multiprocessing.pool import ThreadPool
+from multiprocessing import cpu_count
+import numpy as np
 
 
 def tadbit(x, n_cpus=1, verbose=True, max_tad_size="max",
-           no_heuristic=False, get_weights=False, use_visibility=False):
+           no_heuristic=False, get_weights=False, use_visibility=False,
+           window=None, overlap=None, boundaries=None, radius=2,
+           llik_cache=None, get_stats=False, progress=None):
     """
     The TADBit algorithm works on raw chromosome interaction count data.
     The normalization is neither necessary nor recommended,
@@ -29,15 +39,63 @@ def tadbit(x, n_cpus=1, verbose=True, max_tad_size="max",
     :param x: a square matrix of interaction counts in the HI-C data or a list
        of such matrices for replicated experiments. The counts must be evenly
        sampled and not normalized. x might be either a list of list, a path to
-       a file or a file handler
+       a file (optionally gzipped, with either the full matrix or the list
+       of interacting pairs), a file handler, a numpy array or a scipy sparse
+       matrix
     :param 1 n_cpus: The number of CPUs to allocate to TADBit. If
        n_cpus='max' the total number of CPUs will be used
     :param auto max_tad_size: an integer defining maximum size of TAD. Default
-       (auto) defines it as the number of rows/columns
+       (auto) defines it as the number of rows/columns. Only used with
+       no_heuristic, in which case memory usage is proportional to the number
+       of rows/columns times max_tad_size (instead of its square), plus the
+       number of rows/columns to the power 1.5 for the dynamic programming,
+       which allows to work on long chromosomes at high resolution. This does
+       not apply to the input: sparse matrices are still expanded to their
+       dense upper triangle (as int32), as the sums of the full rows are
+       needed to weight the cells. Use window to bound this memory too
     :param False no_heuristic: whether to use or not some heuristics
     :param False get_weights: either to return the weights corresponding to the
        Hi-C count (weights are a normalization dependent of the count of each
-       columns)
+       columns), as
+       :class:`pytadbit.utils.hic_normalization.NormalizedHiC` objects
+    :param None window: if given, and smaller than the number of rows/columns,
+       TADs are searched in overlapping windows of this number of bins, run
+       in parallel (n_cpus windows at once). Memory usage and running time
+       then grow linearly with the size of the matrix. Each window keeps the
+       boundaries found in its central part (up to the middle of the overlaps
+       with the neighboring windows). Windows with less than 6 rows/columns
+       with non-zero diagonal are skipped (no boundary is searched in their
+       central part)
+    :param None overlap: number of bins shared by consecutive windows (by
+       default a quarter of the window)
+    :param None boundaries: list of prior boundaries (the last bin of each
+       TAD), e.g. found at a coarser resolution. If given, the heuristic is
+       replaced by the computation of the likelihood of the TADs starting and
+       ending close to these boundaries only (and spanning at most two of the
+       intervals between them). A report of the number of likelihoods
+       computed is printed if verbose
+    :param 2 radius: bins closer than this number of bins to a prior boundary
+       are possible boundaries
+    :param None llik_cache: path to a directory where the log-likelihoods of
+       the TADs are stored between runs (one file per set of matrices). The
+       log-likelihoods already computed on the same matrices (with any other
+       parameter) are not computed again, and the result is the same as
+       without cache
+    :param False get_stats: if True, the result also contains, under the key
+       'stats', a dict of the wall times (in seconds) of the phases of the
+       computation ('input', 'weights', 'heuristic', 'likelihood' per AIC
+       cycle, 'dp' per number of breaks and 'total'), of the number of
+       likelihoods ('cells') 'computed' per cycle, taken from the cache
+       ('cached'), or left undefined ('skipped', by the heuristic or for
+       being too thin) out of the 'total', of the number of Newton-Raphson
+       iterations and of the utilization of the threads. In windowed mode,
+       the dict has a single key, 'windows', with the list of the dicts of
+       each window (None for skipped windows)
+    :param None progress: a function called with the name of the current
+       phase ('heuristic', 'likelihood' or 'confidence'), the work done and
+       the total work, every half second while computing likelihoods, and at
+       the end of each phase. It is called from the thread calling tadbit
+       (or running the window), and can use Python objects
 
     :returns: the :py:func:`list` of topologically associated domains'
        boundaries, and the corresponding list associated log likelihoods.
@@ -45,40 +103,251 @@ def tadbit(x, n_cpus=1, verbose=True, max_tad_size="max",
        weights.
     """
     nums, size = read_matrix(x)
+    prior = None if boundaries is None else _prior(boundaries, radius, size)
+    if window and window < size:
+        return _windowed_tadbit(nums, size, n_cpus, verbose, max_tad_size,
+                                no_heuristic, get_weights, use_visibility,
+                                window, overlap, prior, llik_cache,
+                                get_stats, progress)
+    # the C module reads tuples of integers or contiguous int32 buffers (the
+    # upper triangle of Hi-C stores and of sparse matrices is passed as is).
+    # Sparse matrices are expanded to a dense triangle of size*(size+1)/2
+    # values even if max_tad_size caps the band, as the C module reads whole
+    # rows (row sums, heuristic); only windows avoid this expansion
+    matrices = [num if type(num) is tuple else
+                np.ascontiguousarray(num.triangle, dtype=np.int32)
+                if isinstance(num, (HiCStore, SparseHiC)) else
+                np.ascontiguousarray(num, dtype=np.int32) for num in nums]
     n_cpus = n_cpus if n_cpus != 'max' else 0
-    max_tad_size = size if max_tad_size is "auto" else max_tad_size
-    _, nbks, passages, _, _, bkpts, weights = \
-       _tadbit_wrapper(nums,             # list of lists representing matrices
+    max_tad_size = size if max_tad_size in ("auto", "max") else max_tad_size
+    key, cache = _load_llik(llik_cache, matrices, size, use_visibility)
+    _, _, passages, llikmat, _, bkpts, rowsums, stats, kept = \
+       _tadbit_wrapper(matrices,         # list of lists representing matrices
                        size,             # size of one row/column
                        len(nums),        # number of matrices
                        n_cpus,      # number of threads
                        int(verbose),     # verbose 0/1
                        max_tad_size,     # max_tad_size
                        int(no_heuristic), # heuristic 0/1
-                       int(use_visibility) # TODO: remove this
+                       int(use_visibility), # TODO: remove this
+                       prior,            # prior boundaries
+                       cache,            # log-likelihoods of previous runs
+                       progress,         # progress callback
+                       int(get_weights)  # weights are returned only if asked
                        )
+    # log-likelihoods are returned for the rows/columns kept only
+    kept = len(kept) / np.dtype(np.intc).itemsize
+    _save_llik(llik_cache, key, cache, llikmat, kept)
 
-    breaks = [i for i in xrange(size) if bkpts[i + nbks * size] == 1]
-    scores = [p for p in passages if p > 0]
+    if verbose and prior is not None:
+        llikmat = np.frombuffer(llikmat)
+        band = len(llikmat) / kept
+        total = sum(min(band, j + 1) for j in xrange(kept))
+        computed = (~np.isnan(llikmat)).sum()
+        stderr.write('prior boundaries: %d log-likelihoods computed out of %d'
+                     ' (%.1f%% saved)\n' % (computed, total,
+                                            100 - 100. * computed / total))
 
+    # the C module returns raw arrays of C ints and doubles
+    breaks = np.flatnonzero(np.frombuffer(bkpts, dtype=np.intc)).tolist()
+    passages = np.frombuffer(passages, dtype=np.intc)
+    scores = passages[passages > 0].astype(float).tolist()
+
+    result = _tads_from_breaks(breaks, scores, size)
+    if get_stats:
+        result['stats'] = stats
+
+    if get_weights:
+        # the C module returns the sums of the rows, from which the weights
+        # are computed
+        rowsums = [np.frombuffer(rowsum, dtype=float) for rowsum in rowsums]
+        return result, _weights(nums, size, rowsums, use_visibility)
+    return result
+
+
+def _tads_from_breaks(breaks, scores, size):
+    """
+    TADs ending at each breakpoint, plus the last one.
+    """
     result = {'start': [], 'end'  : [], 'score': []}
     for brk in xrange(len(breaks)+1):
         result['start'].append((breaks[brk-1] + 1) if brk > 0 else 0)
         result['end'  ].append(breaks[brk] if brk < len(breaks) else size - 1)
         result['score'].append(scores[brk] if brk < len(breaks) else None)
+    return result
+
+
+def _prior(boundaries, radius, size):
+    """
+    Number (from 1) of the prior boundary close to each bin, 0 if none.
+    """
+    prior = np.zeros(size, dtype=np.int32)
+    for num, brk in enumerate(sorted(boundaries), 1):
+        prior[max(0, brk - radius):brk + radius + 1] = num
+    return prior
+
+
+def _load_llik(llik_cache, matrices, size, use_visibility):
+    """
+    Key of the matrices in the cache directory, and flat banded
+    log-likelihood matrix stored under this key (None if not found).
+    """
+    if llik_cache is None:
+        return None, None
+    # (bands of the rows/columns kept, caches of the bands of all the
+    # rows/columns have other keys)
+    key = sha1('kept %d %d' % (size, int(use_visibility)))
+    for num in matrices:
+        key.update(np.ascontiguousarray(num, dtype=np.int32))
+    key = key.hexdigest()
+    fnam = path.join(llik_cache, key + '.npy')
+    if not path.exists(fnam):
+        return key, None
+    return key, np.ascontiguousarray(np.load(fnam), dtype=float).ravel()
+
+
+def _save_llik(llik_cache, key, cache, llikmat, kept):
+    """
+    Store the log-likelihoods computed by the C module with the ones already
+    in the cache directory, as a (kept, band) array.
+
+    :param kept: number of rows/columns kept by the C module (with a non-zero
+       diagonal), the rows of the log-likelihood matrix
+    """
+    if llik_cache is None:
+        return
+    llikmat = np.frombuffer(llikmat).reshape(kept, -1)
+    if cache is not None:
+        cache = cache.reshape(kept, -1)
+        band = max(cache.shape[1], llikmat.shape[1])
+        new = np.empty((kept, band))
+        new.fill(np.nan)
+        new[:, :cache.shape[1]] = cache
+        # log-likelihoods of this run replace the ones of the cache
+        new[:, :llikmat.shape[1]] = np.where(
+            np.isnan(llikmat), new[:, :llikmat.shape[1]], llikmat)
+        llikmat = new
+    # written aside (in a file unique to this call, even across processes)
+    # and renamed, so that concurrent runs read whole files
+    fd, tmp = mkstemp(dir=llik_cache, prefix=key + '.', suffix='.tmp.npy')
+    out = fdopen(fd, 'wb')
+    np.save(out, llikmat)
+    out.close()
+    rename(tmp, path.join(llik_cache, key + '.npy'))
+
+
+def _window(num, size, beg, end):
+    """
+    Flat int32 copy of the square region [beg:end] of a flat Hi-C matrix.
+    """
+    if isinstance(num, np.ndarray):
+        sub = num.reshape(size, size)[beg:end, beg:end]
+    else:
+        sub = [np.asarray(num[i * size + beg:i * size + end])
+               for i in xrange(beg, end)]
+    return np.ascontiguousarray(sub, dtype=np.int32).ravel()
+
+
+def _windowed_tadbit(nums, size, n_cpus, verbose, max_tad_size, no_heuristic,
+                     get_weights, use_visibility, window, overlap, prior,
+                     llik_cache, get_stats, progress):
+    """
+    Run tadbit on overlapping windows of the matrices and stitch the results
+    (see :func:`tadbit`).
+    """
+    if overlap is None:
+        overlap = window / 4
+    if not 0 <= overlap < window:
+        raise ValueError('ERROR: overlap should be smaller than the window\n')
+    step = window - overlap
+    begs = range(0, max(size - overlap, 1), step)
+    # the last window ends at the end of the matrix
+    begs[-1] = max(size - window, 0)
+    ends = [min(beg + window, size) for beg in begs]
+    # boundaries are kept in the central part of each window
+    mids = [0] + [(begs[w + 1] + ends[w]) / 2 for w in xrange(len(begs) - 1)]
+    mids.append(size)
+    if max_tad_size in ("auto", "max"):
+        max_tad_size = window
+    # rows/columns with non-zero diagonal in all the matrices (the others are
+    # removed by the C module, which needs at least 6 of them)
+    keep = np.ones(size, dtype=bool)
+    for num in nums:
+        keep &= np.array([num[i * size + i] for i in xrange(size)]) >= 1
+
+    def call(w):
+        if keep[begs[w]:ends[w]].sum() < 6:
+            return np.zeros(0, dtype=int), np.zeros(0, dtype=np.intc), None
+        matrices = [_window(num, size, begs[w], ends[w]) for num in nums]
+        sub = None
+        if prior is not None and prior[begs[w]:ends[w]].any():
+            # prior boundaries of the window are numbered from 1
+            sub = prior[begs[w]:ends[w]].copy()
+            sub[sub > 0] -= sub[sub > 0].min() - 1
+        key, cache = _load_llik(llik_cache, matrices, ends[w] - begs[w],
+                                use_visibility)
+        _, _, passages, llikmat, _, bkpts, _, stats, kept = _tadbit_wrapper(
+            matrices, ends[w] - begs[w], len(matrices), 1, int(verbose),
+            min(max_tad_size, ends[w] - begs[w]), int(no_heuristic),
+            int(use_visibility), sub, cache, progress)
+        _save_llik(llik_cache, key, cache, llikmat,
+                   len(kept) / np.dtype(np.intc).itemsize)
+        passages = np.frombuffer(passages, dtype=np.intc)
+        breaks = np.flatnonzero(np.frombuffer(bkpts, dtype=np.intc))
+        mid = (breaks + begs[w] >= mids[w]) & (breaks + begs[w] < mids[w + 1])
+        return breaks[mid] + begs[w], passages[breaks[mid]], stats
+
+    n_cpus = cpu_count() if n_cpus == 'max' else n_cpus
+    pool = ThreadPool(max(1, min(n_cpus, len(begs))))
+    found = pool.map(call, range(len(begs)))
+    pool.close()
+    # boundaries found on both sides of the middle of an overlap that would
+    # make a TAD thinner than 3 bins are merged, keeping the best scored
+    breaks, scores = [], []
+    for brk, scr in zip(np.concatenate([brk for brk, _, _ in found]).tolist(),
+                        np.concatenate([scr for _, scr, _ in found]).tolist()):
+        if breaks and brk - breaks[-1] < 3:
+            if scr > scores[-1]:
+                breaks[-1], scores[-1] = brk, float(scr)
+            continue
+        breaks.append(brk)
+        scores.append(float(scr))
+    # the last row/column ends the last TAD
+    if breaks and breaks[-1] == size - 1:
+        breaks, scores = breaks[:-1], scores[:-1]
+    result = _tads_from_breaks(breaks, scores, size)
+    if get_stats:
+        result['stats'] = {'windows': [stats for _, _, stats in found]}
 
     if get_weights:
-        # in tadbit we are not using directly weights, but the
-        # multiplication by the real value
-        tadbit_weights = [[i/j if j else 0.0 for i, j in
-                           zip(nums[k], weights[k])] for k in xrange(len(nums))]
-        if use_visibility:
-            total = sum(nums[0])
-            tadbit_weights = [[t*total for t in tadbit_weights[0]]]
-        return result, tadbit_weights
+        rowsums = []
+        for num in nums[:1] if use_visibility else nums:
+            rowsums.append(np.array([
+                np.asarray(num[i * size:(i + 1) * size])[keep].sum()
+                for i in xrange(size)], dtype=float))
+            rowsums[-1][~keep] = 0
+        return result, _weights(nums, size, rowsums, use_visibility)
     return result
 
 
+def _weights(nums, size, rowsums, use_visibility):
+    """
+    Weights of the matrices, as normalized views of the Hi-C data. Weights are
+    the square root of the products of the sums of the rows (or the products
+    themselves divided by the total count with visibility, for the first
+    matrix only), computed on demand.
+
+    :param rowsums: sums of each row over the rows/columns kept by tadbit (0
+       for the others), per matrix
+    """
+    if use_visibility:
+        total = sum(np.asarray(nums[0][i * size:(i + 1) * size]).sum()
+                    for i in xrange(size))
+        return [NormalizedHiC(nums[0], rowsums[0] / np.sqrt(total), size)]
+    return [NormalizedHiC(num, np.sqrt(rowsum), size)
+            for num, rowsum in zip(nums, rowsums)]
+
+
 def batch_tadbit(directory, parser=None, **kwargs):
     """
     Use tadbit on directories of data files.
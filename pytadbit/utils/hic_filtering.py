@@ -30,7 +30,7 @@ def filter_by_zero_count(matrx, draw_hist=False):
     # get sum of columns
     cols = []
     for c in sorted(matrx, key=sum):
-        cols.append(len(c) - c.count(0))
+        cols.append(np.count_nonzero(c))
     cols = np.array(cols)
     if draw_hist:
         plt.figure(figsize=(9, 9))
@@ -102,17 +102,27 @@ def filter_by_zero_count(matrx, draw_hist=False):
     return bads
 
 
-def filter_by_mean(matrx, draw_hist=False):
+def _column_sums(matrx, sums):
+    """
+    sums of the columns of the matrix, unless already given
+    """
+    if sums is None:
+        return np.array([sum(c) for c in matrx])
+    return np.asarray(sums)
+
+
+def filter_by_mean(matrx, draw_hist=False, sums=None):
     """
     fits the distribution of Hi-C interaction count by column in the matrix to
     a polynomial. Then searches for the first possible 
+
+    :param None sums: sums of the columns of the matrix, if already known (the
+       matrix is then not read)
     """
     nbins = 100
     # get sum of columns
-    cols = []
-    for c in sorted(matrx, key=sum):
-        cols.append(sum(c))
-    cols = np.array(cols)
+    sums = _column_sums(matrx, sums)
+    cols = np.sort(sums)
     if draw_hist:
         plt.figure(figsize=(9, 9))
     median = np.median(cols)
@@ -123,7 +133,7 @@ def filter_by_mean(matrx, draw_hist=False):
     xmax = max(cols)
     y = np.linspace(xmin, xmax, nbins)
     hist = np.digitize(cols, y)
-    x = [sum(hist == i) for i in range(1, nbins + 1)]
+    x = [np.count_nonzero(hist == i) for i in range(1, nbins + 1)]
     if draw_hist:
         hist = plt.hist(cols, bins=100, alpha=.3, color='grey')
     xp = range(0, cols[-1])
@@ -136,7 +146,7 @@ def filter_by_mean(matrx, draw_hist=False):
             xmax = max(cols)
             y = np.linspace(xmin, xmax, nbins)
             hist = np.digitize(cols, y)
-            x = [sum(hist == i) for i in range(1, nbins + 1)]
+            x = [np.count_nonzero(hist == i) for i in range(1, nbins + 1)]
             if draw_hist:
                 plt.clf()
                 hist = plt.hist(cols, bins=100, alpha=.3, color='grey')
@@ -190,62 +200,66 @@ def filter_by_mean(matrx, draw_hist=False):
         plt.show()
     # label as bad the columns with sums lower than the root
     bads = {}
-    for i, col in enumerate(matrx):
-        if sum(col) < root:
+    for i, col in enumerate(sums):
+        if col < root:
             bads[i] = None
     # now stored in Experiment._zeros, used for getting more accurate z-scores
     return bads
 
 
-def filter_by_stdev(matrx):
-    means = [np.mean(c) for c in matrx]
+def filter_by_stdev(matrx, sums=None):
+    if sums is None:
+        means = [np.mean(c) for c in matrx]
+    else:
+        means = np.asarray(sums, dtype=float) / len(sums)
+    sums = _column_sums(matrx, sums)
     mean = np.mean(means)
     stde = np.std(means)
     root = mean - stde * 1.25
     # label as bad the columns with sums lower than the root
     bads = {}
-    for i, col in enumerate(matrx):
-        if sum(col) < root:
+    for i, col in enumerate(sums):
+        if col < root:
             bads[i] = None
     # now stored in Experiment._zeros, used for getting more accurate z-scores
     return bads
 
 
-def filter_by_mad(matrx):
+def filter_by_mad(matrx, sums=None):
     # get sum of columns
-    cols = []
-    for c in sorted(matrx, key=sum):
-        cols.append(sum(c))
-    cols = np.array(cols)
+    sums = _column_sums(matrx, sums)
+    cols = np.sort(sums)
     median = np.median(cols)
     mad = np.median([abs(median - c ) for c in cols])
     root = median - mad * 1.5
     # label as bad the columns with sums lower than the root
     bads = {}
-    for i, col in enumerate(matrx):
-        if sum(col) < root:
+    for i, col in enumerate(sums):
+        if col < root:
             bads[i] = None
     # now stored in Experiment._zeros, used for getting more accurate z-scores
     return bads
 
 
-def hic_filtering_for_modelling(matrx, method='mean'):
+def hic_filtering_for_modelling(matrx, method='mean', sums=None):
     """
     :param matrx: Hi-C matrix of a given experiment
     :param mean method: method to use for filtering Hi-C columns. Aims to
        remove columns with abnormally low count of interactions
+    :param None sums: sums of the columns of the matrix, if already known.
+       Methods 'mean', 'mad' and 'stdev' then do not read the matrix
 
     :returns: the indexes of the columns not to be considered for the
        calculation of the z-score
     """
     if method == 'mean':
-        bads = filter_by_mean(matrx, draw_hist=False)
+        bads = filter_by_mean(matrx, draw_hist=False, sums=sums)
     elif method == 'zeros':
         bads = filter_by_zero_count(matrx)
     elif method == 'mad':
-        bads = filter_by_mad(matrx)
+        bads = filter_by_mad(matrx, sums=sums)
     elif method == 'stdev':
-        bads = filter_by_stdev(matrx)
+        bads = filter_by_stdev(matrx, sums=sums)
     else:
         raise Exception
     return bads
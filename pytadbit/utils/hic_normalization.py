@@ -0,0 +1,255 @@
+"""
+18 Oct 2013
+
+Balancing of Hi-C matrices.
+
+Normalizations are stored as a vector of biases (one per bin), the normalized
+value of a cell being the raw count divided by the product of the biases of
+its row and of its column.
+"""
+
+from scipy.sparse import coo_matrix, diags, issparse
+from warnings     import warn
+import numpy as np
+
+# number of rows of a Hi-C matrix loaded at once
+ROWS_CHUNK = 512
+
+
+def hic_to_sparse(hic, size, band=None, forbidden=None):
+    """
+    Convert a flat Hi-C matrix into a scipy sparse matrix. Rows are read by
+    blocks, so that Hi-C stores
+    (:class:`pytadbit.parsers.hic_store.HiCStore`) are never fully loaded.
+
+    :param hic: a flat Hi-C matrix (tuple, numpy array or HiCStore)
+    :param size: number of rows/columns of the matrix
+    :param None band: if given, only the cells closer than this number of
+       bins to the diagonal are kept
+    :param None forbidden: list of rows/columns to be set to zero
+
+    :returns: a scipy.sparse.csr_matrix
+    """
+    rows, cols, vals = [], [], []
+    for beg in xrange(0, size, ROWS_CHUNK):
+        end = min(beg + ROWS_CHUNK, size)
+        block = np.asarray(hic[beg * size:end * size]).reshape(-1, size)
+        row, col = np.nonzero(block)
+        row += beg
+        if band:
+            near = np.abs(row - col) < band
+            row, col = row[near], col[near]
+        rows.append(row)
+        cols.append(col)
+        vals.append(block[row - beg, col])
+    matrix = coo_matrix((np.concatenate(vals).astype(float),
+                         (np.concatenate(rows), np.concatenate(cols))),
+                        shape=(size, size)).tocsr()
+    if forbidden is not None and len(forbidden):
+        keep = np.ones(size)
+        keep[list(forbidden)] = 0
+        keep = diags(keep, 0)
+        matrix = keep * matrix * keep
+    return matrix
+
+
+def iterative_correction(matrix, tol=1e-5, max_iter=200):
+    """
+    Balance a Hi-C matrix by iterative correction (ICE), as described in
+    Imakaev et al. 2012 (Nature Methods).
+
+    :param matrix: symmetric Hi-C matrix, either a numpy array or a scipy
+       sparse matrix
+    :param 1e-5 tol: maximum relative deviation of the sums of the rows of the
+       balanced matrix
+    :param 200 max_iter: maximum number of iterations
+
+    :returns: a numpy array with the biases of each row/column. Rows without
+       interactions have a bias of 0
+    """
+    size = matrix.shape[0]
+    keep = np.asarray(matrix.sum(axis=1)).ravel() > 0
+    bias = keep.astype(float)
+    inv  = np.zeros(size)
+    for _ in xrange(max_iter):
+        inv[keep] = 1. / bias[keep]
+        # sums of the rows of the matrix balanced with the current biases
+        sums = inv * matrix.dot(inv)
+        sums = sums[keep] / sums[keep].mean()
+        bias[keep] *= sums
+        if np.abs(sums - 1).max() < tol:
+            break
+    else:
+        warn('WARNING: iterative correction did not converge after %d '
+             'iterations\n' % max_iter)
+    return _scale_bias(matrix, bias)
+
+
+def knight_ruiz(matrix, tol=1e-6, max_iter=100, delta=0.1, Delta=3):
+    """
+    Balance a Hi-C matrix with the algorithm of Knight and Ruiz 2013 (IMA
+    Journal of Numerical Analysis), an inexact Newton method converging much
+    faster than iterative correction.
+
+    :param matrix: symmetric Hi-C matrix, either a numpy array or a scipy
+       sparse matrix
+    :param 1e-6 tol: tolerance on the sums of the rows of the balanced
+       matrix
+    :param 100 max_iter: maximum number of Newton iterations
+    :param 0.1 delta: how close to the boundary of the positive cone the
+       iterates may get
+    :param 3 Delta: how far from the boundary of the positive cone the
+       iterates may get
+
+    :returns: a numpy array with the biases of each row/column. Rows without
+       interactions have a bias of 0
+    """
+    keep = np.where(np.asarray(matrix.sum(axis=1)).ravel() > 0)[0]
+    if issparse(matrix):
+        sub = matrix.tocsr()[keep][:, keep]
+    else:
+        sub = matrix[np.ix_(keep, keep)]
+    ones     = np.ones(len(keep))
+    g        = 0.9
+    etamax   = eta = 0.1
+    stop_tol = tol * 0.5
+    x        = ones.copy()
+    rt       = tol ** 2
+    v        = x * sub.dot(x)
+    rk       = 1 - v
+    rho_km1  = rk.dot(rk)
+    rout     = rold = rho_km1
+    for _ in xrange(max_iter):
+        if rout <= rt:
+            break
+        # inner conjugate gradient iterations
+        k = 0
+        y = ones.copy()
+        innertol = max(eta ** 2 * rout, rt)
+        while rho_km1 > innertol:
+            k += 1
+            if k == 1:
+                z = rk / v
+                p = z
+                rho_km1 = rk.dot(z)
+            else:
+                p = z + rho_km1 / rho_km2 * p
+            w = x * sub.dot(x * p) + v * p
+            alpha = rho_km1 / p.dot(w)
+            ap = alpha * p
+            ynew = y + ap
+            if ynew.min() <= delta:
+                neg = ap < 0
+                y += min((delta - y[neg]) / ap[neg]) * ap
+                break
+            if ynew.max() >= Delta:
+                big = ynew > Delta
+                y += min((Delta - y[big]) / ap[big]) * ap
+                break
+            y = ynew
+            rk = rk - alpha * w
+            rho_km2 = rho_km1
+            z = rk / v
+            rho_km1 = rk.dot(z)
+        x *= y
+        v = x * sub.dot(x)
+        rk = 1 - v
+        rho_km1 = rk.dot(rk)
+        rout = rho_km1
+        rat = rout / rold
+        rold = rout
+        eta_o = eta
+        eta = g * rat
+        if g * eta_o ** 2 > 0.1:
+            eta = max(eta, g * eta_o ** 2)
+        eta = max(min(eta, etamax), stop_tol / np.sqrt(rout))
+    else:
+        if rout > rt:
+            warn('WARNING: Knight-Ruiz balancing did not converge after %d '
+                 'iterations\n' % max_iter)
+    bias = np.zeros(matrix.shape[0])
+    bias[keep] = 1. / x
+    return _scale_bias(matrix, bias)
+
+
+def _scale_bias(matrix, bias):
+    """
+    scale biases so that the rows of the balanced matrix sum, in average, as
+    the rows of the raw matrix.
+    """
+    keep = bias > 0
+    inv  = np.zeros(len(bias))
+    inv[keep] = 1. / bias[keep]
+    balanced = (inv * matrix.dot(inv))[keep].mean()
+    raw      = np.asarray(matrix.sum(axis=1)).ravel()[keep].mean()
+    return bias * np.sqrt(balanced / raw)
+
+
+class NormalizedHiC(object):
+    """
+    Normalized view of a flat Hi-C matrix. Values are computed when accessed,
+    by dividing the raw counts by the biases of the corresponding row and
+    column, so that only a vector of biases is stored in addition to the Hi-C
+    data.
+
+    It behaves like the flat matrices stored in Experiment.hic_data: the value
+    of the cell in row i and column j is obtained with norm[i * size + j], and
+    slices return numpy arrays. Cells of rows or columns with a bias of 0 are
+    equal to 0.
+
+    :param hic: a flat Hi-C matrix (tuple, numpy array or
+       :class:`pytadbit.parsers.hic_store.HiCStore`)
+    :param bias: list of biases, one per row/column
+    :param size: number of rows/columns of the matrix
+
+    """
+    def __init__(self, hic, bias, size):
+        self.hic  = hic
+        self.bias = np.asarray(bias, dtype=float)
+        self.size = size
+
+
+    def __repr__(self):
+        return 'NormalizedHiC (size: %s)' % (self.size)
+
+
+    def __len__(self):
+        return self.size * self.size
+
+
+    def __getitem__(self, k):
+        if isinstance(k, slice):
+            ks = np.arange(*k.indices(len(self)), dtype=np.int64)
+            den = self.bias[ks / self.size] * self.bias[ks % self.size]
+            vals = np.zeros(len(ks))
+            good = den != 0
+            vals[good] = np.asarray(self.hic[k], dtype=float)[good] / den[good]
+            return vals
+        if k < 0:
+            k += len(self)
+        if not 0 <= k < len(self):
+            raise IndexError('normalized Hi-C index out of range')
+        den = self.bias[k / self.size] * self.bias[k % self.size]
+        return self.hic[k] / den if den else 0.
+
+
+    def __iter__(self):
+        for i in xrange(self.size):
+            for val in self[i * self.size:(i + 1) * self.size]:
+                yield val
+
+
+    def __array__(self, dtype=None):
+        return np.asarray(self[:], dtype=dtype)
+
+
+    def __eq__(self, other):
+        try:
+            return len(self) == len(other) and all(
+                (self[:] == np.asarray(other, dtype=float)).tolist())
+        except TypeError:
+            return False
+
+
+    def __ne__(self, other):
+        return not self == other
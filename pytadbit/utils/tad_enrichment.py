@@ -0,0 +1,212 @@
+"""
+18 Oct 2013
+
+Enrichment of genomic features (genes, peaks, clusters of elements...) at
+TAD boundaries, and along TADs, with its significance estimated against
+randomized features.
+"""
+
+from pytadbit.experiment import Experiment
+from multiprocessing     import Pool, cpu_count
+import numpy as np
+
+# TADs and features of the running boundary_enrichment, read by the forked
+# worker processes instead of being pickled for each batch of randomizations.
+_NULL = {}
+
+
+def tad_positions(xpr, bins=20, experiment=None, min_score=0,
+                  max_tad_size=None):
+    """
+    Genomic positions of equally spaced points along each TAD, from its
+    start to its end.
+
+    :param xpr: :class:`pytadbit.Experiment` (or
+       :class:`pytadbit.Chromosome`) with TADs
+    :param 20 bins: number of points per TAD
+    :param None experiment: name of the experiment, if xpr is a Chromosome
+       (by default its first experiment)
+    :param 0 min_score: only TADs with a boundary score (at their end) of at
+       least this value are used
+    :param None max_tad_size: only TADs of at most this size (in bases) are
+       used
+
+    :returns: a numpy array of bins rows, each one holding the positions of
+       the corresponding point in every TAD (sorted)
+    """
+    starts, ends = _tads(_get_experiment(xpr, experiment), min_score)
+    if max_tad_size is not None:
+        keep = ends - starts <= max_tad_size
+        starts, ends = starts[keep], ends[keep]
+    steps = np.linspace(0, 1, bins)
+    return starts + np.outer(steps, ends - starts)
+
+
+def tad_boundaries(xpr, experiment=None, min_score=0):
+    """
+    Genomic positions of the boundaries between consecutive TADs.
+
+    :param xpr: :class:`pytadbit.Experiment` (or
+       :class:`pytadbit.Chromosome`) with TADs
+    :param None experiment: name of the experiment, if xpr is a Chromosome
+       (by default its first experiment)
+    :param 0 min_score: only boundaries with at least this score are used
+
+    :returns: a sorted numpy array of positions
+    """
+    xpr = _get_experiment(xpr, experiment)
+    _, ends = _tads(xpr, min_score)
+    # the end of the last TAD is the end of the chromosome
+    return ends[ends < xpr.size * xpr.resolution]
+
+
+def count_hits(positions, features):
+    """
+    Count the features containing at least one position.
+
+    :param positions: sorted numpy array of genomic positions, or list of
+       such arrays
+    :param features: numpy array of the start and end positions of the
+       features (2 columns), or 3D array with one such array per set of
+       features. A position hits a feature if strictly between its start and
+       end.
+
+    :returns: the number of features hit, per array of positions (and per
+       set of features, as rows)
+    """
+    if np.ndim(positions[0]) == 0:
+        positions = [positions]
+    features  = np.asarray(features, dtype=float)
+    counts = [(np.searchsorted(pos, features[..., 1], side='left') >
+               np.searchsorted(pos, features[..., 0], side='right')).sum(-1)
+              for pos in positions]
+    return np.array(counts).T
+
+
+def boundary_enrichment(xpr, features, experiment=None, bins=20, min_score=0,
+                        max_tad_size=None, n_rand=1000, method='rotate',
+                        batch=100, n_cpus=1, seed=1):
+    """
+    Count the features crossed by TAD boundaries, and the features crossed
+    by each point of the TADs (as the profile of the features along TADs,
+    e.g. to find whether TAD boundaries break clusters of colocalizing
+    elements). These counts are compared to the counts of randomized
+    features:
+
+     - 'rotate': the features are all shifted by the same random offset
+       along the chromosome (wrapping around its end), keeping their
+       relative positions.
+     - 'shuffle': each feature is moved to a random position, keeping its
+       length.
+
+    :param xpr: :class:`pytadbit.Experiment` (or
+       :class:`pytadbit.Chromosome`) with TADs
+    :param features: list of (start, end) genomic positions of the features
+    :param None experiment: name of the experiment, if xpr is a Chromosome
+       (by default its first experiment)
+    :param 20 bins: number of points per TAD for the profile
+    :param 0 min_score: only boundaries with at least this score (and TADs
+       ending by them) are used
+    :param None max_tad_size: only TADs of at most this size (in bases) are
+       used for the profile
+    :param 1000 n_rand: number of randomizations
+    :param 'rotate' method: randomization of the features, 'rotate' or
+       'shuffle'
+    :param 100 batch: number of randomizations evaluated at once
+    :param 1 n_cpus: number of processes evaluating batches of randomizations
+       (if 'max', the total number of CPUs). The results do not depend on
+       it.
+    :param 1 seed: seed of the random generator
+
+    :returns: a dict with the observed 'boundary' count and 'profile' (one
+       count per point along TADs), their mean under randomization
+       ('boundary_exp' and 'profile_exp'), and the p-values of observing as
+       many hits ('boundary_pval_high', 'profile_pval_high') or as few
+       ('boundary_pval_low', 'profile_pval_low')
+    """
+    global _NULL
+    if method not in ('rotate', 'shuffle'):
+        raise NotImplementedError('ERROR: method should be "rotate" or ' +
+                                  '"shuffle"\n')
+    xpr = _get_experiment(xpr, experiment)
+    features = np.asarray(features, dtype=float).reshape(-1, 2)
+    positions = ([tad_boundaries(xpr, min_score=min_score)] +
+                 list(tad_positions(xpr, bins=bins, min_score=min_score,
+                                    max_tad_size=max_tad_size)))
+    observed = count_hits(positions, features)
+    _NULL = {'positions': positions,
+             'features' : features,
+             'length'   : float(xpr.size * xpr.resolution),
+             'method'   : method}
+    # one seed per batch, so that results do not depend on n_cpus
+    jobs = [(seed + i, min(batch, n_rand - i * batch))
+            for i in xrange((n_rand + batch - 1) / batch)]
+    n_cpus = cpu_count() if n_cpus == 'max' else n_cpus
+    pool = None
+    try:
+        if n_cpus > 1 and len(jobs) > 1:
+            pool = Pool(min(n_cpus, len(jobs)))
+            null = pool.map(_null_batch, jobs, chunksize=1)
+        else:
+            null = [_null_batch(job) for job in jobs]
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+        _NULL = {}
+    null = np.vstack(null) if null else np.zeros((0, len(positions)))
+    expected = null.mean(0) if n_rand else [None] * len(positions)
+    pval_high = ((null >= observed).sum(0) + 1.) / (n_rand + 1)
+    pval_low  = ((null <= observed).sum(0) + 1.) / (n_rand + 1)
+    return {'boundary'          : int(observed[0]),
+            'boundary_exp'      : expected[0],
+            'boundary_pval_high': pval_high[0],
+            'boundary_pval_low' : pval_low[0],
+            'profile'           : observed[1:].tolist(),
+            'profile_exp'       : list(expected[1:]),
+            'profile_pval_high' : pval_high[1:].tolist(),
+            'profile_pval_low'  : pval_low[1:].tolist()}
+
+
+def _null_batch(args):
+    """
+    Counts of hits of a batch of randomized features (one row per
+    randomization).
+    """
+    seed, n_rand = args
+    features = _NULL['features']
+    length   = _NULL['length']
+    rnd = np.random.RandomState(seed)
+    if _NULL['method'] == 'rotate':
+        starts = (features[:, 0] +
+                  rnd.uniform(0, length, (n_rand, 1))) % length
+    else:
+        starts = rnd.uniform(0, length, (n_rand, len(features)))
+    ends = starts + (features[:, 1] - features[:, 0])
+    return count_hits(_NULL['positions'], np.dstack((starts, ends)))
+
+
+def _get_experiment(xpr, experiment):
+    """
+    Experiment object from an Experiment, or from a Chromosome and a name.
+    """
+    if isinstance(xpr, Experiment):
+        return xpr
+    if experiment is None:
+        return xpr.experiments[0]
+    return xpr.get_experiment(experiment)
+
+
+def _tads(xpr, min_score):
+    """
+    Start and end genomic positions of the TADs, sorted by start.
+    """
+    if not xpr.tads:
+        raise Exception('ERROR: no TADs defined in experiment %s\n' %
+                        xpr.name)
+    tads = sorted([xpr.tads[k] for k in xpr.tads
+                   if min_score <= 0 or (xpr.tads[k]['score'] or 0) >=
+                   min_score], key=lambda t: t['start'])
+    starts = np.array([t['start'] for t in tads], dtype=float)
+    ends   = np.array([t['end'] + 1 for t in tads], dtype=float)
+    return starts * xpr.resolution, ends * xpr.resolution
@@ -0,0 +1,125 @@
+"""
+18 Oct 2013
+
+Interval index of the TADs of several experiments.
+"""
+
+from collections import OrderedDict
+import numpy as np
+
+
+class TADIndex(object):
+    """
+    Index of the TADs of a list of experiments, to find the TADs containing
+    genomic positions, the TADs overlapping regions and the closest TAD
+    boundaries, by binary search (in O(log n) for n TADs per experiment).
+
+    Positions are genomic coordinates in bases: the TAD starting at bin s and
+    ending at bin e of an experiment at resolution r covers [s*r, (e+1)*r),
+    and its boundary is at (e+1)*r. The TADs of each experiment are assumed
+    not to overlap (as the TADs found by :func:`pytadbit.tadbit.tadbit`).
+
+    Queries accept a single position (the results are TAD numbers, as in
+    Experiment.tads, or None) or an array of positions (the results are
+    arrays, with 0 instead of None).
+
+    :param experiments: list of :class:`pytadbit.Experiment` objects
+
+    """
+    def __init__(self, experiments):
+        self._tads = OrderedDict()
+        for xpr in experiments:
+            if not xpr.tads:
+                continue
+            keys = sorted(xpr.tads, key=lambda k: xpr.tads[k]['start'])
+            self._tads[xpr.name] = (
+                np.array(keys),
+                np.array([xpr.tads[k]['start'] for k in keys]) *
+                xpr.resolution,
+                (np.array([xpr.tads[k]['end'] for k in keys]) + 1) *
+                xpr.resolution)
+
+
+    def __repr__(self):
+        return 'TADIndex (%s)' % ', '.join(
+            ['%s: %d TADs' % (name, len(self._tads[name][0]))
+             for name in self._tads])
+
+
+    def __contains__(self, name):
+        return name in self._tads
+
+
+    def _select(self, experiments):
+        if experiments is None:
+            return self._tads.keys()
+        return [name for name in experiments if name in self._tads]
+
+
+    def tad_at(self, pos, experiments=None):
+        """
+        :param pos: genomic position (or array of positions)
+        :param None experiments: names of the experiments to search (all by
+           default)
+
+        :returns: a dict with, for each experiment, the number of the TAD
+           containing pos
+        """
+        scalar = np.isscalar(pos)
+        pos = np.asarray(pos)
+        found = {}
+        for name in self._select(experiments):
+            keys, starts, ends = self._tads[name]
+            idx = np.searchsorted(starts, pos, side='right') - 1
+            inside = (idx >= 0) & (pos < ends[idx.clip(0)])
+            tads = np.where(inside, keys[idx.clip(0)], 0)
+            found[name] = (int(tads) or None) if scalar else tads
+        return found
+
+
+    def overlapping(self, beg, end, experiments=None):
+        """
+        :param beg: start of the region (genomic position)
+        :param end: end of the region (excluded)
+        :param None experiments: names of the experiments to search (all by
+           default)
+
+        :returns: a dict with, for each experiment, the list of the numbers
+           of the TADs overlapping the region, sorted by position
+        """
+        found = {}
+        for name in self._select(experiments):
+            keys, starts, ends = self._tads[name]
+            first = np.searchsorted(ends, beg, side='right')
+            last  = np.searchsorted(starts, end, side='left')
+            found[name] = keys[first:last].tolist()
+        return found
+
+
+    def nearest_boundary(self, pos, experiments=None):
+        """
+        :param pos: genomic position (or array of positions)
+        :param None experiments: names of the experiments to search (all by
+           default)
+
+        :returns: a dict with, for each experiment, the number of the TAD
+           with the closest boundary to pos, and the distance from this
+           boundary to pos (negative if pos is upstream)
+        """
+        scalar = np.isscalar(pos)
+        pos = np.asarray(pos)
+        found = {}
+        for name in self._select(experiments):
+            keys, _, ends = self._tads[name]
+            idx = np.searchsorted(ends, pos).clip(1, len(ends) - 1)
+            if len(ends) == 1:
+                idx = np.zeros_like(idx)
+            else:
+                # closest of the boundaries around pos
+                idx = np.where(pos - ends[idx - 1] <= ends[idx] - pos,
+                               idx - 1, idx)
+            if scalar:
+                found[name] = (int(keys[idx]), int(pos - ends[idx]))
+            else:
+                found[name] = (keys[idx], pos - ends[idx])
+        return found
@@ -8,6 +8,7 @@ from bisect   import bisect_left
 from itertools import combinations
 from pytadbit.eqv_rms_drms import rmsdRMSD_wrapper
 from math     import log10
+from collections import Mapping
 import numpy as np
 
 
@@ -53,22 +54,222 @@ def zscore(values, size):
           ___/_________________________________
             /
 
+    Replace the values by the z-score of their log10. Null values are given
+    the log10 of half the smallest non-null value (halved as integers if the
+    values are integers), and negative ones -99. Values equal to the position
+    of a cell of the diagonal in the flat matrix (i + size * i) are also
+    given the log10 of this minimum.
+
+    :param values: list or numpy array of values (modified in place), should
+       not contain the diagonal of the Hi-C matrix
+    :param size: number of rows/columns of the Hi-C matrix
+    """
+    zsc = _zscore(np.asarray(values), size)
+    values[:] = zsc if isinstance(values, np.ndarray) else zsc.tolist()
+
+
+def _zscore(vals, size):
+    """
+    z-scores of a numpy array of values (see :func:`zscore`), as a new array
+    of floats
+    """
+    return _zscore_chunk(vals, size, *_zscore_stats([vals], size))
+
+
+def _null_values(vals, size):
+    """
+    values given the log10 of the minimum (null values and values equal to the
+    position of a cell of the diagonal)
     """
     # do not take into account the diagonal
-    nop = dict([(i + size * i,  None) for i in xrange(size)])
-    minv = min([v for v in values if v]) / 2
-    # get the log10 of values
-    vals = [log10(v) if v > 0 and not v in nop else log10(minv) for v in values]
-    mean_v = np.mean(vals)
-    std_v = np.std(vals)
-    # replace values by z-score
-    for i in xrange(len(values)):
-        if values[i] > 0:
-            values[i] = (vals[i] - mean_v) / std_v
-        elif values[i] == 0:
-            values[i] = (log10(minv) - mean_v) / std_v
-        else:
-            values[i] = -99
+    nop = ((vals % (size + 1) == 0) & (vals >= 0) &
+           (vals <= (size - 1) * (size + 1)))
+    return (vals <= 0) | nop
+
+
+def _zscore_stats(chunks, size):
+    """
+    minimum given to null values, mean and standard deviation of the log10 of
+    the values of a list (or generator) of numpy arrays, NaN being skipped.
+    Chunks are read once, so that the z-scores of a large matrix can be
+    computed chunk by chunk (see :func:`_zscore_chunk`).
+    """
+    minv = None
+    count = nlogs = 0
+    sum_v = sum_v2 = 0.
+    for vals in chunks:
+        vals = vals[~np.isnan(vals)]
+        count += len(vals)
+        if np.any(vals != 0):
+            lowest = vals[vals != 0].min()
+            minv = lowest if minv is None else min(minv, lowest)
+        logs = np.log10(vals[~_null_values(vals, size)])
+        nlogs += len(logs)
+        sum_v += logs.sum()
+        sum_v2 += (logs ** 2).sum()
+    if minv is None:
+        raise ValueError('ERROR: no non-null value to compute z-scores')
+    minv = minv / 2
+    # null values are given the log10 of half the minimum
+    nulls = count - nlogs
+    sum_v += nulls * log10(minv)
+    sum_v2 += nulls * log10(minv) ** 2
+    mean_v = sum_v / count
+    std_v = (max(sum_v2 / count - mean_v ** 2, 0)) ** 0.5
+    return minv, mean_v, std_v
+
+
+def _zscore_chunk(vals, size, minv, mean_v, std_v):
+    """
+    z-scores of a numpy array of values, given the minimum, mean and standard
+    deviation computed by :func:`_zscore_stats` over all the values. NaN are
+    kept.
+    """
+    zsc = np.empty(len(vals))
+    zsc.fill(np.nan)
+    kept = ~np.isnan(vals)
+    vals = vals[kept]
+    scores = np.empty(len(vals))
+    scores.fill((log10(minv) - mean_v) / std_v)
+    pos = ~_null_values(vals, size)
+    scores[pos] = (np.log10(vals[pos]) - mean_v) / std_v
+    scores[vals < 0] = -99
+    zsc[kept] = scores
+    return zsc
+
+
+class ZScores(Mapping):
+    """
+    Z-scores of the interactions between the rows/columns of a Hi-C matrix,
+    as computed by :func:`pytadbit.Experiment.get_hic_zscores`.
+
+    Values are stored in a flat float32 array containing the upper triangle
+    of the matrix (without diagonal) restricted to the bins kept, with NaN for
+    missing values. For compatibility, it can also be read as a dictionary of
+    dictionaries, with bin numbers as strings for keys (i.e.:
+    zscores['3']['10']). Only the upper triangle is available this way.
+
+    :param triangle: flat array with the upper triangle of the matrix of the
+       bins kept, row after row
+    :param bins: list of the bins kept (rows/columns not filtered)
+    :param size: number of rows/columns of the full Hi-C matrix
+
+    """
+    def __init__(self, triangle, bins, size):
+        self.triangle = np.asarray(triangle, dtype=np.float32)
+        self.bins     = np.asarray(bins, dtype=int)
+        self.size     = size
+        self.index    = np.empty(size, dtype=int)
+        self.index.fill(-1)
+        self.index[self.bins] = np.arange(len(self.bins))
+        nbins = len(self.bins)
+        self.starts = np.array([a * (2 * nbins - a - 1) / 2
+                                for a in xrange(nbins)], dtype=int)
+        # rows without any value are not listed, as in a dictionary
+        self._counts = np.array([np.count_nonzero(~np.isnan(self._row(a)))
+                                 for a in xrange(nbins)], dtype=int)
+
+
+    def __repr__(self):
+        return 'ZScores (size: %s, bins kept: %s)' % (self.size,
+                                                      len(self.bins))
+
+
+    def _row(self, a):
+        """
+        values of the row of the a-th bin kept (columns of bins after it)
+        """
+        return self.triangle[self.starts[a]:
+                             self.starts[a] + len(self.bins) - a - 1]
+
+
+    def _position(self, i):
+        """
+        position of a bin in the list of bins kept, -1 if not kept
+        """
+        try:
+            i = int(i)
+        except (TypeError, ValueError):
+            return -1
+        if not 0 <= i < self.size:
+            return -1
+        return self.index[i]
+
+
+    def __getitem__(self, i):
+        a = self._position(i)
+        if a < 0 or not self._counts[a]:
+            raise KeyError(i)
+        return _ZScoresRow(self, a)
+
+
+    def __iter__(self):
+        for i in self.bins[self._counts > 0]:
+            yield str(i)
+
+
+    def __len__(self):
+        return np.count_nonzero(self._counts)
+
+
+    def row(self, i):
+        """
+        :param i: row number
+
+        :returns: a numpy array with the z-scores of row i, NaN for missing
+           values (including the diagonal and the lower triangle)
+        """
+        vals = np.empty(self.size, dtype=np.float32)
+        vals.fill(np.nan)
+        a = self.index[i]
+        if a >= 0:
+            vals[self.bins[a + 1:]] = self._row(a)
+        return vals
+
+
+    def get_matrix(self):
+        """
+        :returns: a square numpy array with the z-scores of the full Hi-C
+           matrix (NaN for missing values and filtered rows/columns). The
+           matrix is symmetric
+        """
+        matrix = np.empty((self.size, self.size))
+        matrix.fill(np.nan)
+        for a, i in enumerate(self.bins):
+            row = self._row(a)
+            matrix[i, self.bins[a + 1:]] = row
+            matrix[self.bins[a + 1:], i] = row
+        return matrix
+
+
+class _ZScoresRow(Mapping):
+    """
+    z-scores of one row of a :class:`ZScores` object, read as a dictionary
+    """
+    def __init__(self, zscores, a):
+        self.zscores = zscores
+        self.a       = a
+        self.zsc     = zscores._row(a)
+        self.cols    = zscores.bins[a + 1:]
+
+
+    def __getitem__(self, j):
+        b = self.zscores._position(j)
+        if b <= self.a:
+            raise KeyError(j)
+        val = self.zsc[b - self.a - 1]
+        if np.isnan(val):
+            raise KeyError(j)
+        return float(val)
+
+
+    def __iter__(self):
+        for j in self.cols[~np.isnan(self.zsc)]:
+            yield str(j)
+
+
+    def __len__(self):
+        return np.count_nonzero(~np.isnan(self.zsc))
 
 
 def calc_consistency(models, nloci, dcutoff=200):
@@ -6,6 +6,7 @@ Sample script to infer bias toward TAD boundaries
 """
 
 from pytadbit import Chromosome
+from pytadbit.utils.tad_enrichment import boundary_enrichment
 from scipy.cluster.hierarchy import linkage
 from scipy.cluster.hierarchy import fcluster
 from matplotlib import pyplot as plt
@@ -13,45 +14,30 @@ from matplotlib import pyplot as plt
 PATH =  'sample_data/'
 
 
-def tad_breaker(tads, cluster, resolution, bins=20, show_plot=False,
-                title=None, max_tad_size=3000000):
+def tad_breaker(exp, cluster, bins=20, show_plot=False,
+                title=None, max_tad_size=3000000, n_rand=1000):
     """
     Find out if TAD boundaries are breaking clusters of colocalizing
     (epi)genetic elements.
     
-    :param tads:
+    :param exp: Experiment with TADs
     :param cluster: cluster of elements
     :param title: for plotting
-    :param resolution: in bases
     :param 20 bins: number of bins to use
     :param False show_plot:
-    :para False test: for significant difference between extremes and center
+    :param 1000 n_rand: number of randomizations of the clusters, to test
+       the significance of the counts
 
     :returns: list of counts for each bin
     """
-    def arrange(beg, end, num):
-        num -= 1
-        step  = int((end - beg) / num)
-        for k in xrange(int(beg), int(end), step):
-            yield k
-        yield int(end)
-    brk_set = []
-    for t in xrange(len(tads)):
-        if not tads[t]['score'] >= 5:
-           continue
-        if (tads[t]['end'] - tads[t]['start']) * resolution > max_tad_size:
-            continue
-        brk_set.append([b for b in arrange(tads[t]['start'] * resolution,
-                                           tads[t]['end'] * resolution, bins)])
-    counts = []
-    for b in range(bins):
-        count = 0
-        for start, end in cluster:
-            for brk in brk_set:
-                if start < brk[b] < end:
-                    count += 1
-                    break
-        counts.append(1-float(count)/len(cluster))
+    enrichment = boundary_enrichment(exp, cluster, bins=bins, min_score=5,
+                                     max_tad_size=max_tad_size,
+                                     n_rand=n_rand, n_cpus='max')
+    counts = [1 - float(count) / len(cluster)
+              for count in enrichment['profile']]
+    print 'clusters broken by boundaries: %d (expected %.1f, p-value %.3f)' % (
+        enrichment['boundary'], enrichment['boundary_exp'],
+        enrichment['boundary_pval_low'])
     print counts
     if show_plot:
         plt.bar(range(bins), counts)
@@ -116,7 +102,7 @@ def main():
         cluster[j-1].append(geneids['19'][i][1])
     for i, _ in enumerate(cluster):
         cluster[i] = min(cluster[i]), max(cluster[i])
-    tad_breaker(exp.tads, cluster, exp.resolution, show_plot=True, bins=5,
+    tad_breaker(exp, cluster, show_plot=True, bins=5,
                 title='Proportion of HOX genes according to position in a TAD')
     
     
@@ -3,13 +3,6 @@
 
 // Global variables. //
 
-int *_cache_index;
-int _max_cache_index;
-int n_processed;              // Number of slices processed so far.
-int n_to_process;             // Total number of slices to process.
-int taskQ_i;                  // Index used for task queue.
-pthread_mutex_t tadbit_lock;  // Mutex to access task queue.
-
 // Convenience function to erase tadbit_output data structure //
 void
 destroy_tadbit_output(
@@ -18,30 +11,439 @@ destroy_tadbit_output(
 {
    free(seg->passages);
    free(seg->llikmat);
+   free(seg->pos);
    free(seg->mllik);
    free(seg->bkpts);
    for (int i = 0 ; i < seg->m ; i++) {
-      free(seg->weights[i]);
+      free(seg->rowsums[i]);
    }   
-   free(seg->weights);
+   free(seg->rowsums);
+   free(seg->stats.t_llik);
+   free(seg->stats.n_llik);
+   free(seg->stats.t_dp);
    free(seg);
 
    return;
 }
 
 
+static inline double
+wall_time(
+  void
+){
+// SYNOPSIS:                                                            
+//   Wall time in seconds (from an arbitrary origin).                   
+//                                                                      
+
+   struct timespec ts;
+   clock_gettime(CLOCK_MONOTONIC, &ts);
+   return ts.tv_sec + 1e-9 * ts.tv_nsec;
+
+}
+
+void *
+pool_worker(
+  void *arg
+){
+// SYNOPSIS:                                                            
+//   Thread function of the pool: wait for a job, run it and signal     
+//   its end, until the pool is destroyed.                              
+//                                                                      
+// PARAMETERS:                                                          
+//   'arg': the pool (see header file).                                 
+//                                                                      
+// RETURN:                                                              
+//   'void *'                                                           
+//                                                                      
+
+   tadbit_pool *pool = (tadbit_pool *) arg;
+   int generation = 0;
+
+   while (1) {
+      pthread_mutex_lock(&pool->lock);
+      while (!pool->quit && pool->generation == generation) {
+         pthread_cond_wait(&pool->start, &pool->lock);
+      }
+      if (pool->quit) {
+         pthread_mutex_unlock(&pool->lock);
+         break;
+      }
+      generation = pool->generation;
+      void *(*job)(void *) = pool->job;
+      void *job_arg = pool->arg;
+      pthread_mutex_unlock(&pool->lock);
+
+      double start = wall_time();
+      job(job_arg);
+      double busy = wall_time() - start;
+
+      pthread_mutex_lock(&pool->lock);
+      pool->busy += busy;
+      if (--pool->running == 0) pthread_cond_signal(&pool->done);
+      pthread_mutex_unlock(&pool->lock);
+   }
+
+   return NULL;
+
+}
+
 void
-fg(
+destroy_pool(
+  tadbit_pool *pool
+){
+// SYNOPSIS:                                                            
+//   Stop the threads of the pool and free it.                          
+//                                                                      
+
+   int i;
+
+   pthread_mutex_lock(&pool->lock);
+   pool->quit = 1;
+   pthread_cond_broadcast(&pool->start);
+   pthread_mutex_unlock(&pool->lock);
+   for (i = 0 ; i < pool->n_threads ; i++) {
+      pthread_join(pool->tid[i], NULL);
+   }
+
+   pthread_mutex_destroy(&pool->lock);
+   pthread_cond_destroy(&pool->start);
+   pthread_cond_destroy(&pool->done);
+   free(pool->tid);
+   free(pool);
+
+   return;
+
+}
+
+
+tadbit_pool *
+create_pool(
+  const int n_threads
+){
+// SYNOPSIS:                                                            
+//   Start 'n_threads' threads waiting for jobs.                        
+//                                                                      
+// RETURN:                                                              
+//   The pool, or NULL if threads could not be created.                 
+//                                                                      
+
+   int i;
+   int err;
+   tadbit_pool *pool = (tadbit_pool *) malloc(sizeof(tadbit_pool));
+
+   pool->n_threads = 0;
+   pool->tid = (pthread_t *) malloc(n_threads * sizeof(pthread_t));
+   pool->generation = 0;
+   pool->running = 0;
+   pool->quit = 0;
+   pool->busy = 0.0;
+   pool->wall = 0.0;
+   pthread_mutex_init(&pool->lock, NULL);
+   pthread_cond_init(&pool->start, NULL);
+   pthread_cond_init(&pool->done, NULL);
+
+   for (i = 0 ; i < n_threads ; i++) {
+      err = pthread_create(&(pool->tid[i]), NULL, &pool_worker, pool);
+      if (err) {
+         fprintf(stderr, "error creating thread (%d)\n", err);
+         destroy_pool(pool);
+         return NULL;
+      }
+      pool->n_threads++;
+   }
+
+   return pool;
+
+}
+
+void
+run_pool(
+  tadbit_pool *pool,
+  void *(*job)(void *),
+  void *arg,
+  void (*tick)(void *),
+  void *tick_arg
+){
+// SYNOPSIS:                                                            
+//   Run 'job' with argument 'arg' on all the threads of the pool and   
+//   wait for all of them to return. Jobs share their work through      
+//   the atomic counter 'taskQ_i' of the context (see header file).     
+//   If 'tick' is not NULL, it is called with 'tick_arg' by the         
+//   calling thread every 'PROGRESS_INTERVAL' seconds while waiting.    
+//                                                                      
+
+   double start = wall_time();
+   struct timespec ts;
+
+   pthread_mutex_lock(&pool->lock);
+   pool->job = job;
+   pool->arg = arg;
+   pool->running = pool->n_threads;
+   pool->generation++;
+   pthread_cond_broadcast(&pool->start);
+   while (pool->running > 0) {
+      if (tick == NULL) {
+         pthread_cond_wait(&pool->done, &pool->lock);
+         continue;
+      }
+      clock_gettime(CLOCK_REALTIME, &ts);
+      long nsec = ts.tv_nsec + (long) (PROGRESS_INTERVAL * 1e9);
+      ts.tv_sec += nsec / 1000000000;
+      ts.tv_nsec = nsec % 1000000000;
+      pthread_cond_timedwait(&pool->done, &pool->lock, &ts);
+      if (pool->running > 0) {
+         pthread_mutex_unlock(&pool->lock);
+         tick(tick_arg);
+         pthread_mutex_lock(&pool->lock);
+      }
+   }
+   pool->wall += wall_time() - start;
+   pthread_mutex_unlock(&pool->lock);
+
+   return;
+
+}
+
+static inline double
+weight(
+  const int use_visibility,
+  const double rs_i,
+  const double rs_j
+){
+// SYNOPSIS:                                                            
+//   Weight of the cell at the intersection of rows with sums 'rs_i'    
+//   and 'rs_j' (product of the sums if 'use_visibility' is set,        
+//   square root of the product otherwise).                             
+   return use_visibility ? rs_i*rs_j : sqrt(rs_i*rs_j);
+}
+
+
+static inline int
+cell(
+  const int *k,
+  const int r,
+  const int c,
+  const int N,
+  const int triangle
+){
+// SYNOPSIS:                                                            
+//   Count of the cell ('r','c') of a symmetric 'N' x 'N' matrix stored 
+//   in full or as its upper triangle (see the 'TRI' macro).            
+   if (!triangle) return k[r+(size_t) c*N];
+   return r <= c ? k[TRI(r,c,N)] : k[TRI(c,r,N)];
+}
+
+
+static inline double
+lgam(
+  const obsmap *map,
+  const int k
+){
+// SYNOPSIS:                                                            
+//   Log-gamma term 'lgamma(k+1)' of a count (tabulated if small).      
+   return (k >= 0 && k < map->nlgtab) ? map->lgtab[k] : lgamma(k+1);
+}
+
+
+void
+diagonal_prefix_sums(
   // input //
   const int    n,
+  const obsmap *map,
+  const int    *k,
+  const double *rs,
+  // output //
+        diagsum *ps
+){
+// SYNOPSIS:                                                            
+//   Compute the prefix sums of the cells of the original matrix along  
+//   its diagonals: the element (r,c) of 'ps' contains the sums (number 
+//   of cells, weights, counts and log-gamma terms) of the cells        
+//   (r-t,c-t) for t >= 0. The cells of the removed rows/columns and    
+//   of the main diagonal are not counted.                              
+//                                                                      
+// ARGUMENTS:                                                           
+//   'n': row/column number of the counts.                              
+//   'map': position of the rows/columns in the original matrices.      
+//   'k': raw hiC counts (original matrix).                             
+//   'rs': row sums, from which the weights are computed.               
+//        -- output arguments --                                        
+//   'ps': address of an array of N*N 'diagsum'.                        
+//                                                                      
+// SIDE-EFFECTS:                                                        
+//   Update 'ps' in place.                                              
+//                                                                      
+
+   int i;
+   int r;
+   int c;
+   const int N = map->N;
+   const int vis = map->use_visibility;
+
+   // Index of the rows/columns after removal (-1 if removed).
+   int *idx = (int *) malloc(N * sizeof(int));
+   for (r = 0 ; r < N ; r++) idx[r] = -1;
+   for (i = 0 ; i < n ; i++) idx[map->pos[i]] = i;
+
+   for (c = 0 ; c < N ; c++)
+   for (r = 0 ; r < N ; r++) {
+      diagsum *s = ps + r + (size_t) c*N;
+      if (r > 0 && c > 0) *s = *(s-N-1);
+      else *s = (diagsum) {0.0, 0.0, 0.0, 0.0};
+      if (r == c || idx[r] < 0 || idx[c] < 0) continue;
+      const int count = cell(k, r, c, N, map->triangle);
+      s->ncells += 1;
+      s->w += weight(vis, rs[idx[r]], rs[idx[c]]);
+      s->k += count;
+      s->lgam += lgam(map, count);
+   }
+
+   free(idx);
+
+   return;
+
+}
+
+
+int
+aggregate(
+  // input //
   const int    i_,
   const int    _i,
   const int    j_,
   const int    _j,
   const int    diag,
+  const obsmap *map,
   const int    *k,
-  const double *d,
-  const double *w,
+  const double *rs,
+  const diagsum *ps,
+  // output //
+        diagsum *agg,
+        int    *dist
+){
+// SYNOPSIS:                                                            
+//   Sum the number of cells, the weights, the counts and the           
+//   log-gamma terms of the counts of a block per distance to the       
+//   diagonal. All the cells at the same distance have the same         
+//   expected count (up to the weight), so the Newton-Raphson cycles    
+//   of 'll' only need these sums.                                      
+//                                                                      
+// ARGUMENTS:                                                           
+//   See the function 'll' for the description of 'i_', '_i', 'j_',     
+//      '_j', 'diag', 'map', 'k', 'rs' and 'ps'.                        
+//        -- output arguments --                                        
+//   'agg': address of an array of 'diagsum' for the sums.              
+//   'dist': address of an array of int for the distances.              
+//                                                                      
+// RETURN:                                                              
+//   The number of distances present in the block.                      
+//                                                                      
+// SIDE-EFFECTS:                                                        
+//   Update 'agg' and 'dist' in place.                                  
+//                                                                      
+
+   int i;
+   int j;
+   int d;
+   int nd = 0;
+   const int N = map->N;
+   const int *pos = map->pos;
+   const int vis = map->use_visibility;
+
+   if (ps != NULL) {
+      // The sums of the cells on each diagonal of the block are the
+      // differences of two prefix sums (see 'diagonal_prefix_sums').
+      // Removed rows/columns contribute 0 to the prefix sums.
+      const int r0 = pos[i_];
+      const int r1 = diag ? pos[_j] : pos[_i];
+      const int c0 = pos[j_];
+      const int c1 = pos[_j];
+      // Shift 'c-r' of the diagonals of the block. Off-diagonal blocks
+      // are either above (positive shift) or below the diagonal.
+      int delta_low = diag ? 1 : c0-r1;
+      int delta_high = c1-r0;
+      int delta;
+      for (delta = delta_low ; delta <= delta_high ; delta++) {
+         // First and last row of the diagonal in the block.
+         int ra = diag ? r0 : (r0 > c0-delta ? r0 : c0-delta);
+         int rb = diag ? r1-delta : (r1 < c1-delta ? r1 : c1-delta);
+         if (ra > rb) continue;
+         const diagsum *top = ps + rb + (size_t) (rb+delta)*N;
+         const diagsum *bot = (ra > 0 && ra+delta > 0) ?
+            ps + ra-1 + (size_t) (ra-1+delta)*N : NULL;
+         diagsum s = *top;
+         if (bot != NULL) {
+            s.ncells -= bot->ncells;
+            s.w -= bot->w;
+            s.k -= bot->k;
+            s.lgam -= bot->lgam;
+         }
+         if (s.ncells < 0.5) continue;
+         agg[nd] = s;
+         dist[nd++] = delta > 0 ? delta : -delta;
+      }
+      return nd;
+   }
+
+   // No prefix sums: scan the block and sum the cells per distance.
+   int i_high = -1;
+   int j_low = diag ? j_+1 : j_;
+   int j_high = _j+1;
+   int d_low = N;
+   int d_high = 0;
+   // The rows of a column are all on the same side of the diagonal, so
+   // the extreme distances are those of the first and last rows.
+   for (j = j_low ; j < j_high ; j++) {
+      i_high = diag ? j : _i+1;
+      if (i_high <= i_) continue;
+      d = abs(pos[j]-pos[i_]);
+      if (d < d_low) d_low = d;
+      if (d > d_high) d_high = d;
+      d = abs(pos[j]-pos[i_high-1]);
+      if (d < d_low) d_low = d;
+      if (d > d_high) d_high = d;
+   }
+   if (d_low > d_high) return 0;
+
+   for (d = d_low ; d <= d_high ; d++) {
+      agg[d-d_low] = (diagsum) {0.0, 0.0, 0.0, 0.0};
+   }
+
+   for (j = j_low ; j < j_high ; j++) {
+      const int pj = pos[j];
+      const double rs_j = rs[j];
+      i_high = diag ? j : _i+1;
+      for (i = i_ ; i < i_high ; i++) {
+         const int pi = pos[i];
+         const int count = cell(k, pi, pj, N, map->triangle);
+         diagsum *s = agg + (pi > pj ? pi-pj : pj-pi) - d_low;
+         s->ncells += 1;
+         s->w += weight(vis, rs[i], rs_j);
+         s->k += count;
+         s->lgam += lgam(map, count);
+      }
+   }
+
+   // Keep the distances present in the block (in place, since the
+   // index of a distance in the output is not larger than in 'agg').
+   for (d = d_low ; d <= d_high ; d++) {
+      if (agg[d-d_low].ncells < 0.5) continue;
+      agg[nd] = agg[d-d_low];
+      dist[nd++] = d;
+   }
+
+   return nd;
+
+}
+
+
+void
+fg(
+  // input //
+  const int    nd,
+  const diagsum *agg,
+  const int    *dist,
+  const obsmap *map,
   const double a,
   const double b,
   const double da,
@@ -56,8 +458,10 @@ fg(
 //   cycles.                                                            
 //                                                                      
 // ARGUMENTS:                                                           
-//   See the function 'll' for the description of 'n', 'i_', '_i',      
-//      'j_', '_j', 'diag', 'k', 'd', and 'w'.                          
+//   'nd': number of distances in the block (see 'aggregate').          
+//   'agg': sums of the cells of the block per distance.                
+//   'dist': distances of the sums in 'agg'.                            
+//   'map': log-distances from the diagonal (see 'll').                 
 //   'a': parameter 'a' of the Poisson regression (see 'poiss_reg').    
 //   'b': parameter 'b' of the Poisson regression (see 'poiss_reg').    
 //   'da': computed differential of 'a' (see 'poiss_reg').              
@@ -79,30 +483,18 @@ fg(
    // can return a long double (causing segmentation fault if 'tmp' is
    // declared as long).
    long double tmp;
-   int i;
-   int j;
-   int i_low = i_;
-   int i_high = -1;
-   int j_low = diag ? j_+1 : j_;
-   int j_high = _j+1;
-   int index;
+   int t;
+   const double *logd = map->logd;
 
    *f = 0.0; *g = 0.0;
-   // Initialize cache.
-   for (index = 0 ; index < _max_cache_index ; index++) c[index] = NAN;
 
-   for (j = j_low ; j < j_high ; j++) {
-      i_high = diag ? j : _i+1;
-      for (i = i_low ; i < i_high ; i++) {
-         // Retrieve value of the exponential from cache.
-         index = _cache_index[i+j*n];
-         if (c[index] != c[index]) {
-            c[index] = exp(a+da+(b+db)*d[i+j*n]);
-         }
-         tmp  =  w[i+j*n] * c[index] - k[i+j*n];
-         *f  +=  tmp;
-         *g  +=  tmp * d[i+j*n];
-      }
+   for (t = 0 ; t < nd ; t++) {
+      const double d = logd[dist[t]];
+      // Store the value of the exponential for 'll'.
+      c[t] = exp(a+da+(b+db)*d);
+      tmp  =  agg[t].w * c[t] - agg[t].k;
+      *f  +=  tmp;
+      *g  +=  tmp * d;
    }
 
    return;
@@ -111,17 +503,19 @@ fg(
 
 double
 ll(
-  const int    n,
   const int    i_,
   const int    _i,
   const int    j_,
   const int    _j,
   const int    diag,
+  const obsmap *map,
   const int    *k,
-  const double *d,
-  const double *w,
-  const double *lg,
-        double *c
+  const double *rs,
+  const diagsum *ps,
+        diagsum *agg,
+        int    *dist,
+        double *c,
+        long   *n_iter
 ){
 // SYNOPSIS:                                                            
 //   The fitted model (by maximum likelihood) is Poisson with lambda    
@@ -130,18 +524,25 @@ ll(
 //                                                                      
 //      - w_i exp(a + b*d_i) + k_i(log(w_i) + a + b*d_i) - log(k_i!)    
 //                                                                      
+//   The terms are summed per distance 'd_i' (see 'aggregate').         
+//                                                                      
 // ARGUMENTS:                                                           
-//   'n': row/column number of the counts.                              
 //   'i_': first value of index i (row).                                
 //   '_i': last value of index i (row).                                 
 //   'j_': first value of index j (column).                             
 //   '_j': last value of index j (column).                              
 //   'diag': whether the block is half-diagonal (middle block).         
-//   'k': raw hiC counts.                                               
-//   'd': distances from diagonal in log.                               
-//   'w': weights measuring hiC bias.                                   
-//   'lg': log-gamma terms.                                             
+//   'map': position of the rows/columns in the original matrices,      
+//        log-distances from diagonal and log-gamma terms.              
+//   'k': raw hiC counts (original matrix).                             
+//   'rs': row sums, from which the weights measuring hiC bias are      
+//        computed.                                                     
+//   'ps': prefix sums of the cells along the diagonals of the          
+//        original matrix (NULL if not tabulated).                      
+//   'agg': address of an array of 'diagsum' for the sums per distance. 
+//   'dist': address of an array of int for the distances.              
 //   'c': address of an array of double for caching.                    
+//   'n_iter': address of a counter of Newton-Raphson iterations.       
 //                                                                      
 // RETURN:                                                              
 //   The maximum log-likelihood of a block of hiC data.                 
@@ -157,12 +558,7 @@ ll(
    if ((_i < i_+2) || (_j < j_+2)) return NAN;
 
    int i;
-   int j;
-   int i_low = i_;
-   int i_high = -1;
-   int j_low = diag ? j_+1 : j_;
-   int j_high = _j+1;
-   int index;
+   int t;
    int iter = 0;
    double denom;
    double oldgrad;
@@ -178,32 +574,28 @@ ll(
    double dgdb = 0.0;
    // See the comment about 'tmp' in 'fg'.
    long double tmp; 
+   const double *logd = map->logd;
+
+   const int nd = aggregate(i_, _i, j_, _j, diag, map, k, rs, ps,
+         agg, dist);
 
-   fg(n, i_, _i, j_, _j, diag, k, d, w, a, b, da, db, c, &f, &g);
+   fg(nd, agg, dist, map, a, b, da, db, c, &f, &g);
 
    // Newton-Raphson until gradient function is less than TOLERANCE.
    // The gradient function is the square norm 'f*f + g*g'.
    while ((oldgrad = f*f + g*g) > TOLERANCE && iter++ < MAXITER) {
 
-      for (index = 0 ; index < _max_cache_index ; index++) c[index] = NAN;
       // Compute the derivatives.
       dfda = dfdb = dgda = dgdb = 0.0;
 
-      for (j = j_low ; j < j_high ; j++) {
-         i_high = diag ? j : _i+1;
-         for (i = i_low ; i < i_high ; i++) {
-            index = _cache_index[i+j*n];
-            // Retrieve value of the exponential from cache.
-            if (c[index] != c[index]) { // ERROR.
-               c[index] = exp(a+b*d[i+j*n]);
-            }
-            tmp   =   w[i+j*n] * c[index];
-            dfda +=   tmp;
-            tmp  *=   d[i+j*n];
-            dgda +=   tmp;
-            tmp  *=   d[i+j*n];
-            dgdb +=   tmp;
-         }
+      for (t = 0 ; t < nd ; t++) {
+         const double d = logd[dist[t]];
+         tmp   =   agg[t].w * exp(a+b*d);
+         dfda +=   tmp;
+         tmp  *=   d;
+         dgda +=   tmp;
+         tmp  *=   d;
+         dgdb +=   tmp;
       }
       dfdb = dgda;
 
@@ -211,7 +603,7 @@ ll(
       da = (f*dgdb - g*dfdb) / denom;
       db = (g*dfda - f*dgda) / denom;
 
-      fg(n, i_, _i, j_, _j, diag, k, d, w, a, b, da, db, c, &f, &g);
+      fg(nd, agg, dist, map, a, b, da, db, c, &f, &g);
 
       // Traceback if we are not going down the gradient. Cut the
       // length of the steps in half until this step goes down
@@ -219,7 +611,7 @@ ll(
       for (i = 0 ; (i < 20) && (f*f + g*g > oldgrad) ; i++) {
          da /= 2;
          db /= 2;
-         fg(n, i_, _i, j_, _j, diag, k, d, w, a, b, da, db, c, &f, &g);
+         fg(nd, agg, dist, map, a, b, da, db, c, &f, &g);
       }
 
       // Update 'a' and 'b'.
@@ -227,6 +619,7 @@ ll(
       b += db;
 
    }
+   *n_iter += iter;
 
    if (iter >= MAXITER) {
       // Something probably went wrong. Return NAN.
@@ -237,14 +630,9 @@ ll(
    double llik = 0.0;
 
    // The last call to 'fg' has set the cache to the right values.
-   // No need to reset the cache.
-   for (j = j_low ; j < j_high ; j++) {
-      i_high = diag ? j : _i+1;
-      for (i = i_low ; i < i_high ; i++) {
-         index = _cache_index[i+j*n];
-         // Retrieve value of the exponential from cache.
-         llik += c[index] + k[i+j*n]*(a+b*d[i+j*n]) - lg[i+j*n];
-      }
+   for (t = 0 ; t < nd ; t++) {
+      llik += agg[t].ncells * c[t] + agg[t].k * (a+b*logd[dist[t]]) -
+         agg[t].lgam;
    }
 
    return llik;
@@ -266,53 +654,51 @@ fill_DP(
 //   'void *'                                                           
 //                                                                      
 // SIDE-EFFECTS:                                                        
-//   Update 'old_llik', 'new_llik' and 'new_bkpt_list' in place.        
+//   Update 'new_llik' and 'backtrack' (if not NULL) in place.          
 //                                                                      
 
    dpworker_arg *myargs = (dpworker_arg *) arg;
    const int n = myargs->n;
+   const int band = myargs->band;
    const double *llikmat = (const double *) myargs->llikmat;
    double *old_llik = (double *) myargs->old_llik;
    double *new_llik = (double *) myargs->new_llik;
    const int nbreaks = myargs->nbreaks;
-   int *new_bkpt_list = (int *) myargs->new_bkpt_list;
-   const int *old_bkpt_list = (const int *) myargs->old_bkpt_list;
+   int *backtrack = (int *) myargs->backtrack;
+   tadbit_context *ctx = myargs->ctx;
 
    int i;
+   int j;
 
    while (1) {
-      pthread_mutex_lock(&tadbit_lock);
-      if (taskQ_i > n-1) {
+      // Claim 'DP_CHUNK' tasks at once. A task gives an end point 'j'.
+      long first = __sync_fetch_and_add(&ctx->taskQ_i, DP_CHUNK);
+      if (first > n-1) {
          // Task queue is empty. Exit loop and return
-         pthread_mutex_unlock(&tadbit_lock);
          break;
       }
-      // A task gives an end point 'j'.
-      int j = taskQ_i;
-      taskQ_i++;
-      pthread_mutex_unlock(&tadbit_lock);
-
-      new_llik[j] = -INFINITY;
-      int new_bkpt = -1;
-
-      // Cycle over start point 'i'.
-      for (i = 3 * nbreaks ; i < j-3 ; i++) {
-
-         // If NAN the following condition evaluates to false.
-         double tmp = old_llik[i-1] + llikmat[i+j*n];
-         if (tmp > new_llik[j]) {
-            new_llik[j] = tmp;
-            new_bkpt = i-1;
+      int last = first+DP_CHUNK < n ? first+DP_CHUNK : n;
+
+      for (j = first ; j < last ; j++) {
+         new_llik[j] = -INFINITY;
+         int new_bkpt = -1;
+
+         // Cycle over start point 'i' (slices outside of the band are
+         // not stored and their log-likelihood is undefined).
+         int i_low = j-band+1 > 3 * nbreaks ? j-band+1 : 3 * nbreaks;
+         for (i = i_low ; i < j-3 ; i++) {
+
+            // If NAN the following condition evaluates to false.
+            double tmp = old_llik[i-1] + llikmat[BAND(i,j,band)];
+            if (tmp > new_llik[j]) {
+               new_llik[j] = tmp;
+               new_bkpt = i-1;
+            }
          }
-      }
 
-      // Update breakpoint list (skip if log-lik is undefined).
-      // No need to use mutex because 'j' is different for every thread.
-      if (new_llik[j] > -INFINITY) {
-         for (i = 0 ; i < n ; i++) {
-            new_bkpt_list[j+i*n] = old_bkpt_list[new_bkpt+i*n];
-         }
-         new_bkpt_list[j+new_bkpt*n] = 1;
+         // Store the back pointer ('-1' if log-lik is undefined).
+         // No need to use mutex because 'j' is different for every thread.
+         if (backtrack != NULL) backtrack[j] = new_bkpt;
       }
    }
 
@@ -320,58 +706,146 @@ fill_DP(
 
 }
 
+void
+walk_levels(
+  // input //
+  const double *llikmat,
+  const int n,
+  const int band,
+  const int first,
+  const int last,
+  tadbit_context *ctx,
+  // output //
+  double *row,
+  double *mllik,
+  int *backtrack,
+  double *times
+){
+// SYNOPSIS:                                                            
+//   Run the levels 'first' to 'last'-1 (numbers of breaks) of the      
+//   dynamic programming of 'DPwalk', starting from the maximum         
+//   log-likelihoods with 'first'-1 breaks.                             
+//                                                                      
+// PARAMETERS:                                                          
+//   '*llikmat': banded matrix of maximum log-likelihood values.        
+//   'n': row/col number of 'llikmat'.                                  
+//   'band': number of diagonals stored in 'llikmat'.                   
+//   'first', 'last': the levels to compute.                            
+//   'ctx': the context of the call (see header file).                  
+//        -- output arguments --                                        
+//   '*row': maximum log-likelihood of the segmentations of [0,j]       
+//        with 'first'-1 breaks, replaced by those with 'last'-1        
+//        breaks.                                                       
+//   '*mllik': maximum log-likelihood of the segmentations (NULL if     
+//        not used).                                                    
+//   '*backtrack': back pointers of the levels, level 'nbreaks' at      
+//        'j+(nbreaks-first)*n' (NULL if not used, see 'DPwalk').       
+//   '*times': time spent per number of breaks, incremented (NULL if    
+//        not used).                                                    
+//                                                                      
+// RETURN:                                                              
+//   'void'                                                             
+//                                                                      
+// SIDE-EFFECTS:                                                        
+//   Update 'row', 'mllik' and 'backtrack' in place.                    
+//                                                                      
+
+   int i;
+   int nbreaks;
+
+   double *new_llik = (double *) malloc(n * sizeof(double));
+   for (i = 0 ; i < n ; i++) new_llik[i] = -INFINITY;
+
+   dpworker_arg arg = {
+      .n = n,
+      .band = band,
+      .llikmat = llikmat,
+      .old_llik = row,
+      .new_llik = new_llik,
+      .nbreaks = first,
+      .backtrack = NULL,
+      .ctx = ctx,
+   };
+
+   for (nbreaks = first ; nbreaks < last ; nbreaks++) {
+
+      arg.nbreaks = nbreaks;
+      if (backtrack != NULL) {
+         arg.backtrack = backtrack + (size_t) (nbreaks-first)*n;
+      }
+      double start = wall_time();
+      ctx->taskQ_i = 3 * nbreaks + 2;
+      run_pool(ctx->pool, &fill_DP, &arg, NULL, NULL);
+
+      // Update full log-likelihoods.
+      if (mllik != NULL) mllik[nbreaks] = new_llik[n-1];
+
+      // Slices ending before '3*nbreaks+2' are not updated, and not
+      // used at the next level either.
+      for (i = 0 ; i < n ; i++) {
+         row[i] = new_llik[i];
+      }
+
+      if (times != NULL) times[nbreaks] += wall_time() - start;
+
+   }
+
+   free(new_llik);
+
+   return;
+
+}
+
 void
 DPwalk(
   // input //
   const double *llikmat,
   const int n,
+  const int band,
   const int MAXBREAKS,
-  int n_threads,
+  tadbit_context *ctx,
   // output //
   double *mllik,
-  int *breakpoints
+  int *backtrack,
+  double *times
 ){
 // SYNOPSIS:                                                            
 //   Dynamic programming algorithm to compute the most likely position  
 //   of breakpoints given a matrix of slice maximum log-likelihood.     
 //                                                                      
 // PARAMETERS:                                                          
-//   '*llikmat': matrix of maximum log-likelihood values.               
+//   '*llikmat': banded matrix of maximum log-likelihood values.        
 //   'n': row/col number of 'llikmat'.                                  
+//   'band': number of diagonals stored in 'llikmat'.                   
 //   'MAXBREAKS': The maximum number of breakpoints.                    
+//   'ctx': the context of the call (see header file).                  
 //        -- output arguments --                                        
 //   '*mllik': maximum log-likelihood of the segmentations.             
-//   '*breakpoints': optimal breakpoints per number of breaks.          
+//   '*backtrack': back pointers of the dynamic programming. The       
+//        element 'j+nbreaks*n' is the end of the second to last        
+//        segment of the most likely segmentation of [0,j] with         
+//        'nbreaks' breaks, or -1 if there is none. Breakpoints are     
+//        retrieved with 'get_breakpoints'.                             
+//   '*times': time spent per number of breaks, incremented (NULL if    
+//        not used).                                                    
 //                                                                      
 // RETURN:                                                              
 //   'void'                                                             
 //                                                                      
 // SIDE-EFFECTS:                                                        
-//   Update 'breakpoints' in place.                                     
+//   Update 'mllik' and 'backtrack' in place.                           
 //                                                                      
 
    int i;
-   int nbreaks;
+   size_t t;
 
-   double new_llik[n];
-   double old_llik[n];
-
-   // Breakpoint lists. The first index (row) is the end of the slice,
-   // the second is 1 if this position is an end (breakpoint).
-   // These must be allocated from the heap because 'n' can be large.
-   int *new_bkpt_list = (int *) malloc(n*n * sizeof(int));
-   int *old_bkpt_list = (int *) malloc(n*n * sizeof(int));
+   double *old_llik = (double *) malloc(n * sizeof(double));
 
    // Initializations.
-   // 'breakpoints' is a 'n' x 'MAXBREAKS' array. The first index (row)
-   // is 1 if there is a breakpoint at that location, the second index
-   // (column) is the number of breakpoints.
-   for (i = 0 ; i < n*MAXBREAKS ; i++) breakpoints[i] = 0;
-
-   for (i = 0 ; i < n*n ; i++) {
-      new_bkpt_list[i] = 0;
-      old_bkpt_list[i] = 0;
-   }
+   // 'backtrack' is a 'n' x 'MAXBREAKS' array. The first index (row)
+   // is the end of the slice, the second index (column) is the number
+   // of breakpoints. Segmentations without breakpoint have none.
+   for (t = 0 ; t < (size_t) n*MAXBREAKS ; t++) backtrack[t] = -1;
 
    for (i = 0 ; i < MAXBREAKS ; i++) {
       mllik[i] = NAN;
@@ -380,66 +854,226 @@ DPwalk(
    // Initialize 'old_llik' to the first line of 'llikmat' containing
    // the log-likelihood of segments starting at index 0.
    for (i = 0 ; i < n ; i++) {
-      old_llik[i] = llikmat[i*n];
-      new_llik[i] = -INFINITY;
+      old_llik[i] = i < band ? llikmat[BAND(0,i,band)] : NAN;
    }
 
-   int err = pthread_mutex_init(&tadbit_lock, NULL);
-   if (err) {
-      fprintf(stderr, "error initializing mutex (%d)\n", err);
-      return;
+   // Dynamic programming.
+   walk_levels(llikmat, n, band, 1, MAXBREAKS, ctx, old_llik, mllik,
+         backtrack + n, times);
+
+   free(old_llik);
+
+   return;
+
+}
+
+void
+DPcheckpoints(
+  // input //
+  const double *llikmat,
+  const int n,
+  const int band,
+  const int MAXBREAKS,
+  const int step,
+  tadbit_context *ctx,
+  // output //
+  double *mllik,
+  double *checkpoints,
+  double *times
+){
+// SYNOPSIS:                                                            
+//   Dynamic programming of 'DPwalk' without back pointers, which take  
+//   'n' x 'MAXBREAKS' int. Instead, the maximum log-likelihoods of a   
+//   number of breaks every 'step' are kept, from which 'DPtrace'       
+//   computes the back pointers again, 'step' levels at a time.         
+//                                                                      
+// PARAMETERS:                                                          
+//   '*llikmat': banded matrix of maximum log-likelihood values.        
+//   'n': row/col number of 'llikmat'.                                  
+//   'band': number of diagonals stored in 'llikmat'.                   
+//   'MAXBREAKS': The maximum number of breakpoints.                    
+//   'step': number of breaks between checkpoints.                      
+//   'ctx': the context of the call (see header file).                  
+//        -- output arguments --                                        
+//   '*mllik': maximum log-likelihood of the segmentations.             
+//   '*checkpoints': array of 'n' x ('MAXBREAKS'-2)/'step'+1 elements.  
+//        The element 'j+k*n' is the maximum log-likelihood of the      
+//        segmentations of [0,j] with 'k*step' breaks.                  
+//   '*times': time spent per number of breaks, incremented (NULL if    
+//        not used).                                                    
+//                                                                      
+// RETURN:                                                              
+//   'void'                                                             
+//                                                                      
+// SIDE-EFFECTS:                                                        
+//   Update 'mllik' and 'checkpoints' in place.                         
+//                                                                      
+
+   int i;
+   int k;
+
+   double *row = (double *) malloc(n * sizeof(double));
+
+   for (i = 0 ; i < MAXBREAKS ; i++) {
+      mllik[i] = NAN;
    }
 
-   dpworker_arg arg = {
-      .n = n,
-      .llikmat = llikmat,
-      .old_llik = old_llik,
-      .new_llik = new_llik,
-      .nbreaks = 1,
-      .new_bkpt_list = new_bkpt_list,
-      .old_bkpt_list = old_bkpt_list,
-   };
+   for (i = 0 ; i < n ; i++) {
+      row[i] = i < band ? llikmat[BAND(0,i,band)] : NAN;
+   }
 
-   pthread_t *tid = (pthread_t *) malloc(n_threads * sizeof(pthread_t));
+   for (k = 0 ; k*step+1 < MAXBREAKS ; k++) {
+      for (i = 0 ; i < n ; i++) checkpoints[i+(size_t) k*n] = row[i];
+      int last = (k+1)*step+1 < MAXBREAKS ? (k+1)*step+1 : MAXBREAKS;
+      walk_levels(llikmat, n, band, k*step+1, last, ctx, row, mllik,
+            NULL, times);
+   }
 
-   // Dynamic programming.
-   for (nbreaks = 1 ; nbreaks < MAXBREAKS ; nbreaks++) {
+   free(row);
 
-      arg.nbreaks = nbreaks;
-      // Update breakpoint lists.
-      for (i = 0 ; i < n*n ; i++) {
-         old_bkpt_list[i] = new_bkpt_list[i];
-      }
-      taskQ_i = 3 * nbreaks + 2;
-
-      for (i = 0 ; i < n_threads ; i++) tid[i] = 0;
-      for (i = 0 ; i < n_threads ; i++) {
-         err = pthread_create(&(tid[i]), NULL, &fill_DP, &arg);
-         if (err) {
-            fprintf(stderr, "error creating thread (%d)\n", err);
-            return;
+   return;
+
+}
+
+void
+DPtrace(
+  // input //
+  const double *llikmat,
+  const int n,
+  const int band,
+  const int MAXBREAKS,
+  const int step,
+  const double *checkpoints,
+  const int nfirst,
+  const int nlast,
+  tadbit_context *ctx,
+  // output //
+  int *breakpoints,
+  double *times
+){
+// SYNOPSIS:                                                            
+//   Breakpoints of the most likely segmentations with 'nfirst' to      
+//   'nlast' breaks (see 'get_breakpoints'), from the checkpoints of    
+//   'DPcheckpoints'. The back pointers are computed again from the     
+//   checkpoints, 'step' levels at a time starting from the highest,    
+//   and all the segmentations are followed down through each block.    
+//                                                                      
+// PARAMETERS:                                                          
+//   '*llikmat': banded matrix of maximum log-likelihood values.        
+//   'n': row/col number of 'llikmat'.                                  
+//   'band': number of diagonals stored in 'llikmat'.                   
+//   'MAXBREAKS': The maximum number of breakpoints.                    
+//   'step', '*checkpoints': computed by 'DPcheckpoints'.               
+//   'nfirst', 'nlast': the numbers of breaks.                          
+//   'ctx': the context of the call (see header file).                  
+//        -- output arguments --                                        
+//   '*breakpoints': array of 'n' x ('nlast'-'nfirst'+1) elements. The  
+//        element 'j+(nbreaks-nfirst)*n' is set to 1 if 'j' is a        
+//        breakpoint of the segmentation with 'nbreaks' breaks, and to  
+//        0 otherwise.                                                  
+//   '*times': time spent per number of breaks, incremented (NULL if    
+//        not used).                                                    
+//                                                                      
+// RETURN:                                                              
+//   'void'                                                             
+//                                                                      
+// SIDE-EFFECTS:                                                        
+//   Update 'breakpoints' in place.                                     
+//                                                                      
+
+   int i;
+   int k;
+   size_t t;
+
+   const int ntraces = nlast-nfirst+1;
+   for (t = 0 ; t < (size_t) n*ntraces ; t++) breakpoints[t] = 0;
+
+   // Current number of breaks and end of each segmentation. If there
+   // is no segmentation of [0,n-1] with 'nbreaks' breaks, the one with
+   // the highest number of breaks below is used instead ('found' is 0
+   // until it is).
+   int *level = (int *) malloc(ntraces * sizeof(int));
+   int *end = (int *) malloc(ntraces * sizeof(int));
+   char *found = (char *) malloc(ntraces * sizeof(char));
+   int top = 0;
+   for (i = 0 ; i < ntraces ; i++) {
+      level[i] = nfirst+i < MAXBREAKS-1 ? nfirst+i : MAXBREAKS-1;
+      end[i] = n-1;
+      found[i] = 0;
+      if (level[i] > top) top = level[i];
+   }
+
+   double *row = (double *) malloc(n * sizeof(double));
+   int *backtrack = (int *) malloc((size_t) n*step * sizeof(int));
+
+   for (k = (top-1)/step ; top > 0 && k >= 0 ; k--) {
+      int first = k*step+1;
+      int last = (k+1)*step+1 < top+1 ? (k+1)*step+1 : top+1;
+      for (i = 0 ; i < n ; i++) row[i] = checkpoints[i+(size_t) k*n];
+      for (t = 0 ; t < (size_t) n*(last-first) ; t++) backtrack[t] = -1;
+      walk_levels(llikmat, n, band, first, last, ctx, row, NULL,
+            backtrack, times);
+      for (i = 0 ; i < ntraces ; i++) {
+         for ( ; level[i] >= first ; level[i]--) {
+            int j = backtrack[end[i]+(size_t) (level[i]-first)*n];
+            if (!found[i] && j < 0) continue;
+            found[i] = 1;
+            end[i] = j;
+            breakpoints[j+(size_t) i*n] = 1;
          }
       }
+   }
 
-      // Wait for threads to return.
-      for (i = 0 ; i < n_threads ; i++) {
-         pthread_join(tid[i], NULL);
-      }
+   free(level);
+   free(end);
+   free(found);
+   free(row);
+   free(backtrack);
 
-      // Update full log-likelihoods.
-      mllik[nbreaks] = new_llik[n-1];
+   return;
 
-      // Record breakpoints.
-      for (i = 0 ; i < n ; i++) {
-         old_llik[i] = new_llik[i];
-         breakpoints[i+nbreaks*n] = new_bkpt_list[n-1+i*n];
-      }
+}
 
-   }
+void
+get_breakpoints(
+  // input //
+  const int *backtrack,
+  const int n,
+  const int nbreaks,
+  // output //
+  int *breakpoints
+){
+// SYNOPSIS:                                                            
+//   Follow the back pointers of 'DPwalk' to retrieve the breakpoints   
+//   of the most likely segmentation with 'nbreaks' breaks. If no       
+//   such segmentation exists, the most likely segmentation with the    
+//   highest number of breaks below 'nbreaks' is used instead.          
+//                                                                      
+// PARAMETERS:                                                          
+//   '*backtrack': back pointers computed by 'DPwalk'.                  
+//   'n': row/col number of the matrix of log-likelihood.               
+//   'nbreaks': the number of breakpoints.                              
+//        -- output arguments --                                        
+//   '*breakpoints': array of 'n' elements, set to 1 at breakpoints     
+//        and to 0 elsewhere.                                           
+//                                                                      
+// RETURN:                                                              
+//   'void'                                                             
+//                                                                      
+// SIDE-EFFECTS:                                                        
+//   Update 'breakpoints' in place.                                     
+//                                                                      
 
-   free(tid);
-   free(new_bkpt_list);
-   free(old_bkpt_list);
+   int i;
+   int j = n-1;
+   int nb = nbreaks;
+
+   for (i = 0 ; i < n ; i++) breakpoints[i] = 0;
+   while ((nb > 0) && (backtrack[n-1+(size_t) nb*n] < 0)) nb--;
+   for ( ; nb > 0 ; nb--) {
+      j = backtrack[j+(size_t) nb*n];
+      breakpoints[j] = 1;
+   }
 
    return;
 
@@ -453,8 +1087,9 @@ fill_llikmat(
 //   Compute the log-likelihood of the slices. The element (i,j) of     
 //   the matrix 'llikmat' will contain the log-likelihood  of the       
 //   slice starting at i and ending at j. the matrix is initialized     
-//   with nan because not all elements will be computed. The lower      
-//   triangular part is left out.                                       
+//   with nan because not all elements will be computed. Only the       
+//   'band' first diagonals of the upper triangular part are stored     
+//   (see the 'BAND' macro).                                            
 //                                                                      
 // PARAMETERS:                                                          
 //   'arg': thread arguments (see header file for definition).          
@@ -469,88 +1104,116 @@ fill_llikmat(
    llworker_arg *myargs = (llworker_arg *) arg;
    const int n = myargs->n;
    const int m = myargs->m;
+   const int band = myargs->band;
+   const obsmap *map = myargs->map;
    const int **k = (const int **) myargs->k;
-   const double *d = (const double*) myargs->d;
-   const double **w = (const double **) myargs->w;
-   const double **lg= (const double **) myargs->lg;
+   const double **rs = (const double **) myargs->rs;
+   const diagsum **ps = (const diagsum **) myargs->ps;
    const char *skip = (const char *) myargs->skip;
    double *llikmat = myargs->llikmat;
    const int verbose = myargs->verbose;
+   tadbit_context *ctx = myargs->ctx;
 
    int i;
    int j;
    int l;
 
-   // Cache to speed up computation. Get the max of '_cache_index'
-   // in order to allocate the right size.
-   double *c= (double *) malloc(_max_cache_index * sizeof(double));
-   for (i = 0 ; i < _max_cache_index ; i++) c[i] = 0.0;
+   // Sums per distance and cache to speed up computation. Their size
+   // is stored in 'map'.
+   diagsum *agg = (diagsum *) malloc(map->ncache * sizeof(diagsum));
+   int *dist = (int *) malloc(map->ncache * sizeof(int));
+   double *c= (double *) malloc(map->ncache * sizeof(double));
+   for (i = 0 ; i < map->ncache ; i++) c[i] = 0.0;
 
-   int job_index;
+   size_t job_index;
+   long n_iter = 0;
+   const size_t n_jobs = (size_t) n*band;
    
    // Break out of the loop when task queue is empty.
    while (1) {
 
-      pthread_mutex_lock(&tadbit_lock);
-      while ((taskQ_i < n*n) && (skip[taskQ_i] > 0)) {
-         // Fast forward to the next job.
-         taskQ_i++;
-      }
-      if (taskQ_i >= n*n) {
+      // Claim 'LLIK_CHUNK' jobs at once (skipped jobs included).
+      size_t first = __sync_fetch_and_add(&ctx->taskQ_i, LLIK_CHUNK);
+      if (first >= n_jobs) {
          // Task queue is empty. Exit loop and return
-         pthread_mutex_unlock(&tadbit_lock);
          break;
       }
-      job_index = taskQ_i;
-      taskQ_i++;
-      pthread_mutex_unlock(&tadbit_lock);
-
-      // Compute the log-likelihood of slice '(i,j)'.
-      i = job_index % n;
-      j = job_index / n;
-
-      // Make sure that slices have minimum width 3.
-      int cornered = (i == 1) || (i == 2) || (j == n-2) || (j == n-3);
-      int slice_too_thin = (j-i) < 2;
-      if (cornered || slice_too_thin) continue;
-
-      // Distinct parts of the array, no lock needed.
-      llikmat[i+j*n] = 0.0;
-      for (l = 0 ; l < m ; l++) {
-         // LABEL: slice ll summation.
-         llikmat[i+j*n] += 
-            ll(n,   0, i-1, i, j, 0, k[l], d, w[l], lg[l], c) / 2 +
-            ll(n,   i,   j, i, j, 1, k[l], d, w[l], lg[l], c) +
-            ll(n, j+1, n-1, i, j, 0, k[l], d, w[l], lg[l], c) / 2;
-      }
+      size_t last = first+LLIK_CHUNK < n_jobs ? first+LLIK_CHUNK : n_jobs;
+
+      for (job_index = first ; job_index < last ; job_index++) {
+         if (skip[job_index] > 0) continue;
+
+         // Compute the log-likelihood of slice '(i,j)'.
+         j = job_index / band;
+         i = j - job_index % band;
+
+         // Make sure that slices have minimum width 3.
+         int cornered = (i == 1) || (i == 2) || (j == n-2) || (j == n-3);
+         int slice_too_thin = (j-i) < 2;
+         if (cornered || slice_too_thin) continue;
+
+         // Distinct parts of the array, no lock needed.
+         llikmat[job_index] = 0.0;
+         for (l = 0 ; l < m ; l++) {
+            // LABEL: slice ll summation.
+            llikmat[job_index] += 
+               ll(  0, i-1, i, j, 0, map, k[l], rs[l], ps[l],
+                     agg, dist, c, &n_iter) / 2 +
+               ll(  i,   j, i, j, 1, map, k[l], rs[l], ps[l],
+                     agg, dist, c, &n_iter) +
+               ll(j+1, n-1, i, j, 0, map, k[l], rs[l], ps[l],
+                     agg, dist, c, &n_iter) / 2;
+         }
 
-      n_processed++;
-      if (verbose) {
-         fprintf(stderr, "computing likelihood (%0.f%% done)\r",
-            99 * n_processed / (float) n_to_process);
+         int done = __sync_add_and_fetch(&ctx->n_processed, 1);
+         if (verbose) {
+            fprintf(stderr, "computing likelihood (%0.f%% done)\r",
+               99 * done / (float) ctx->n_to_process);
+         }
       }
    }
 
+   __sync_fetch_and_add(&ctx->n_newton, n_iter);
+
+   free(agg);
+   free(dist);
    free(c);
    return NULL;
 
 }
 
+void
+report_likelihood(
+   void *arg
+){
+// SYNOPSIS:                                                            
+//   Report the progress of the computation of the log-likelihoods to   
+//   the progress callback of the context 'arg' (see header file).      
+//                                                                      
+
+   tadbit_context *ctx = (tadbit_context *) arg;
+   ctx->progress(ctx->progress_data, "likelihood", ctx->n_processed,
+         ctx->n_to_process);
+
+}
+
 void
 allocate_heur_job(
   char *skip,
   const int i0,
   const int j0,
-  const int n
+  const int n,
+  const int band
 ){
 // SYNOPSIS:                                                            
 //   Create or update thread jobs (used in pre-heuristic).
 //                                                                      
 // PARAMETERS:                                                          
-//   'skip': the job matrix to update in place.                         
+//   'skip': the (banded) job matrix to update in place.                
 //   'i0': start position of the approximate TAD.                       
 //   'j0': end position of the approximate TAD.                         
 //   'n': number of rows/columns of the hiC matrix (or 'skip').         
+//   'band': number of diagonals stored in 'skip'.                      
 //                                                                      
 // RETURN:                                                              
 //   'void'                                                             
@@ -564,17 +1227,18 @@ allocate_heur_job(
 
    for (j = j0-2 ; j < j0+3 ; j++)
    for (i = i0-2 ; i < i0+3 ; i++)
-      if ((i+j*n > 0) && (i+j*n < n*n)) skip[i+j*n] = 0;
+      if ((i >= 0) && (j < n) && (i <= j) && (j-i < band))
+         skip[BAND(i,j,band)] = 0;
 
 }
 
 void
 allocate_new_jobs(
   char *skip,
-  const int *bkpts,
-  const int MAXBREAKS,
-  const int nbreaks_opt,
-  const int n
+  const int *breakpoints,
+  const int ntraces,
+  const int n,
+  const int band
 ){
 // SYNOPSIS:                                                            
 //   Create or update thread jobs. For an approximate TAD defined by    
@@ -583,8 +1247,11 @@ allocate_new_jobs(
 //                                                                      
 // PARAMETERS:                                                          
 // TODO Update parameters
-//   'skip': the job matrix to update in place.                         
+//   'skip': the (banded) job matrix to update in place.                
+//   'breakpoints': 'ntraces' segmentations around the optimal one      
+//        (see 'DPtrace').                                              
 //   'n': number of rows/columns of the hiC matrix (or 'skip').         
+//   'band': number of diagonals stored in 'skip'.                      
 //                                                                      
 // RETURN:                                                              
 //   'void'                                                             
@@ -597,7 +1264,7 @@ allocate_new_jobs(
    int j;
    int i0;
    int j0;
-   int shift;
+   int l;
    char *starts = (char*) malloc(n* sizeof(char));
    char *ends = (char*) malloc(n* sizeof(char));
    for (i = 0 ; i < n ; i++) {
@@ -605,17 +1272,16 @@ allocate_new_jobs(
       ends[i] = 0;
    }
    
-   for (shift = -10 ; shift < 11 ; shift++) {
-      if (shift+nbreaks_opt < 0) continue;
-      if (shift+nbreaks_opt > MAXBREAKS-1) break;
+   for (l = 0 ; l < ntraces ; l++) {
+      const int *bkpts = breakpoints + (size_t) l*n;
       for (i0 = 0, j0 = 0 ; j0 < n ; j0++) {
-         if (bkpts[j0+(shift+nbreaks_opt)*n]) {
+         if (bkpts[j0]) {
 
             // Jobs for splitting the TAD.
             for (j = i0 ; j < j0 ; j++)
-               skip[i0+j*n] = 0;
+               if (j-i0 < band) skip[BAND(i0,j,band)] = 0;
             for (i = i0 ; i < j0 ; i++)
-               skip[i+j0*n] = 0;
+               if (j0-i < band) skip[BAND(i,j0,band)] = 0;
 
             starts[i0] = 1;
             ends[j0] = 1;
@@ -627,31 +1293,141 @@ allocate_new_jobs(
    // Jobs for merging the TADs.
    for (i = 0 ; i < n ; i++)
    for (j = 0 ; j < n ; j++)
-      if (starts[i] && ends[j] && (j-i < 500) && (i < j))
-         skip[i+j*n] = 0;
+      if (starts[i] && ends[j] && (j-i < 500) && (j-i < band) && (i < j))
+         skip[BAND(i,j,band)] = 0;
 
    free(starts);
    free(ends);
 
 }
 
+void
+allocate_prior_jobs(
+  char *skip,
+  const int *groups,
+  const int n,
+  const int band
+){
+// SYNOPSIS:                                                            
+//   Create thread jobs for the slices starting and ending close to     
+//   prior boundaries, e.g. found at a coarser resolution. Boundaries   
+//   are numbered in order, and the rows/columns close to a boundary    
+//   form a group with its number. A slice is computed if it starts     
+//   after a row of group 'ga' (or at the first row) and ends at a row  
+//   of group 'gb' (or at the last row) with 0 <= 'gb'-'ga' <=          
+//   'PRIOR_SPAN'.                                                      
+//                                                                      
+// PARAMETERS:                                                          
+//   'skip': the (banded) job matrix to update in place.                
+//   'groups': the group of each row/column (0 if none).                
+//   'n': number of rows/columns of the hiC matrix (or 'skip').         
+//   'band': number of diagonals stored in 'skip'.                      
+//                                                                      
+// RETURN:                                                              
+//   'void'                                                             
+//                                                                      
+// SIDE-EFFECTS:                                                        
+//   Update 'skip' in place.                                            
+//                                                                      
+
+   int i;
+   int j;
+   int last_group = 0;
+   size_t t;
+
+   for (i = 0 ; i < n ; i++) {
+      if (groups[i] > last_group) last_group = groups[i];
+   }
+
+   for (t = 0 ; t < (size_t) n*band ; t++) skip[t] = 1;
+
+   for (j = 0 ; j < n ; j++) {
+      // The last row ends the last slice whatever its group.
+      int gb = j == n-1 ? last_group+1 : groups[j];
+      if (gb == 0) continue;
+      for (i = j-band+1 > 0 ? j-band+1 : 0 ; i < j ; i++) {
+         int ga = i == 0 ? 0 : groups[i-1];
+         if ((ga == 0 && i > 0) || gb < ga || gb-ga > PRIOR_SPAN) continue;
+         skip[BAND(i,j,band)] = 0;
+      }
+   }
+
+   return;
+
+}
+
+void
+erase_lower_triangle(
+  char *skip,
+  const int n,
+  const int band
+){
+// SYNOPSIS:                                                            
+//   Skip the cells of the banded job matrix 'skip' that are on the     
+//   diagonal or outside of the matrix (first columns).                 
+//                                                                      
+// SIDE-EFFECTS:                                                        
+//   Update 'skip' in place.                                            
+//                                                                      
+
+   int i;
+   int j;
+
+   for (j = 0 ; j < n ; j++)
+   for (i = j-band+1 ; i <= j ; i++)
+      if ((i < 0) || (i == j)) skip[BAND(i,j,band)] = 1;
+
+}
+
 void
 tadbit(
   // input //
   int **obs,
   int n,
   const int m,
+  const int triangle,
   int n_threads,
   const int verbose,
   int max_tad_size,
   const int do_not_use_heuristic,
   const int use_visibility,
+  const int *prior,
+  const double *cache,
+  const size_t ncache,
+  tadbit_progress progress,
+  void *progress_data,
   // output //
   tadbit_output *seg
 )
 // TODO: write synopsis.
+// 'triangle' tells whether the matrices 'obs' are stored as their upper
+// triangular part (see the 'TRI' macro) or in full.
+// 'prior' (NULL if not used) gives, for each row/column of the original
+// matrices, the number of the prior boundary it is close to (0 if it
+// is not close to any), see 'allocate_prior_jobs'.
+// 'cache' (NULL if not used) is the log-likelihood matrix returned by a
+// previous call on the same matrices, of 'ncache' values (the number of
+// rows/columns kept times the number of diagonals, see the 'BAND'
+// macro). The slices found in it are not recomputed.
+// The log-likelihood matrix 'seg->llikmat' is returned for the 'seg->n'
+// rows/columns kept only (their index in the original matrices is
+// 'seg->pos'), so that its size does not depend on the rows/columns
+// removed.
+// 'progress' (NULL if not used) is called with 'progress_data' from
+// the calling thread at the end of the pre-heuristic, regularly while
+// computing the log-likelihoods and during the confidence computation.
+// Wall times and counts are stored in 'seg->stats'.
 {
 
+   double t0 = wall_time();
+   double t1;
+   tadbit_stats stats = {
+      .t_llik = NULL,
+      .n_llik = NULL,
+      .t_dp = NULL,
+   };
+   seg->stats = stats;
+
    // Get thread number if set to 0 (max).
    if (n_threads < 1) {
       #ifdef _SC_NPROCESSORS_ONLN
@@ -661,36 +1437,39 @@ tadbit(
       #endif
    }
 
+   // The same threads run all the parallel jobs below.
+   tadbit_context ctx = {
+      .pool = create_pool(n_threads),
+      .taskQ_i = 0,
+      .n_processed = 0,
+      .n_to_process = 0,
+      .n_newton = 0,
+      .progress = progress,
+      .progress_data = progress_data,
+   };
+   if (ctx.pool == NULL) {
+      fprintf(stderr, "error creating thread pool\n");
+      // Signal failure.
+      seg->maxbreaks = -2;
+      return;
+   }
+
    const int N = n;   // Original size.
-   int err;           // Used for error checking.
 
    int i;
    int j;
    int k;
    int l;
    int i0;
+   size_t t;
 
 
-   // Allocate memory and initialize variables. The distance
-   // matrix 'dist' is the distance to the main diagonal. Every
-   // element of coordinate (i,j) is on a diagonal; the distance
-   // is the log-shift to the main diagonal 'i-j'.
-
-   double *init_dist = (double *) malloc(N*N * sizeof(double));
-
-   for (l = 0, i = 0; i < N ; i++) {
-   for (j = 0; j < N ; j++) {
-      init_dist[l] = log(abs(i-j));
-      l++;
-   }
-   }
-
    // Simplify input. Remove line and column if 0 on the diagonal.
    char *remove = (char *) malloc (N * sizeof(char));
    for (i = 0 ; i < N ; i++) {
       remove[i] = 0;
       for (k = 0 ; k < m ; k++) {
-         if (obs[k][i+i*N] < 1) {
+         if (cell(obs[k], i, i, N, triangle) < 1) {
             remove[i] = 1;
          }
       }
@@ -703,46 +1482,46 @@ tadbit(
       n -= remove[i];
    }
 
-   if (n < 6) {
+   if (n < 6 || (cache != NULL && (ncache == 0 || ncache % n != 0))) {
       // Signal failure.
-      seg->maxbreaks = -1;
+      seg->maxbreaks = n < 6 ? -1 : -3;
       // Clean before exit.
-      free(init_dist);
       free(remove);
+      destroy_pool(ctx.pool);
       // Bye-bye.
       return;
    }
+   const int cache_band = cache != NULL ? ncache / n : 0;
 
    const int MAXBREAKS = n/5;
 
-   _cache_index = (int *) malloc(n*n * sizeof(int));
-   _max_cache_index = N+1;
-   // Allocate and copy.
-   double **log_gamma = (double **) malloc(m * sizeof(double *));
-   int **new_obs = (int **) malloc(m * sizeof(int *));
-   double *dist = (double *) malloc(n*n * sizeof(double));
-   for (k = 0 ; k < m ; k++) {
-      l = 0;
-      log_gamma[k] = (double *) malloc(n*n * sizeof(double));
-      new_obs[k] = (int *) malloc(n*n * sizeof(int));
-      for (j = 0 ; j < N ; j++) {
-      for (i = 0 ; i < N ; i++) {
-         if (remove[i] || remove[j]) continue;
-         _cache_index[l] = i > j ? i-j : j-i;
-         log_gamma[k][l] = lgamma(obs[k][i+j*N]+1);
-         new_obs[k][l] = obs[k][i+j*N];
-         dist[l] = init_dist[i+j*N];
-         l++;
-      }
-      }
+   // Without the heuristic, only the slices shorter than 'max_tad_size'
+   // are computed, so that only the 'band' first diagonals of the
+   // matrices of log-likelihood and jobs are stored. With the heuristic,
+   // 'max_tad_size' is not used and the full upper triangle is stored.
+   int band = n;
+   if (do_not_use_heuristic && max_tad_size < n-1) {
+      band = max_tad_size < 0 ? 1 : max_tad_size+1;
    }
 
-   // We will not need the initial observations any more.
-   free(init_dist);
-   obs = new_obs;
+   // The observations are not copied. Instead, 'pos' gives the index
+   // of the rows/columns kept in the original matrices. The distance
+   // of every element of coordinate (i,j) to the main diagonal is the
+   // log-shift 'log(|i-j|)' in the original matrices.
+   int *pos = (int *) malloc(n * sizeof(int));
+   for (l = 0, i = 0 ; i < N ; i++) {
+      if (!remove[i]) pos[l++] = i;
+   }
+   double *logd = (double *) malloc(N * sizeof(double));
+   for (i = 0 ; i < N ; i++) logd[i] = log(i);
 
+   t1 = wall_time();
+   stats.t_input = t1 - t0;
+   stats.n_threads = n_threads;
 
-   // Compute row/column sums (identical by symmetry).
+   // Compute row/column sums (identical by symmetry). The weights
+   // of the cells are computed from the sums on demand (see 'weight').
+   int maxcount = 0;
    double **rowsums = (double **) malloc(m * sizeof(double *));
    for (k = 0 ; k < m ; k++) {
       rowsums[k] = (double *) malloc(n * sizeof(double));
@@ -751,156 +1530,181 @@ tadbit(
 
    for (i = 0 ; i < n ; i++)
    for (k = 0 ; k < m ; k++)
-   for (l = 0 ; l < n ; l++)
-      rowsums[k][i] += obs[k][i+l*n];
+   for (l = 0 ; l < n ; l++) {
+      int count = cell(obs[k], pos[i], pos[l], N, triangle);
+      rowsums[k][i] += count;
+      if (count > maxcount) maxcount = count;
+   }
 
-   // Compute the weights.
-   double **weights = (double **) malloc(m * sizeof(double *));
+   // Tabulate the log-gamma terms of the counts (up to the largest one).
+   int nlgtab = maxcount < LGAMMA_TABLE ? maxcount+1 : LGAMMA_TABLE;
+   double *lgtab = (double *) malloc(nlgtab * sizeof(double));
+   for (i = 0 ; i < nlgtab ; i++) lgtab[i] = lgamma(i+1);
+
+   const obsmap map = {
+      .N = N,
+      .triangle = triangle,
+      .pos = pos,
+      .logd = logd,
+      .lgtab = lgtab,
+      .nlgtab = nlgtab,
+      .use_visibility = use_visibility,
+      .ncache = N+1,
+   };
+
+   // When the full upper triangle is stored anyway, also tabulate the
+   // prefix sums of the cells along the diagonals, so that the sums per
+   // distance of the blocks are not recomputed cell by cell. They take
+   // N*N 'diagsum' per matrix, and are not used above 'PREFIX_BUDGET'.
+   const int use_prefix = band >= n &&
+      (size_t) m*N*N * sizeof(diagsum) <= PREFIX_BUDGET;
+   diagsum **prefix = (diagsum **) malloc(m * sizeof(diagsum *));
    for (k = 0 ; k < m ; k++) {
-      weights[k] = (double *) malloc(n*n * sizeof(double));
-      for (i = 0 ; i < n*n ; i++) weights[k][i] = 0.0;
-      // Compute scalar product.
-      for (j = 0 ; j < n ; j++) {
-      for (i = 0 ; i < n ; i++) {
-         // TODO: test whether second normalization makes more
-         // sense and remove the square root normalization.
-         //weights[k][i+j*n] = sqrt(rowsums[k][i]*rowsums[k][j]);
-         //weights[k][i+j*n] = rowsums[k][i]*rowsums[k][j] / totalsum[k];
-         if (use_visibility) {
-           //weights[k][i+j*n] = rowsums[k][i]*rowsums[k][j] / totalsum[k];
-           weights[k][i+j*n] = rowsums[k][i]*rowsums[k][j];
-         }
-         else {
-           weights[k][i+j*n] = sqrt(rowsums[k][i]*rowsums[k][j]);
-         }
-      }
-      }
+      prefix[k] = NULL;
+      if (!use_prefix) continue;
+      prefix[k] = (diagsum *) malloc((size_t) N*N * sizeof(diagsum));
+      diagonal_prefix_sums(n, &map, obs[k], rowsums[k], prefix[k]);
    }
 
-   // We don't need the row/column sums any more.
-   for (l = 0 ; l < m ; l++) free(rowsums[l]);
-   free(rowsums);
+   stats.t_weights = wall_time() - t1;
+   stats.n_dp = MAXBREAKS;
+   stats.t_dp = (double *) malloc(MAXBREAKS * sizeof(double));
+   for (i = 0 ; i < MAXBREAKS ; i++) stats.t_dp[i] = 0.0;
 
    double *mllik = (double *) malloc(MAXBREAKS * sizeof(double));
-   int *bkpts = (int *) malloc(MAXBREAKS*n * sizeof(int));
-   double *llikmat = (double *) malloc(n*n * sizeof(double));
-   for (i = 0 ; i < n*n ; i++)
-      llikmat[i] = NAN;
+   // Breakpoints of a segmentation (1 at breakpoints, 0 elsewhere).
+   int *bkpts = (int *) malloc(n * sizeof(int));
+   // The back pointers of all the numbers of breaks take 'n' x
+   // 'MAXBREAKS' int. Only the log-likelihoods of a number of breaks
+   // every 'step' are kept, and the back pointers are computed again
+   // 'step' levels at a time (see 'DPcheckpoints' and 'DPtrace').
+   int step = (int) ceil(sqrt(MAXBREAKS));
+   double *checkpoints =
+      (double *) malloc((size_t) n*((MAXBREAKS-2)/step+1) * sizeof(double));
+   // Segmentations around the optimal one.
+   int *traces = (int *) malloc((size_t) n*21 * sizeof(int));
+   double *llikmat = (double *) malloc((size_t) n*band * sizeof(double));
+   for (t = 0 ; t < (size_t) n*band ; t++)
+      llikmat[t] = NAN;
 
    // 'skip' will contain only 0 or 1 and can be stored as 'char'.
-   char *skip = (char *) malloc(n*n * sizeof(char));
+   char *skip = (char *) malloc((size_t) n*band * sizeof(char));
 
    // Use the heuristic by default (hence the name of the parameter).
    // The parameter 'max_tad_size' is needed only in case the heuristic
-   // is not used.
-   if (do_not_use_heuristic) {
-      for (j = 0 ; j < n ; j++)
-      for (i = 0 ; i < n ; i++)
-         // Also sets the lower triangular part of 'skip'.
-         skip[i+j*n] = (i >= j) || ((j-i) > max_tad_size) ? 1 : 0;
+   // is not used (it is then the width of the band). Prior boundaries
+   // (found at a coarser resolution) replace the heuristic.
+   if (prior != NULL) {
+      int *groups = (int *) malloc(n * sizeof(int));
+      for (i = 0 ; i < n ; i++) groups[i] = prior[pos[i]];
+      allocate_prior_jobs(skip, groups, n, band);
+      free(groups);
+   }
+   else if (do_not_use_heuristic) {
+      for (t = 0 ; t < (size_t) n*band ; t++) skip[t] = 0;
+      erase_lower_triangle(skip, n, band);
    }
    else {
       if (verbose) {
          fprintf(stderr, "running pre-heuristic\n");
       }
+      t1 = wall_time();
 
-      for (i = 0 ; i < n*n ; i++) skip[i] = 1;
+      for (t = 0 ; t < (size_t) n*band ; t++) skip[t] = 1;
 
-      // 'S[i+j*n]' is the weighted sum of reads within the triangle
-      // defined by ('i','j') in the upper triangular matrix of
-      // observations.
-      double *S = (double *) malloc(n*n * sizeof(double));
-      for (i = 0 ; i < n*n ; i++) S[i] = 0.0;
-      for (j = 1 ; j < n ; j++) {
+      // 'S[BAND(i,j,band)]' is the weighted sum of reads within the
+      // triangle defined by ('i','j') in the upper triangular matrix
+      // of observations.
+      double *S = (double *) malloc((size_t) n*band * sizeof(double));
+      for (t = 0 ; t < (size_t) n*band ; t++) S[t] = 0.0;
+      for (j = 1 ; j < band ; j++) {
       for (i = 0 ; i < n-j ; i++) {
          double weighted_value = 0.0;
          for (l = 0 ; l < m ; l++)
-            weighted_value += obs[l][i+(i+j)*n]/weights[l][i+(i+j)*n];
-         S[i+(i+j)*n] = S[i+(i+j-1)*n] + S[i+1+(i+j)*n] -
-            S[i+1+(i+j-1)*n] + weighted_value;
+            weighted_value += cell(obs[l], pos[i], pos[i+j], N, triangle) /
+               weight(use_visibility, rowsums[l][i], rowsums[l][i+j]);
+         // The cell below the diagonal (for 'j' = 1) is 0.
+         S[BAND(i,i+j,band)] = S[BAND(i,i+j-1,band)] +
+            S[BAND(i+1,i+j,band)] -
+            (j > 1 ? S[BAND(i+1,i+j-1,band)] : 0.0) + weighted_value;
       }
       }
 
-      double *heur_score = (double *) malloc(n*n * sizeof(double));
-      for (i = 0 ; i < n*n ; i++) heur_score[i] = NAN;
+      double *heur_score = (double *) malloc((size_t) n*band * sizeof(double));
+      for (t = 0 ; t < (size_t) n*band ; t++) heur_score[t] = NAN;
       for (j = 1 ; j < n ; j++)
-      for (i = 0 ; i < j ; i++)
-        heur_score[i+j*n] = log(S[i+j*n]);
+      for (i = j-band+1 > 0 ? j-band+1 : 0 ; i < j ; i++)
+        heur_score[BAND(i,j,band)] = log(S[BAND(i,j,band)]);
 
       // Use dynamic programming to find approximate break points.
       // The matrix 'mllik' is used only to make the function call valid
       // (it is updated in place, but the value is disregarded), and
       // the heuristic score 'heur_score' plays the role of the
       // log-likelihood 'llikmat'.
-      DPwalk(heur_score, n, MAXBREAKS, n_threads, mllik, bkpts);
+      // The full upper triangle is stored in this case, so all the back
+      // pointers are kept.
+      int *backtrack = (int *) malloc((size_t) MAXBREAKS*n * sizeof(int));
+      DPwalk(heur_score, n, band, MAXBREAKS, &ctx, mllik, backtrack,
+            NULL);
 
       free(heur_score);
       free(S);
 
       // Create a thread job for each approximate TAD.
-      for (i = 0 ; i < n*n ; i++) skip[i] = 1;
+      for (t = 0 ; t < (size_t) n*band ; t++) skip[t] = 1;
       for (j = 1 ; j < MAXBREAKS ; j++) {
          i0 = 0;
+         get_breakpoints(backtrack, n, j, bkpts);
          for (i = 0 ; i < n ; i++) {
-            if (bkpts[i+j*n]) {
-               allocate_heur_job(skip, i0, i, n);
+            if (bkpts[i]) {
+               allocate_heur_job(skip, i0, i, n, band);
                i0 = i+1;
             }
          }
       }
+      free(backtrack);
 
       // Erase the lower triangular part of 'skip'.
-      for (j = 0 ; j < n ; j++)
-      for (i = j ; i < n ; i++)
-         skip[i+j*n] = 1;
+      erase_lower_triangle(skip, n, band);
 
       // Allocate estimation of the log likelihood for all small
       // TADs (less than 3 bins).
       for (j = 6 ; j < n ; j++)
       for (i = j-6 ; i < j-3 ; i++)
-         skip[i+j*n] = 0;
+         if (j-i < band) skip[BAND(i,j,band)] = 0;
 
       // Allocate jobs at the ends of the chromosomes/units because
       // these regions are a bit noisier.
       for (j = 1 ; j < 51 ; j++)
       for (i = 0 ; i < j-3 ; i++)
-         if (i < n && j < n) skip[i+j*n] = 0;
+         if (i < n && j < n && j-i < band) skip[BAND(i,j,band)] = 0;
       for (j = n-51 ; j < n ; j++)
       for (i = n-51 ; i < j-3 ; i++)
-         if (i > 0 && j > 0) skip[i+j*n] = 0;
+         if (i > 0 && j > 0 && j-i < band) skip[BAND(i,j,band)] = 0;
 
       // Reset lower triangular part of 'skip'.
-      for (j = 0 ; j < n ; j++)
-      for (i = j ; i < n ; i++)
-         skip[i+j*n] = 1;
+      erase_lower_triangle(skip, n, band);
 
-   } // End of pre-heuristic.
+      stats.t_heuristic = wall_time() - t1;
+      if (progress != NULL) progress(progress_data, "heuristic", 1, 1);
 
+   } // End of pre-heuristic.
 
-   // Allocate 'tid'.
-   pthread_t *tid = (pthread_t *) malloc(n_threads * sizeof(pthread_t));
 
    llworker_arg arg = {
       .n = n,
       .m = m,
+      .band = band,
+      .map = &map,
       .k = (const int **) obs,
-      .d = dist,
-      .w = (const double **) weights,
-      .lg = (const double **) log_gamma,
+      .rs = (const double **) rowsums,
+      .ps = (const diagsum **) prefix,
       .skip = skip,
       .llikmat = llikmat,
       .verbose = verbose,
+      .ctx = &ctx,
    };
 
-   err = pthread_mutex_init(&tadbit_lock, NULL);
-   if (err) {
-      fprintf(stderr, "error initializing mutex (%d)\n", err);
-      // Signal failure.
-      seg->maxbreaks = -1;
-      // TODO: free memory before exit.
-      return;
-   }
-
    int n_params;
    int nbreaks_opt = 0;
    double AIC = -INFINITY;
@@ -915,40 +1719,52 @@ tadbit(
       AIC = newAIC;
 
       // Initialize task queue.
-      n_to_process = 0;
-      for (i = 0 ; i < n*n ; i++) {
+      ctx.n_to_process = 0;
+      for (t = 0 ; t < (size_t) n*band ; t++) {
+         // Take the jobs of this cycle from the cache if possible.
+         if (cache != NULL && !skip[t] && isnan(llikmat[t])) {
+            j = t / band;
+            i = j - t % band;
+            if (i >= 0 && j-i < cache_band) {
+               llikmat[t] = cache[BAND(i,j,cache_band)];
+               stats.n_cached += !isnan(llikmat[t]);
+            }
+         }
          // Skip all computation done in previous cycles.
-         if (!isnan(llikmat[i])) skip[i] = 1;
-         n_to_process += (1-skip[i]);
+         if (!isnan(llikmat[t])) skip[t] = 1;
+         ctx.n_to_process += (1-skip[t]);
       }
-      n_processed = 0;
-      taskQ_i = 0;
+      ctx.n_processed = 0;
+      ctx.taskQ_i = 0;
       
-      // Instantiate threads and start running jobs.
-      for (i = 0 ; i < n_threads ; i++) tid[i] = 0;
-      for (i = 0 ; i < n_threads ; i++) {
-         err = pthread_create(&(tid[i]), NULL, &fill_llikmat, &arg);
-         if (err) {
-            fprintf(stderr, "error creating thread (%d)\n", err);
-            seg->maxbreaks = -1;
-            // TODO: free memory before exit.
-            return;
-         }
+      // Run the jobs and wait for the threads to finish.
+      t1 = wall_time();
+      if (progress != NULL) {
+         run_pool(ctx.pool, &fill_llikmat, &arg, &report_likelihood, &ctx);
+         // Too thin slices are not counted as processed.
+         progress(progress_data, "likelihood", ctx.n_to_process,
+               ctx.n_to_process);
       }
-
-      // Wait for threads to return.
-      for (i = 0 ; i < n_threads ; i++) {
-         pthread_join(tid[i], NULL);
+      else {
+         run_pool(ctx.pool, &fill_llikmat, &arg, NULL, NULL);
       }
       if (verbose) {
          fprintf(stderr, "computing likelihood (100%% done)\n");
       }
+      stats.n_cycles++;
+      stats.t_llik = (double *) realloc(stats.t_llik,
+            stats.n_cycles * sizeof(double));
+      stats.n_llik = (int *) realloc(stats.n_llik,
+            stats.n_cycles * sizeof(int));
+      stats.t_llik[stats.n_cycles-1] = wall_time() - t1;
+      stats.n_llik[stats.n_cycles-1] = ctx.n_processed;
 
       // The matrix 'llikmat' now contains the log-likelihood of the
       // segments. The breakpoints are found by dynamic programming.
       int maxbreaks = nbreaks_opt ? nbreaks_opt + 11 : MAXBREAKS;
       if (maxbreaks > MAXBREAKS) maxbreaks = MAXBREAKS;
-      DPwalk(llikmat, n, maxbreaks, n_threads, mllik, bkpts);
+      DPcheckpoints(llikmat, n, band, maxbreaks, step, &ctx, mllik,
+            checkpoints, stats.t_dp);
 
       // Get optimal number of breaks by AIC.
       newAIC = -INFINITY;
@@ -959,118 +1775,121 @@ tadbit(
       }
       nbreaks_opt -= 1;
 
-      allocate_new_jobs(skip, bkpts, MAXBREAKS, nbreaks_opt, n);
+      // Segmentations with up to 10 breaks more or less than the optimum
+      // (the optimal one is 'traces + nfirst*n').
+      int nfirst = nbreaks_opt > 10 ? 10 : nbreaks_opt;
+      DPtrace(llikmat, n, band, maxbreaks, step, checkpoints,
+            nbreaks_opt-nfirst, nbreaks_opt+10, &ctx, traces, stats.t_dp);
+      for (i = 0 ; i < n ; i++) bkpts[i] = traces[i+(size_t) nfirst*n];
+
+      allocate_new_jobs(skip, traces, nfirst+11, n, band);
 
    }
 
    AIC = newAIC;
 
-   pthread_mutex_destroy(&tadbit_lock);
    free(skip);
-   free(tid);
-   free(_cache_index);
+
+   // Slices of the band left undefined (not computed or too thin).
+   for (j = 0 ; j < n ; j++)
+   for (i = j-band+1 > 0 ? j-band+1 : 0 ; i < j ; i++) {
+      stats.n_slices++;
+      stats.n_skipped += isnan(llikmat[BAND(i,j,band)]) != 0;
+   }
+
+   free(traces);
 
    // Compute breakpoint confidence by penalized dynamic progamming.
-   double *llikmatcpy = (double *) malloc (n*n * sizeof(double));
+   double *llikmatcpy = (double *) malloc ((size_t) n*band * sizeof(double));
    double *mllikcpy = (double *) malloc(MAXBREAKS * sizeof(double));
-   int *bkptscpy = (int *) malloc(n*MAXBREAKS * sizeof(int));
+   int *bkptscpy = (int *) malloc(n * sizeof(int));
    int *passages = (int *) malloc(n * sizeof(int));
-   for (i = 0 ; i < n*MAXBREAKS ; i++) bkptscpy[i] = bkpts[i];
-   for (i = 0 ; i < n*n ; i++) llikmatcpy[i] = llikmat[i];
+   for (i = 0 ; i < n ; i++) bkptscpy[i] = bkpts[i];
+   for (t = 0 ; t < (size_t) n*band ; t++) llikmatcpy[t] = llikmat[t];
    for (i = 0 ; i < n ; i++) passages[i] = 0;
 
    for (l = 0 ; l < 10 ; l++) {
       i = 0;
       for (j = 0 ; j < n ; j++) {
-         if (bkptscpy[j+nbreaks_opt*n]) {
+         if (bkptscpy[j]) {
             // Apply a constant penalty every time a TAD is present
             // in the final decomposition. The penalty is set to
             // 'm*6' because it is the expected log-likelihood gain
             // for adding a new TAD around the optimum log-likelihood.
-            llikmatcpy[i+j*n] -= m*6;
-            passages[j] += bkpts[j+nbreaks_opt*n];
+            if (j-i < band) llikmatcpy[BAND(i,j,band)] -= m*6;
+            passages[j] += bkpts[j];
             i = j+1;
          }
       }
-      if (i < n) llikmatcpy[i+(n-1)*n] -= m*6;
-      DPwalk(llikmatcpy, n, nbreaks_opt+1, n_threads, mllikcpy, bkptscpy);
+      if (i < n && n-1-i < band) llikmatcpy[BAND(i,n-1,band)] -= m*6;
+      DPcheckpoints(llikmatcpy, n, band, nbreaks_opt+1, step, &ctx,
+            mllikcpy, checkpoints, stats.t_dp);
+      DPtrace(llikmatcpy, n, band, nbreaks_opt+1, step, checkpoints,
+            nbreaks_opt, nbreaks_opt, &ctx, bkptscpy, stats.t_dp);
+      if (progress != NULL) progress(progress_data, "confidence", l+1, 10);
    }
    free(llikmatcpy);
    free(mllikcpy);
+   free(checkpoints);
    free(bkptscpy);
-   
-   // Resize output to match original.
-   int p;
-   double **resized_weights = (double **) malloc(m * sizeof(double *));
-   for (l = 0 ; l < m ; l++) {
-      resized_weights[l] = (double *) malloc(N*N * sizeof(double));
-      for (i = 0 ; i < N*N ; i++) resized_weights[l][i] = 0.0;
+   stats.n_newton = ctx.n_newton;
+   if (ctx.pool->wall > 0) {
+      stats.utilization = ctx.pool->busy / (n_threads * ctx.pool->wall);
    }
+   destroy_pool(ctx.pool);
+   
+   // Resize output to match original. The weights are not returned,
+   // only the row sums from which they are computed (see 'weight').
+   double **resized_rowsums = (double **) malloc(m * sizeof(double *));
    for (k = 0 ; k < m ; k++) {
-      for (l = 0, i = 0 ; i < N ; i++) {
-         if (remove[i]) continue;
-         for (p = 0, j = 0 ; j < N ; j++) {
-            if (remove[j]) continue;
-            resized_weights[k][i+j*N] = weights[k][l+p*n];
-	    p++;
-	 }
-	 l++;
-      }
+      resized_rowsums[k] = (double *) malloc(N * sizeof(double));
+      for (i = 0 ; i < N ; i++) resized_rowsums[k][i] = 0.0;
+      for (l = 0 ; l < n ; l++) resized_rowsums[k][pos[l]] = rowsums[k][l];
    }
 
-   int *resized_bkpts = (int *) malloc(N*MAXBREAKS * sizeof(int));
+   int *resized_bkpts = (int *) malloc(N * sizeof(int));
    int *resized_passages = (int *) malloc(N * sizeof(int));
-   for (i = 0 ; i < N*MAXBREAKS ; i++) resized_bkpts[i] = 0;
+   for (i = 0 ; i < N ; i++) resized_bkpts[i] = 0;
    for (i = 0 ; i < N ; i++) resized_passages[i] = 0;
 
    for (l = 0, i = 0 ; i < N ; i++) {
       if (remove[i]) continue;
       resized_passages[i] = passages[l];
-      for (j = 0 ; j < MAXBREAKS ; j++)
-         resized_bkpts[i+j*N] = bkpts[l+j*n];
+      resized_bkpts[i] = bkpts[l];
       l++;
    }
 
    free(passages);
    free(bkpts);
 
-   double *resized_llikmat = (double *) malloc(N*N * sizeof(double));
-   for (i = 0 ; i < N*N ; i++) {
-      resized_llikmat[i] = NAN;
-   }
-
-   for (l = 0, i = 0 ; i < N ; i++) {
-      if (remove[i]) continue;
-      for (k = 0, j = 0 ; j < N ; j++) {
-         if (remove[j]) continue;
-         resized_llikmat[i+j*N] = llikmat[l+k*n];
-         k++;
-      }
-      l++;
-   }
-
-   free(llikmat);
+   // The log-likelihood is returned as is, for the rows/columns kept
+   // only (with their index 'pos' in the original matrices). Removed
+   // rows/columns would make the band wider in the original matrix.
 
    for (k = 0 ; k < m ; k++) {
-      free(new_obs[k]);
-      free(log_gamma[k]);
-      free(weights[k]);
+      free(rowsums[k]);
+      free(prefix[k]);
    }
-   free(weights);
-   free(new_obs);
-   free(log_gamma);
-   free(dist);
+   free(rowsums);
+   free(prefix);
+   free(lgtab);
+   free(logd);
    free(remove);
 
    // Update output struct.
    seg->m = m;
    seg->maxbreaks = MAXBREAKS;
    seg->nbreaks_opt = nbreaks_opt;
-   seg->weights = resized_weights;
+   seg->n = n;
+   seg->pos = pos;
+   seg->band = band;
+   seg->rowsums = resized_rowsums;
    seg->passages = resized_passages;
-   seg->llikmat = resized_llikmat;
+   seg->llikmat = llikmat;
    seg->mllik = mllik;
    seg->bkpts = resized_bkpts;
+   stats.t_total = wall_time() - t0;
+   seg->stats = stats;
 
    return;
 
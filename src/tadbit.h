@@ -7,47 +7,170 @@
 #include <float.h>
 #include <assert.h>
 #include <pthread.h>
+#include <time.h>
 
 #ifndef _TADBIT_LOADED
 #define _TADBIT_LOADED
 
 #define TOLERANCE 1e-6
 #define MAXITER 10000
+// Counts below this value have their log-gamma term tabulated.
+#define LGAMMA_TABLE 65536
+// Number of tasks claimed at once by a thread: cells of 'llikmat'
+// and end points of the dynamic programming.
+#define LLIK_CHUNK 16
+#define DP_CHUNK 32
+// Number of consecutive intervals between prior boundaries that a
+// slice can span (see 'allocate_prior_jobs').
+#define PRIOR_SPAN 2
+// Seconds between two progress reports while computing likelihoods.
+#define PROGRESS_INTERVAL 0.5
+// Memory (in bytes) that the prefix sums along the diagonals of the
+// matrices can take (see 'diagonal_prefix_sums'). The sums per
+// distance of the blocks are computed cell by cell above.
+#ifndef PREFIX_BUDGET
+#define PREFIX_BUDGET ((size_t) 256 << 20)
+#endif
+
+// Position of the cell ('i','j') of the upper triangular part of a
+// matrix in banded arrays storing only the 'band' first diagonals
+// ('i' <= 'j' < 'i'+'band'). Cells are stored column after column,
+// from the diagonal up.
+#define BAND(i,j,band) ((j)-(i) + (size_t) (j)*(band))
+
+// Position of the cell ('i','j') with 'i' <= 'j' of a 'N' x 'N' matrix
+// of which only the upper triangular part is stored, row after row
+// (layout of the Hi-C store files).
+#define TRI(i,j,N) ((size_t) (i)*(2*(size_t) (N)-(i)+1)/2 + (j)-(i))
+
+// Observations are not copied after removing the empty rows/columns:
+// the values of the cells (distance to the diagonal, weights and
+// log-gamma terms) are computed from the original matrices and from
+// the per-row quantities below.
+typedef struct {
+   int N;                 // Original row/column number.
+   int triangle;          // Matrices stored as upper triangles (see
+                          // the 'TRI' macro), in full otherwise.
+   const int *pos;        // Original index of the rows/columns kept.
+   const double *logd;    // Log-distance to the diagonal.
+   const double *lgtab;   // 'lgamma(k+1)' for counts below 'nlgtab'.
+   int nlgtab;
+   int use_visibility;
+   int ncache;            // Size of the caches of 'fg' and 'poiss_reg'.
+} obsmap;
+
+// Sums over cells of the matrix (number of cells, weights, counts and
+// log-gamma terms of the counts), used to evaluate the likelihood of
+// a block per distance to the diagonal instead of per cell.
+typedef struct {
+   double ncells;
+   double w;
+   double k;
+   double lgam;
+} diagsum;
+
+// Pool of threads created once per call to 'tadbit' and running all
+// the parallel jobs ('fill_llikmat' and 'fill_DP') in turn.
+typedef struct {
+   int n_threads;
+   pthread_t *tid;
+   pthread_mutex_t lock;
+   pthread_cond_t start;      // Signals a new job to the threads.
+   pthread_cond_t done;       // Signals the end of a job.
+   void *(*job)(void *);
+   void *arg;
+   int generation;            // Number of jobs started so far.
+   int running;               // Number of threads running the job.
+   int quit;
+   double busy;               // Time spent by the threads in jobs.
+   double wall;               // Time spent waiting for the jobs.
+} tadbit_pool;
+
+// Progress callback of 'tadbit', called from the calling thread only
+// with the name of the phase, the work done and the total work.
+typedef void (*tadbit_progress)(void *, const char *, int, int);
+
+// State of a call to 'tadbit', shared by the threads of its pool.
+// Nothing is stored in global variables, so that several calls can
+// run concurrently in the same process.
+typedef struct {
+   tadbit_pool *pool;
+   long taskQ_i;              // Index used for task queue (atomic).
+   int n_processed;           // Number of slices processed so far.
+   int n_to_process;          // Total number of slices to process.
+   long n_newton;             // Newton-Raphson iterations (atomic).
+   tadbit_progress progress;  // NULL if not used.
+   void *progress_data;
+} tadbit_context;
 
 typedef struct {
    const int n;
    const int m;
+   const int band;
+   const obsmap *map;
    const int **k;
-   const double *d;
-   const double **w;
-   const double **lg;
+   const double **rs;
+   const diagsum **ps;
    const char *skip;
    double *llikmat;
    const int verbose;
+   tadbit_context *ctx;
 } llworker_arg;
 
 typedef struct {
    const int n;
+   const int band;
    const double *llikmat;
    double *old_llik;
    double *new_llik;
    int nbreaks;
-   int *new_bkpt_list;
-   const int *old_bkpt_list;
+   int *backtrack;
+   tadbit_context *ctx;
 } dpworker_arg;
 
 
 
+// Instrumentation of a call to 'tadbit'. Times are wall times in
+// seconds.
+typedef struct {
+   double t_input;            // Removal of the empty rows/columns.
+   double t_weights;          // Row sums and tabulations.
+   double t_heuristic;        // Pre-heuristic (0 if not used).
+   double t_total;
+   int n_cycles;              // Number of AIC cycles.
+   double *t_llik;            // Likelihood fill of each cycle.
+   int *n_llik;               // Slices computed at each cycle.
+   int n_dp;                  // Size of 't_dp' (maximum breaks).
+   double *t_dp;              // Dynamic programming per number of
+                              // breaks (summed over the calls).
+   long n_slices;             // Slices of the band.
+   long n_cached;             // Slices taken from the cache.
+   long n_skipped;            // Slices left undefined.
+   long n_newton;             // Newton-Raphson iterations.
+   int n_threads;
+   double utilization;        // Busy fraction of the threads in jobs.
+} tadbit_stats;
+
 // 'tadbit' output struct.
 typedef struct {
    int m;
-   int maxbreaks;
+   int maxbreaks;     // -1 if less than 6 rows/columns are kept, -2
+                      // if the threads could not be created, -3 if
+                      // the cache does not match the rows/columns kept.
    int nbreaks_opt;
+   int n;             // Number of rows/columns kept.
+   int *pos;          // Index of the rows/columns kept in the original
+                      // matrices.
+   int band;
    int *passages;
-   double *llikmat;
+   double *llikmat;   // Banded log-likelihood of the slices of the
+                      // rows/columns kept ('n' x 'band').
    double *mllik;
-   int *bkpts;
-   double **weights;
+   int *bkpts;        // Optimal breakpoints (1 at breakpoints).
+   double **rowsums;  // Row sums of each matrix (0 for the rows with 0
+                      // on the diagonal), from which the weights of
+                      // the cells are computed.
+   tadbit_stats stats;
 } tadbit_output;
 
 
@@ -58,12 +181,18 @@ tadbit(
   int **obs,
   int n,
   const int m,
+  const int triangle,
   int n_threads,
   const int verbose,
   //const int speed,
   const int max_tad_size,
   const int do_not_use_heuristic,
   const int use_visibility,
+  const int *prior,
+  const double *cache,
+  const size_t ncache,
+  tadbit_progress progress,
+  void *progress_data,
   /* output */
   tadbit_output *seg
 );
@@ -85,7 +85,7 @@ tadbit_R_call(
    int maxbreaks = seg->maxbreaks;
 
    // Check that tadbit exited successfully.
-   if (maxbreaks == -1) {
+   if (maxbreaks < 0) {
       free(obs);
       free(seg);
       SEXP fail_SEXP;
@@ -12,14 +12,119 @@ PyDoc_STRVAR(tadbit_py__doc__,
 /* The function doc string */
 PyDoc_STRVAR(_tadbit_wrapper__doc__,
 "Run tadbit function in tadbit.c.\n\
-    :argument obs: a python list of lists of floats, representing a list of linearized matrices.\n\
+    :argument obs: a python list of tuples of integers (or of contiguous int32 buffers, read without copy), representing a list of linearized symmetric matrices. Buffers of n*(n+1)/2 values are read as the upper triangle of the matrix (row after row), and the other matrices are then copied as upper triangles as well.\n\
     :argument 0 n: number of rows or columns in the matrix\n\
     :argument 0 m: number of matrices\n\
     :argument 0 n_threads: number of threads to use\n\
     :argument 0 verbose: whether to display more/less information about process\n\
     :argument 0 max_tad_size: an integer defining maximum size of TAD. Default defines it to the number of rows/columns.\n\
     :argument 1 do_not_use_heuristic: whether to use or not some heuristics\n\
-    :returns: a python list with each\n");
+    :argument 0 use_visibility: whether to use the visibility weights\n\
+    :argument None prior: None, or a contiguous int32 buffer of n values giving for each row the number of the prior boundary it is close to (0 if none). Only the slices between close boundaries are then computed\n\
+    :argument None cache: None, or a contiguous float64 buffer with the banded log-likelihood matrix returned by a previous call on the same matrices. The slices found in it are not recomputed. A ValueError is raised if its size is not a multiple of the number of rows/columns kept\n\
+    :argument None progress: None, or a python callable called with the name of the phase ('heuristic', 'likelihood' or 'confidence'), the work done and the total work. It is called with the GIL from the calling thread (regularly while computing likelihoods). An exception raised by the callable stops the calls, and is raised at the end of the run\n\
+    :argument 0 get_weights: whether to return the row sums from which the weights are computed\n\
+    :returns: a python list with the maximum number of breaks, the optimal number of breaks, and bytearrays of the passages (int), the banded log-likelihood matrix (double) of the rows/columns kept (those with a non-zero diagonal), the log-likelihoods (double), the breakpoints (int), a list of the row sums (double, 0 for the rows with 0 on the diagonal) of each matrix (None if get_weights is 0), a dict of wall times (in seconds) and counts of the run, and the index of the rows/columns kept (int). A ValueError is raised if less than 6 rows/columns have a non-zero diagonal\n");
+
+
+/* Progress callback of the C module, calling a python callable */
+typedef struct {
+  PyObject * callable;
+  PyObject * type;    /* exception raised by the callable (NULL if none) */
+  PyObject * value;
+  PyObject * traceback;
+} py_progress;
+
+static void call_progress (void *data, const char *phase, int done, int total){
+  py_progress * prog = (py_progress *) data;
+  // the GIL is released while tadbit runs
+  PyGILState_STATE gil = PyGILState_Ensure();
+  if (prog->type == NULL){
+    PyObject * res = PyObject_CallFunction(prog->callable, "sii", phase, done,
+                                           total);
+    if (res == NULL)
+      PyErr_Fetch(&prog->type, &prog->value, &prog->traceback);
+    Py_XDECREF(res);
+  }
+  PyGILState_Release(gil);
+}
+
+
+/* Wall times and counts of a run as a python dict */
+static PyObject * stats_dict (tadbit_stats *stats, double t_convert){
+  int i;
+  PyObject * time = PyDict_New();
+  PyObject * cells = PyDict_New();
+  PyObject * py_stats = PyDict_New();
+  PyObject * item;
+  PyObject * llik_time = PyList_New(stats->n_cycles);
+  PyObject * llik_cells = PyList_New(stats->n_cycles);
+  for (i = 0 ; i < stats->n_cycles ; i++){
+    PyList_SetItem(llik_time, i, PyFloat_FromDouble(stats->t_llik[i]));
+    PyList_SetItem(llik_cells, i, PyInt_FromLong(stats->n_llik[i]));
+  }
+  PyObject * dp_time = PyList_New(stats->n_dp);
+  for (i = 0 ; i < stats->n_dp ; i++)
+    PyList_SetItem(dp_time, i, PyFloat_FromDouble(stats->t_dp[i]));
+
+  // the input conversion of the wrapper is counted with the input
+  PyDict_SetItemString(time, "input",
+                       item = PyFloat_FromDouble(stats->t_input + t_convert));
+  Py_DECREF(item);
+  PyDict_SetItemString(time, "weights",
+                       item = PyFloat_FromDouble(stats->t_weights));
+  Py_DECREF(item);
+  PyDict_SetItemString(time, "heuristic",
+                       item = PyFloat_FromDouble(stats->t_heuristic));
+  Py_DECREF(item);
+  PyDict_SetItemString(time, "total",
+                       item = PyFloat_FromDouble(stats->t_total + t_convert));
+  Py_DECREF(item);
+  PyDict_SetItemString(time, "likelihood", llik_time);
+  Py_DECREF(llik_time);
+  PyDict_SetItemString(time, "dp", dp_time);
+  Py_DECREF(dp_time);
+
+  PyDict_SetItemString(cells, "computed", llik_cells);
+  Py_DECREF(llik_cells);
+  PyDict_SetItemString(cells, "total", item = PyInt_FromLong(stats->n_slices));
+  Py_DECREF(item);
+  PyDict_SetItemString(cells, "cached", item = PyInt_FromLong(stats->n_cached));
+  Py_DECREF(item);
+  PyDict_SetItemString(cells, "skipped",
+                       item = PyInt_FromLong(stats->n_skipped));
+  Py_DECREF(item);
+
+  PyDict_SetItemString(py_stats, "time", time);
+  Py_DECREF(time);
+  PyDict_SetItemString(py_stats, "cells", cells);
+  Py_DECREF(cells);
+  PyDict_SetItemString(py_stats, "newton_iterations",
+                       item = PyInt_FromLong(stats->n_newton));
+  Py_DECREF(item);
+  PyDict_SetItemString(py_stats, "threads",
+                       item = PyInt_FromLong(stats->n_threads));
+  Py_DECREF(item);
+  PyDict_SetItemString(py_stats, "thread_utilization",
+                       item = PyFloat_FromDouble(stats->utilization));
+  Py_DECREF(item);
+  return py_stats;
+}
+
+
+/* Release the matrices read by the wrapper (copies or buffers) */
+static void release_obs (int **list, Py_buffer *views, char *inplace, int m){
+  int k;
+  for (k = 0 ; k < m ; k++){
+    if (inplace[k] == 1)
+      PyBuffer_Release(&views[k]);
+    else if (inplace[k] == 0)
+      free(list[k]);
+  }
+  free(list);
+  free(views);
+  free(inplace);
+}
 
 
 /* The wrapper to the underlying C function */
@@ -32,88 +137,245 @@ static PyObject *_tadbit_wrapper (PyObject *self, PyObject *args){
   const int max_tad_size;
   const int do_not_use_heuristic;
   const int use_visibility;
-  /* output */
-  tadbit_output *seg = (tadbit_output *) malloc(sizeof(tadbit_output));
+  PyObject *py_prior = Py_None;
+  PyObject *py_cache = Py_None;
+  PyObject *py_progress_cb = Py_None;
+  int get_weights = 0;
 
-  if (!PyArg_ParseTuple(args, "Oiiiiiii:tadbit", &obs, &n, &m, &n_threads, &verbose, &max_tad_size, &do_not_use_heuristic, &use_visibility))
+  if (!PyArg_ParseTuple(args, "Oiiiiiii|OOOi:tadbit", &obs, &n, &m, &n_threads, &verbose, &max_tad_size, &do_not_use_heuristic, &use_visibility, &py_prior, &py_cache, &py_progress_cb, &get_weights))
     return NULL;
+  if (py_progress_cb != Py_None && !PyCallable_Check(py_progress_cb)){
+    PyErr_SetString(PyExc_TypeError, "progress must be callable");
+    return NULL;
+  }
+  py_progress prog = {py_progress_cb, NULL, NULL, NULL};
+
+  // prior boundaries (read in place)
+  Py_buffer prior_view;
+  int * prior = NULL;
+  if (py_prior != Py_None){
+    if (PyObject_GetBuffer(py_prior, &prior_view, PyBUF_C_CONTIGUOUS | PyBUF_FORMAT) != 0)
+      return NULL;
+    if (prior_view.itemsize != sizeof(int) || prior_view.len != n * sizeof(int)){
+      PyBuffer_Release(&prior_view);
+      PyErr_SetString(PyExc_TypeError,
+                      "prior must be a contiguous array of n int32");
+      return NULL;
+    }
+    prior = (int *) prior_view.buf;
+  }
+
+  // log-likelihoods of a previous run (read in place)
+  Py_buffer cache_view;
+  double * cache = NULL;
+  size_t ncache = 0;
+  if (py_cache != Py_None){
+    if (PyObject_GetBuffer(py_cache, &cache_view, PyBUF_C_CONTIGUOUS | PyBUF_FORMAT) != 0){
+      if (prior != NULL)
+        PyBuffer_Release(&prior_view);
+      return NULL;
+    }
+    if (cache_view.itemsize != sizeof(double) || cache_view.len == 0){
+      PyBuffer_Release(&cache_view);
+      if (prior != NULL)
+        PyBuffer_Release(&prior_view);
+      PyErr_SetString(PyExc_TypeError,
+                      "cache must be a contiguous array of float64");
+      return NULL;
+    }
+    cache = (double *) cache_view.buf;
+    ncache = cache_view.len / sizeof(double);
+  }
 
   // convert list of lists to pointer o pointers
   // if something goes wrong, it is probably from there :S
-  int i, j;
+  double t_convert = wall_time();
+  int i;
   int ** list;
+  PyObject * item;
+  // matrices are symmetric: buffers of the upper triangle (Hi-C store
+  // files) and of the full matrix are read in place, without copy. If
+  // any matrix is not a full buffer, all are passed to tadbit as upper
+  // triangles (see the TRI macro), and the others are copied ('inplace'
+  // is 1 for buffers to release, 2 for old-style buffers and 0 for
+  // copies)
+  const size_t full_len = (size_t) n*n;
+  const size_t tri_len = (size_t) n*(n+1)/2;
+  int triangle = 0;
+  Py_buffer * views = malloc(m * sizeof(Py_buffer));
+  char * inplace = malloc(m * sizeof(char));
+  char * full = malloc(m * sizeof(char));
   list = malloc(m * sizeof(int*));
-  for (i = 0 ; i < m ; i++ )
-    list[i] = malloc(n*n * sizeof(int));
-  for (i = 0 ; i < m ; i++)
-    for (j = 0 ; j < n*n ; j++)
-      list[i][j] = PyInt_AS_LONG(PyTuple_GET_ITEM(PyList_GET_ITEM(obs, i), j));
+  for (i = 0 ; i < m ; i++){
+    item = PyList_GET_ITEM(obs, i);
+    inplace[i] = 0;
+    full[i] = 0;
+    // contiguous buffers of C ints (e.g. numpy int32 arrays) are used
+    // directly, without going through python integers
+    if (PyObject_CheckBuffer(item) &&
+        PyObject_GetBuffer(item, &views[i], PyBUF_C_CONTIGUOUS | PyBUF_FORMAT) == 0){
+      Py_buffer * view = &views[i];
+      if (view->itemsize != sizeof(int) ||
+          (view->len != full_len * sizeof(int) &&
+           view->len != tri_len * sizeof(int)) ||
+          (view->format != NULL && strcmp(view->format, "i") != 0 &&
+           strcmp(view->format, "=i") != 0 && strcmp(view->format, "<i") != 0)){
+        PyBuffer_Release(view);
+        release_obs(list, views, inplace, i);
+        free(full);
+        if (prior != NULL)
+          PyBuffer_Release(&prior_view);
+        if (cache != NULL)
+          PyBuffer_Release(&cache_view);
+        PyErr_SetString(PyExc_TypeError,
+                        "buffer must be a contiguous array of n*n int32 "
+                        "(or of n*(n+1)/2 for the upper triangle)");
+        return NULL;
+      }
+      list[i] = (int *) view->buf;
+      inplace[i] = 1;
+      full[i] = view->len == full_len * sizeof(int);
+      triangle |= !full[i];
+      continue;
+    }
+    PyErr_Clear();
+    // old-style buffers (array('i') or mmap objects) of the full matrix
+    const void * buf;
+    Py_ssize_t len;
+    if (!PyTuple_Check(item) && PyObject_CheckReadBuffer(item) &&
+        PyObject_AsReadBuffer(item, &buf, &len) == 0 &&
+        len == full_len * sizeof(int)){
+      list[i] = (int *) buf;
+      inplace[i] = 2;
+      full[i] = 1;
+      continue;
+    }
+    PyErr_Clear();
+    if (!PyTuple_Check(item) || PyTuple_GET_SIZE(item) != full_len){
+      release_obs(list, views, inplace, i);
+      free(full);
+      if (prior != NULL)
+        PyBuffer_Release(&prior_view);
+      if (cache != NULL)
+        PyBuffer_Release(&cache_view);
+      PyErr_SetString(PyExc_TypeError,
+                      "matrices must be tuples or int32 buffers of n*n values");
+      return NULL;
+    }
+    // upper triangle of the tuple
+    int row, col;
+    int * tri = list[i] = malloc(tri_len * sizeof(int));
+    for (row = 0 ; row < n ; row++)
+      for (col = row ; col < n ; col++)
+        *tri++ = PyInt_AS_LONG(PyTuple_GET_ITEM(item, row + (size_t) col*n));
+    triangle = 1;
+  }
+  // full matrices passed with triangles are copied as triangles
+  for (i = 0 ; triangle && i < m ; i++){
+    if (!full[i])
+      continue;
+    int row, col;
+    int * tri = malloc(tri_len * sizeof(int));
+    for (row = 0 ; row < n ; row++)
+      for (col = row ; col < n ; col++)
+        tri[TRI(row, col, n)] = list[i][row + (size_t) col*n];
+    if (inplace[i] == 1)
+      PyBuffer_Release(&views[i]);
+    list[i] = tri;
+    inplace[i] = 0;
+  }
+  free(full);
 
-  // run tadbit
-  tadbit(list, n, m, n_threads, verbose, max_tad_size, do_not_use_heuristic, use_visibility, seg);
+  t_convert = wall_time() - t_convert;
+
+  /* output */
+  tadbit_output *seg = (tadbit_output *) malloc(sizeof(tadbit_output));
+
+  // run tadbit (without the GIL: python objects are only accessed by the
+  // progress callback, which takes the GIL, so other python threads can
+  // run tadbit as well)
+  Py_BEGIN_ALLOW_THREADS
+  tadbit(list, n, m, triangle, n_threads, verbose, max_tad_size, do_not_use_heuristic, use_visibility, prior, cache, ncache,
+         py_progress_cb != Py_None ? &call_progress : NULL, &prog, seg);
+  Py_END_ALLOW_THREADS
+  if (prior != NULL)
+    PyBuffer_Release(&prior_view);
+  if (cache != NULL)
+    PyBuffer_Release(&cache_view);
+
+  // nothing else is set by tadbit on failure
+  if (seg->maxbreaks < 0){
+    release_obs(list, views, inplace, m);
+    free(seg->stats.t_llik);
+    free(seg->stats.n_llik);
+    free(seg->stats.t_dp);
+    Py_XDECREF(prog.type);
+    Py_XDECREF(prog.value);
+    Py_XDECREF(prog.traceback);
+    if (seg->maxbreaks == -1)
+      PyErr_SetString(PyExc_ValueError, "tadbit needs at least 6 rows/columns"
+                      " with a non-zero diagonal");
+    else if (seg->maxbreaks == -3)
+      PyErr_SetString(PyExc_ValueError, "cache must hold a band of the"
+                      " rows/columns with a non-zero diagonal");
+    else
+      PyErr_SetString(PyExc_RuntimeError, "tadbit could not create its"
+                      " threads");
+    free(seg);
+    return NULL;
+  }
 
   // store each tadbit output
   int       mbreaks     = seg->maxbreaks;
   int       nbreaks_opt = seg->nbreaks_opt;
   int    *  passages    = seg->passages;
   double *  llikmat     = seg->llikmat;
-  double ** weights     = seg->weights;
+  double ** rowsums     = seg->rowsums;
   double *  mllik       = seg->mllik;
   int    *  bkpts       = seg->bkpts;
 
-  // declare python objects to store lists
+  // declare python objects to store the results. Arrays are returned as
+  // bytearrays holding C ints or doubles (to be read with numpy.frombuffer)
   PyObject * py_bkpts;
   PyObject * py_llikmat;
+  PyObject * py_pos;
   PyObject * py_mllik;
   PyObject * py_result;
   PyObject * py_passages;
   PyObject * py_weights;
-  PyObject * temp;
-
-  // get bkpts
-  int dim = nbreaks_opt*n;
-  py_bkpts = PyList_New(dim+n);
-  for(i = 0 ; i < dim+n; i++)
-    PyList_SetItem(py_bkpts, i, PyInt_FromLong(bkpts[i]));
-
-  /* This is to return directly the list of breaks found
-  j = 0;
-  py_bkpts = PyList_New(nbreaks_opt);
-  for(i = 0 ; i < n; i++){
-    if (bkpts[i+dim]==1){
-      PyList_SetItem(py_bkpts, j, PyInt_FromLong(i));
-      j++;
-    }
+
+  // get bkpts (of the optimal segmentation only, as C ints)
+  py_bkpts = PyByteArray_FromStringAndSize((char *) bkpts, n * sizeof(int));
+
+  // get passages (as C ints)
+  py_passages = PyByteArray_FromStringAndSize((char *) passages,
+                                              n * sizeof(int));
+
+  // get llikmat (banded, see the BAND macro in tadbit.h, for the rows
+  // kept only) and the index of the rows kept (as C ints)
+  py_llikmat = PyByteArray_FromStringAndSize(
+    (char *) llikmat, (size_t) seg->n*seg->band * sizeof(double));
+  py_pos = PyByteArray_FromStringAndSize((char *) seg->pos,
+                                         seg->n * sizeof(int));
+
+  // get row sums (only if asked)
+  if (get_weights){
+    py_weights = PyList_New(m);
+    for(i = 0 ; i < m; i++)
+      PyList_SetItem(py_weights, i, PyByteArray_FromStringAndSize(
+                       (char *) rowsums[i], n * sizeof(double)));
   }
-  */
-
-  // get passages
-  py_passages = PyList_New(n);
-  for(i = 0 ; i < n; i++)
-    PyList_SetItem(py_passages, i, PyFloat_FromDouble(passages[i]));
-
-  // get llikmat
-  py_llikmat = PyList_New(n*n);
-  for(i = 0 ; i < n*n; i++)
-    PyList_SetItem(py_llikmat, i, PyFloat_FromDouble(llikmat[i]));
-
-  // get weights
-  py_weights = PyList_New(m);
-  for(i = 0 ; i < m; i++){
-    temp = PyList_New(n*n);
-    PyList_SetItem(py_weights, i, temp);
-    for(j = 0 ; j < n*n; j++){
-      PyList_SetItem(temp, j, PyFloat_FromDouble(weights[i][j]));
-    }
+  else {
+    Py_INCREF(Py_None);
+    py_weights = Py_None;
   }
 
   // get mllik
-  py_mllik = PyList_New(mbreaks);
-  for(i = 0 ; i < mbreaks ; i++)
-    PyList_SetItem(py_mllik, i, PyFloat_FromDouble(mllik[i]));
+  py_mllik = PyByteArray_FromStringAndSize((char *) mllik,
+                                           mbreaks * sizeof(double));
 
   // group results into a python list
-  py_result = PyList_New(7);
+  py_result = PyList_New(9);
 
   PyList_SetItem(py_result, 0, PyInt_FromLong(mbreaks));
   PyList_SetItem(py_result, 1, PyInt_FromLong(nbreaks_opt));
@@ -122,22 +384,30 @@ static PyObject *_tadbit_wrapper (PyObject *self, PyObject *args){
   PyList_SetItem(py_result, 4, py_mllik);
   PyList_SetItem(py_result, 5, py_bkpts);
   PyList_SetItem(py_result, 6, py_weights);
+  PyList_SetItem(py_result, 7, stats_dict(&seg->stats, t_convert));
+  PyList_SetItem(py_result, 8, py_pos);
 
   // free many things... no leaks here!!
-  free(seg);
   free(passages);
   free(llikmat);
+  free(seg->pos);
   int k;
-  for (k = 0 ; k < m ; k++){
-    //free(obs[k]);
-    free(weights[k]);
-    free(list[k]);
-  }
-  //free(obs);
-  free(weights);
-  free(list);
+  for (k = 0 ; k < m ; k++)
+    free(rowsums[k]);
+  free(rowsums);
+  release_obs(list, views, inplace, m);
   free(mllik);
   free(bkpts);
+  free(seg->stats.t_llik);
+  free(seg->stats.n_llik);
+  free(seg->stats.t_dp);
+  free(seg);
+  if (prog.type != NULL){
+    // exception raised by the progress callback
+    Py_DECREF(py_result);
+    PyErr_Restore(prog.type, prog.value, prog.traceback);
+    return NULL;
+  }
   //free(py_bkpts);
   //free(py_llikmat);
   //free(py_mllik);
@@ -6,9 +6,33 @@ unittest for pytadbit functions
 
 import unittest
 from pytadbit import tadbit, batch_tadbit, Chromosome, load_chromosome
+from pytadbit import Genome, write_chromosome_store, load_chromosome_store
+from pytadbit import compact_chromosome_store
 from pytadbit.tad_clustering.tad_cmo import optimal_cmo
 from pytadbit.parsers.hic_parser import __check_hic as check_hic
-from os import system
+from pytadbit.parsers.hic_parser import read_matrix, read_sparse_matrix
+from pytadbit.parsers.hic_parser import SparseHiC
+from pytadbit.parsers.hic_store import write_hic_store, load_hic_store
+from pytadbit.parsers.hic_store import HiCStore
+from pytadbit.parsers.pairs_parser import bin_pairs
+from pytadbit.experiment import coarsen_matrix
+from pytadbit.tadbit_py import _tadbit_wrapper
+from pytadbit.tadbit import _save_llik
+from pytadbit.utils.tad_enrichment import boundary_enrichment
+from pytadbit.utils.tadmaths import zscore
+from pytadbit.boundary_aligner.globally import needleman_wunsch, score_matrix
+from gzip import GzipFile
+from cPickle import loads, dumps
+from numpy import isnan, mean, std, may_share_memory, load, int32
+from numpy import frombuffer, intc, triu_indices, zeros
+from numpy.random import RandomState
+from os import system, listdir, path, getpid
+from threading import Thread
+from multiprocessing import Process, Event
+from resource import setrlimit, getpagesize, RLIMIT_AS, RLIM_INFINITY
+from sys import exit
+from math import log
+from array import array
 
 
 class TestTadbit(unittest.TestCase):
@@ -185,7 +209,7 @@ class TestTadbit(unittest.TestCase):
         tadbit_weigths = exp.norm[:]
         exp.norm = None
         exp.normalize_hic()
-        self.assertEqual(tadbit_weigths[0], exp.norm[0])
+        self.assertEqual(list(tadbit_weigths[0]), list(exp.norm[0]))
 
 
     def test_11_write_interaction_pairs(self):
@@ -202,6 +226,820 @@ class TestTadbit(unittest.TestCase):
         pass
 
 
+    def test_13_read_matrix(self):
+        """
+        matrices read from plain or gzipped files give the same buffer
+        """
+        nums, size = read_matrix('20Kb/chrT/chrT_A.tsv')
+        out = GzipFile('lolo.gz', 'w')
+        out.write(open('20Kb/chrT/chrT_A.tsv').read())
+        out.close()
+        gnums, gsize = read_matrix('lolo.gz')
+        system('rm -f lolo.gz')
+        self.assertEqual(size, 100)
+        self.assertEqual(size, gsize)
+        self.assertEqual(list(nums[0]), list(gnums[0]))
+        self.assertEqual(list(nums[0][:4]), [629, 164, 88, 105])
+
+
+    def test_14_sparse_matrix(self):
+        """
+        matrices read from lists of interacting pairs
+        """
+        nums, size = read_matrix('20Kb/chrT/chrT_A.tsv')
+        out = GzipFile('lolo.gz', 'w')
+        for i in xrange(size):
+            for j in xrange(i, size):
+                if nums[0][i * size + j]:
+                    out.write('%s\t%s\t%s\n' % (i + 1, j + 1,
+                                                 nums[0][i * size + j]))
+        out.close()
+        sparse, ssize = read_sparse_matrix('lolo.gz')
+        snums, _ = read_matrix('lolo.gz')
+        system('rm -f lolo.gz')
+        self.assertEqual(size, ssize)
+        self.assertTrue(sparse.nnz < size * size)
+        # sparse files are not expanded into dense matrices
+        self.assertTrue(isinstance(snums[0], SparseHiC))
+        self.assertEqual(list(nums[0]), list(snums[0]))
+        self.assertEqual(list(nums[0][size:3 * size + 7]),
+                         list(snums[0][size:3 * size + 7]))
+        self.assertEqual(list(nums[0][5::size]), list(snums[0][5::size]))
+        self.assertEqual(tadbit(nums, verbose=False),
+                         tadbit(snums, verbose=False))
+        test_chr = Chromosome(name='Test Chromosome')
+        test_chr.add_experiment('exp1', 20000, hic_data=sparse)
+        self.assertEqual(list(nums[0]),
+                         list(test_chr.experiments['exp1'].hic_data[0]))
+
+
+    def test_15_hic_store(self):
+        """
+        binary Hi-C stores give the same data and TADs as text matrices
+        """
+        nums, size = read_matrix('20Kb/chrT/chrT_A.tsv')
+        write_hic_store('lolo.hic', nums[0], size, 20000)
+        store = load_hic_store('lolo.hic')
+        self.assertEqual(store.size, size)
+        self.assertEqual(store.resolution, 20000)
+        self.assertEqual(list(store), list(nums[0]))
+        self.assertEqual(list(store[:]), list(nums[0]))
+        self.assertEqual(list(store[size + 3:3 * size + 1]),
+                         list(nums[0][size + 3:3 * size + 1]))
+        self.assertEqual(list(store[5::size]), list(nums[0][5::size]))
+        self.assertEqual(list(store.row_sums()),
+                         list(nums[0].reshape(size, size).sum(axis=1)))
+        self.assertEqual(tadbit('lolo.hic', max_tad_size="auto",
+                                verbose=False),
+                         tadbit('20Kb/chrT/chrT_A.tsv', max_tad_size="auto",
+                                verbose=False))
+        test_chr = Chromosome(name='Test Chromosome')
+        test_chr.add_experiment('exp1', 40000, hic_data='lolo.hic')
+        exp = test_chr.experiments['exp1']
+        self.assertEqual(exp.size, 50)
+        self.assertEqual(sum(exp.hic_data[0]), sum(nums[0]))
+        # filtering the columns of a store does not read its rows, only its
+        # triangle
+        slices = []
+        getitem = HiCStore.__getitem__
+        def spy(hic, k):
+            if isinstance(k, slice):
+                slices.append(len(xrange(*k.indices(len(hic)))))
+            return getitem(hic, k)
+        HiCStore.__getitem__ = spy
+        try:
+            test_chr.add_experiment('exp2', 20000, hic_data='lolo.hic')
+        finally:
+            HiCStore.__getitem__ = getitem
+        system('rm -f lolo.hic')
+        self.assertEqual(slices, [])
+        test_chr.add_experiment('exp3', 20000,
+                                hic_data='20Kb/chrT/chrT_A.tsv')
+        self.assertEqual(test_chr.experiments['exp2']._zeros,
+                         test_chr.experiments['exp3']._zeros)
+
+
+    def test_16_bin_pairs(self):
+        """
+        binning of read pairs at several resolutions
+        """
+        out = open('lolo', 'w')
+        out.write('# chromosome and position of each read\n')
+        for pos1, pos2 in [(100, 5000), (15000, 39000), (25000, 26000),
+                           (39999, 1000), (41000, 41500)]:
+            out.write('chrT\t%s\tchrT\t%s\n' % (pos1, pos2))
+        out.write('chrT\t100\tchrU\t100\n')
+        out.close()
+        matrices = bin_pairs('lolo', [10000, 20000], chunk_size=2)
+        # matrices are sized to the full chromosome if its size is known
+        full = bin_pairs('lolo', 20000, chunk_size=4,
+                         chr_sizes={'chrT': 100000})
+        system('rm -f lolo')
+        full = full['chrT'][20000]
+        self.assertEqual(len(full), 6 * 6)
+        self.assertEqual(list(full.reshape(6, 6)[:3, :3].ravel()),
+                         [1, 2, 0, 2, 1, 0, 0, 0, 1])
+        self.assertEqual(sum(full), 7)
+        self.assertEqual(matrices.keys(), ['chrT'])
+        self.assertEqual(list(matrices['chrT'][20000]),
+                         [1, 2, 0, 2, 1, 0, 0, 0, 1])
+        self.assertEqual(sum(matrices['chrT'][10000]), 7)
+        test_chr = Chromosome(name='chrT')
+        test_chr.add_experiment('exp1', 20000,
+                                hic_data=matrices['chrT'][20000],
+                                filter_columns=False)
+        self.assertEqual(test_chr.experiments['exp1'].size, 3)
+
+
+    def test_17_resolution_pyramid(self):
+        """
+        coarsening of Hi-C data by blocks, and reuse of computed resolutions
+        """
+        size = 7
+        hic  = tuple(range(size * size))
+        # size is not a multiple of 3, last row/column gets the rest
+        self.assertEqual(list(coarsen_matrix(hic, size, 3)),
+                         [sum(hic[i * size + j]
+                              for i in range(size) if i / 3 == k
+                              for j in range(size) if j / 3 == l)
+                          for k in range(3) for l in range(3)])
+        test_chr = Chromosome(name='Test Chromosome')
+        test_chr.add_experiment('exp1', 20000,
+                                hic_data='20Kb/chrT/chrT_A.tsv')
+        exp = test_chr.experiments['exp1']
+        exp.build_pyramid([40000, 100000, 200000])
+        exp.set_resolution(100000)
+        hic100 = exp.hic_data
+        exp.set_resolution(20000)
+        exp.set_resolution(100000)
+        self.assertTrue(exp.hic_data is hic100)
+        # 200 kb summed from 40 kb or from 100 kb gives the same matrix
+        self.assertEqual(list(exp._get_level(200000)[0][0]),
+                         list(coarsen_matrix(exp._ori_hic[0], 100, 10)))
+        exp.pyramid_budget = 0
+        exp.set_resolution(60000)
+        self.assertEqual(exp._pyramid.keys(), [60000])
+        exp2 = exp + exp
+        self.assertEqual(exp.resolution, 60000)
+        self.assertEqual(exp2.resolution, 60000)
+        self.assertEqual(sum(exp2.hic_data[0]), 2 * sum(exp.hic_data[0]))
+
+
+    def test_18_hic_balancing(self):
+        """
+        normalizations stored as biases, and matrix balancing
+        """
+        test_chr = Chromosome(name='Test Chromosome')
+        test_chr.add_experiment('exp1', 20000,
+                                hic_data='20Kb/chrT/chrT_A.tsv')
+        exp = test_chr.experiments['exp1']
+        size = exp.size
+        hic = list(exp.hic_data[0])
+        rowsums = [sum(hic[i * size:(i + 1) * size]) - hic[i * size + 22]
+                   for i in xrange(size)]
+        exp.normalize_hic(method='visibility')
+        self.assertEqual(len(exp.bias), size)
+        self.assertAlmostEqual(exp.norm[0][5 * size + 7],
+                               hic[5 * size + 7] / (
+                                   float(rowsums[5] * rowsums[7]) /
+                                   sum(rowsums)))
+        self.assertEqual(exp.norm[0][22 * size + 7], 0)
+        for method in ['ice', 'kr']:
+            exp.normalize_hic(method=method, tol=1e-6, max_iter=1000)
+            sums = [sum(exp.norm[0][i * size:(i + 1) * size])
+                    for i in xrange(size) if exp.bias[i]]
+            self.assertAlmostEqual(min(sums) / max(sums), 1, places=3)
+        exp.normalize_hic(method='ice', band=10)
+        self.assertEqual(len(exp.bias), size)
+        exp.get_hic_zscores()
+        self.assertEqual(len(exp._zscores), size - 2)
+
+
+    def test_19_zscores(self):
+        """
+        z-scores stored as an array, and read as a dictionary
+        """
+        test_chr = Chromosome(name='Test Chromosome')
+        test_chr.add_experiment('exp1', 20000,
+                                hic_data='20Kb/chrT/chrT_A.tsv')
+        exp = test_chr.experiments['exp1']
+        exp.normalize_hic()
+        exp.get_hic_zscores()
+        zscores = exp._zscores
+        values = [zscores[i][j] for i in zscores for j in zscores[i]]
+        self.assertEqual(len(values), (~isnan(zscores.triangle)).sum())
+        self.assertAlmostEqual(mean(values), 0, places=5)
+        self.assertAlmostEqual(std(values), 1, places=5)
+        matrix = zscores.get_matrix()
+        self.assertAlmostEqual(matrix[10, 3], zscores['3']['10'])
+        self.assertEqual(zscores[3][10], zscores['3']['10'])
+        # only the upper triangle is available as a dictionary
+        self.assertFalse('3' in zscores['10'])
+        self.assertFalse(str(exp._zeros.keys()[0]) in zscores)
+        self.assertEqual(dict(loads(dumps(zscores))['3']),
+                         dict(zscores['3']))
+        exp.get_hic_zscores(normalized=False, zscored=False)
+        self.assertEqual(exp._zscores['3']['10'],
+                         exp.hic_data[0][3 * exp.size + 10])
+        # values from the original implementation: integers are halved as
+        # integers, and values equal to the position of a cell of the
+        # diagonal (8 in a 3x3 matrix) are taken as null
+        values = [0, 3, 8, 5, 0, 9, 12]
+        zscore(values, 3)
+        self.assertEqual([round(v, 6) for v in values],
+                         [-1.055915, 0.042879, -1.055915, 0.553789, -1.055915,
+                          1.141673, 1.429403])
+        values = [0., 3., 8., 5., 0., 9., 12.]
+        zscore(values, 3)
+        self.assertEqual([round(v, 6) for v in values],
+                         [-1.004473, -0.159559, -1.004473, 0.463113, -1.004473,
+                          1.179597, 1.530268])
+
+
+    def test_20_region_zscores(self):
+        """
+        z-scores of regions computed from views of the Hi-C data, and cached
+        """
+        test_chr = Chromosome(name='Test Chromosome')
+        test_chr.add_experiment('exp1', 20000,
+                                hic_data='20Kb/chrT/chrT_A.tsv')
+        exp = test_chr.experiments['exp1']
+        exp.normalize_hic()
+        raw, norm, zeros = exp.get_region(10, 40)
+        self.assertEqual(raw.shape, (31, 31))
+        self.assertTrue(may_share_memory(raw, exp.hic_data[0]))
+        self.assertEqual(raw[2, 5], exp.hic_data[0][12 * exp.size + 15])
+        self.assertAlmostEqual(norm[2, 5], exp.norm[0][12 * exp.size + 15])
+        self.assertEqual(zeros, [22 - 10])
+        exp.region_cache_size = 2
+        zscores, values = exp._sub_experiment_zscore(10, 40)
+        self.assertEqual(len(values), 31)
+        self.assertTrue(isnan(values[12][3]))
+        self.assertAlmostEqual(values[2][5], norm[2, 5])
+        self.assertTrue(exp._sub_experiment_zscore(10, 40)[0] is zscores)
+        # cached results are shared, they can not be modified
+        self.assertRaises(ValueError, values.__setitem__, (2, 5), 0)
+        self.assertRaises(ValueError, zscores.triangle.__setitem__, 0, 0)
+        exp._sub_experiment_zscore(0, 20)
+        exp._sub_experiment_zscore(30, 50)
+        self.assertEqual(exp._region_zscores.keys(), [(0, 20), (30, 50)])
+        exp.normalize_hic()
+        self.assertEqual(len(exp._region_zscores), 0)
+        exp._sub_experiment_zscore(0, 20)
+        exp.load_tad_def(exp4, weights=exp.norm)
+        self.assertEqual(len(exp._region_zscores), 0)
+
+
+    def test_21_interaction_pairs(self):
+        """
+        interaction pairs written by blocks, compressed, binary or iterated
+        """
+        test_chr = Chromosome(name='Test Chromosome')
+        test_chr.add_experiment('exp1', 20000,
+                                hic_data='20Kb/chrT/chrT_A.tsv')
+        exp = test_chr.experiments['exp1']
+        exp.normalize_hic()
+        exp.get_hic_zscores()
+        exp.write_interaction_pairs('lolo', cutoff=0.5, focus=(5, 50))
+        lines = open('lolo').readlines()
+        pairs = list(exp.iter_interaction_pairs(cutoff=0.5, focus=(5, 50)))
+        self.assertEqual(len(lines), len(pairs))
+        self.assertEqual(lines[0], '%s\t%s\t%s\n' % pairs[0])
+        self.assertTrue(all(val >= 0.5 for _, _, val in pairs))
+        self.assertEqual(pairs[0][2], exp._zscores[str(pairs[0][0] + 4)][
+            str(pairs[0][1] + 4)])
+        exp.write_interaction_pairs('lolo.gz', cutoff=0.5, focus=(5, 50))
+        self.assertEqual(GzipFile('lolo.gz').readlines(), lines)
+        exp.write_interaction_pairs('lolo.npz', zscored=False,
+                                    normalized=False, diagonal=True,
+                                    file_format='npz')
+        npz = load('lolo.npz')
+        self.assertEqual(len(npz['value']), 99 * 100 / 2)
+        self.assertEqual(npz['value'][0], exp.hic_data[0][0])
+        self.assertEqual(list(npz['elt2'][:3]), [1, 2, 3])
+        system('rm -f lolo lolo.gz lolo.npz')
+
+
+    def test_22_compact_storage(self):
+        """
+        Hi-C data stored in typed numpy arrays
+        """
+        matrix = [[3, 1, 0], [1, 5, 2], [0, 2, 4]]
+        nums, size = read_matrix([matrix])
+        self.assertEqual(size, 3)
+        self.assertEqual(nums[0].dtype, int32)
+        self.assertEqual(list(nums[0]), [3, 1, 0, 1, 5, 2, 0, 2, 4])
+        nums, _ = read_matrix(tuple(float(v) for v in nums[0]))
+        self.assertEqual(nums[0].dtype, float)
+        test_chr = Chromosome(name='Test Chromosome')
+        test_chr.add_experiment('exp1', 20000,
+                                hic_data='20Kb/chrT/chrT_A.tsv')
+        exp = test_chr.experiments['exp1']
+        self.assertEqual(exp.hic_data[0].dtype, int32)
+        self.assertEqual(exp.hic_data[0].nbytes, 4 * exp.size**2)
+        matrix = exp.get_hic_matrix()
+        self.assertTrue(may_share_memory(matrix, exp.hic_data[0]))
+        self.assertEqual(matrix[3][10], exp.hic_data[0][3 * exp.size + 10])
+        exp.set_resolution(60000)
+        self.assertEqual(exp.hic_data[0].dtype, int32)
+
+
+    def test_23_concurrent_tadbit(self):
+        """
+        tadbit run on several matrices from python threads
+        """
+        results = {}
+        def run(fnam):
+            results[fnam] = tadbit(fnam, max_tad_size="auto", verbose=False,
+                                   no_heuristic=False, n_cpus=2)
+        fnames = ['20Kb/chrT/chrT_B.tsv', '20Kb/chrT/chrT_C.tsv']
+        threads = [Thread(target=run, args=(fnam,)) for fnam in fnames]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(results[fnames[0]], exp2)
+        self.assertEqual(results[fnames[1]], exp3)
+
+
+    def test_24_wrapper_buffers(self):
+        """
+        matrices passed to the C module as buffers, typed outputs
+        """
+        nums, size = read_matrix('20Kb/chrT/chrT_B.tsv')
+        num = nums[0]
+        res1 = _tadbit_wrapper([tuple(int(v) for v in num)], size, 1, 1, 0,
+                               size, 0, 0)
+        res2 = _tadbit_wrapper([array('i', num.tolist())], size, 1, 1, 0,
+                               size, 0, 0)
+        self.assertEqual(res1[5], res2[5])
+        self.assertEqual(res1[3], res2[3])
+        # upper triangle read in place
+        tri = num.reshape(size, size)[triu_indices(size)].astype(int32)
+        res3 = _tadbit_wrapper([tri], size, 1, 1, 0, size, 0, 0)
+        self.assertEqual(res1[5], res3[5])
+        self.assertEqual(res1[3], res3[3])
+        bkpts = frombuffer(res1[5], dtype=intc)
+        self.assertEqual(len(bkpts), size)
+        self.assertEqual(list(bkpts.nonzero()[0] + 1), exp2['start'][1:])
+        self.assertRaises(TypeError, _tadbit_wrapper, [[1, 2]], size, 1, 1, 0,
+                          size, 0, 0)
+        self.assertEqual(res1[6], None)
+        # less than 6 rows with a non-zero diagonal
+        small = num.reshape(size, size)[:5, :5]
+        self.assertRaises(ValueError, _tadbit_wrapper,
+                          [small.astype(int32).ravel()], 5, 1, 1, 0, 5, 0, 0)
+
+
+    def test_25_windowed_tadbit(self):
+        """
+        tadbit on overlapping windows
+        """
+        res = tadbit('20Kb/chrT/chrT_B.tsv', max_tad_size="auto",
+                     verbose=False, no_heuristic=False, window=200)
+        self.assertEqual(res, exp2)
+        res, weights = tadbit('20Kb/chrT/chrT_B.tsv', max_tad_size="auto",
+                              verbose=False, no_heuristic=False, window=60,
+                              overlap=20, n_cpus=2, get_weights=True)
+        self.assertEqual(res['start'][:4], exp2['start'][:4])
+        self.assertEqual(res['start'][-4:], exp2['start'][-4:])
+        self.assertEqual(res['end'][-1], 99)
+        self.assertTrue(all(end - start >= 2 for start, end in
+                            zip(res['start'], res['end'])))
+        _, full = tadbit('20Kb/chrT/chrT_B.tsv', verbose=False,
+                         get_weights=True)
+        self.assertEqual(type(full[0]), type(weights[0]))
+        self.assertTrue(abs(full[0][:] - weights[0][:]).max() < 1e-10)
+        test_chr = Chromosome(name='Test Chromosome')
+        test_chr.add_experiment('exp1', 20000,
+                                hic_data='20Kb/chrT/chrT_B.tsv')
+        test_chr.find_tad('exp1', window=60, overlap=20, verbose=False)
+        self.assertEqual(len(test_chr.experiments['exp1'].tads),
+                         len(res['start']))
+
+
+    def test_26_coarse_to_fine(self):
+        """
+        TADs searched close to boundaries found at a lower resolution
+        """
+        test_chr = Chromosome(name='Test Chromosome')
+        test_chr.add_experiment('exp1', 20000,
+                                hic_data='20Kb/chrT/chrT_D.tsv')
+        test_chr.find_tad('exp1', verbose=False, coarse_resolution=60000)
+        exp = test_chr.experiments['exp1']
+        self.assertEqual(exp.resolution, 20000)
+        starts = [exp.tads[t]['start'] for t in sorted(exp.tads)]
+        self.assertEqual(starts, [0, 3, 8, 13, 19, 35, 44, 50, 62, 67, 76, 84])
+        # boundaries missed at the coarse resolution are not searched: only
+        # the last two boundaries of the full search (90 and 95) are lost
+        self.assertEqual(sorted(set(exp4[0]['start']) - set(starts)), [90, 95])
+        nums, size = read_matrix('20Kb/chrT/chrT_D.tsv')
+        prior = array('i', [0] * size)
+        for num, brk in enumerate([18, 34, 61, 75], 1):
+            for pos in xrange(brk - 2, brk + 3):
+                prior[pos] = num
+        res = _tadbit_wrapper([nums[0]], size, 1, 1, 0, size, 0, 0,
+                              frombuffer(prior, dtype=intc))
+        llikmat = frombuffer(res[3])
+        self.assertTrue((~isnan(llikmat)).sum() < size * (size + 1) / 10)
+        breaks = frombuffer(res[5], dtype=intc).nonzero()[0].tolist()
+        self.assertTrue(set([18, 34, 61, 75]) <= set(breaks))
+
+
+    def test_27_llik_cache(self):
+        """
+        log-likelihoods kept between runs on the same matrices
+        """
+        system('rm -rf lolo_cache; mkdir lolo_cache')
+        fresh = tadbit('20Kb/chrT/chrT_D.tsv', verbose=False,
+                       no_heuristic=True)
+        # the cache is filled by a run with the heuristic
+        first = tadbit('20Kb/chrT/chrT_D.tsv', verbose=False,
+                       llik_cache='lolo_cache')
+        self.assertEqual(first, exp4[0])
+        self.assertEqual(len(listdir('lolo_cache')), 1)
+        again = tadbit('20Kb/chrT/chrT_D.tsv', verbose=False,
+                       no_heuristic=True, llik_cache='lolo_cache')
+        self.assertEqual(again, fresh)
+        cached = load(path.join('lolo_cache', listdir('lolo_cache')[0]))
+        self.assertFalse(isnan(cached[:, 1:]).all())
+        # windows are cached separately
+        windowed = tadbit('20Kb/chrT/chrT_D.tsv', verbose=False, window=60,
+                          llik_cache='lolo_cache')
+        self.assertEqual(len(listdir('lolo_cache')), 3)
+        self.assertEqual(tadbit('20Kb/chrT/chrT_D.tsv', verbose=False,
+                                window=60, llik_cache='lolo_cache'), windowed)
+        system('rm -rf lolo_cache')
+
+
+    def test_28_instrumentation(self):
+        """
+        wall times and counts of the C module, progress callback
+        """
+        calls = []
+        res = tadbit('20Kb/chrT/chrT_D.tsv', verbose=False, n_cpus=2,
+                     get_stats=True,
+                     progress=lambda *args: calls.append(args))
+        stats = res.pop('stats')
+        self.assertEqual(res, exp4[0])
+        self.assertEqual(stats['threads'], 2)
+        self.assertEqual(len(stats['time']['likelihood']),
+                         len(stats['cells']['computed']))
+        cells = stats['cells']
+        self.assertEqual(sum(cells['computed']) + cells['skipped'],
+                         cells['total'])
+        self.assertTrue(0 < cells['skipped'] < cells['total'])
+        self.assertTrue(stats['newton_iterations'] > sum(cells['computed']))
+        self.assertTrue(0 < stats['thread_utilization'] <= 1)
+        self.assertTrue(stats['time']['total'] >=
+                        stats['time']['heuristic'] +
+                        sum(stats['time']['likelihood']))
+        self.assertEqual(calls[0], ('heuristic', 1, 1))
+        self.assertEqual(calls[-1], ('confidence', 10, 10))
+        self.assertEqual(len([c for c in calls if c[0] == 'likelihood' and
+                              c[1] == c[2]]),
+                         len(cells['computed']))
+        def stop(*args):
+            raise KeyboardInterrupt
+        self.assertRaises(KeyboardInterrupt, tadbit, '20Kb/chrT/chrT_D.tsv',
+                          verbose=False, progress=stop)
+
+
+    def test_29_genome(self):
+        """
+        TADs of the experiments of several chromosomes, in parallel
+        """
+        genome = Genome('Test Genome')
+        for name in ['chrT', 'chrU']:
+            crm = genome.add_chromosome(name)
+            crm.add_experiment('exp1', 20000, hic_data='20Kb/chrT/chrT_B.tsv')
+            crm.add_experiment('exp2', 20000, hic_data='20Kb/chrT/chrT_D.tsv')
+        crm.add_experiment('exp3', 40000, hic_data='40Kb/chrT/chrT_A.tsv')
+        crm.get_experiment('exp3').hic_data = [(1, 2)]
+        report = genome.find_tad(n_cpus=2, verbose=False)
+        self.assertEqual(len(report), 5)
+        # largest jobs first
+        self.assertEqual(report[0]['size'], 100)
+        self.assertFalse(getpid() in [job['pid'] for job in report])
+        failed = [job for job in report if job['error']]
+        self.assertEqual([(job['chromosome'], job['experiment'])
+                          for job in failed], [('chrU', 'exp3')])
+        for crm in genome:
+            self.assertEqual(crm.get_experiment('exp1').tads,
+                             genome.get_chromosome('chrT').get_experiment(
+                                 'exp1').tads)
+            xpr = crm.get_experiment('exp2')
+            self.assertEqual([xpr.tads[t]['start'] for t in sorted(xpr.tads)],
+                             exp4[0]['start'])
+            self.assertEqual(len(xpr.norm[0]), 100 * 100)
+        # windows keep their weights as views of the Hi-C data
+        genome.find_tad(chromosomes=['chrT'], experiments=['exp2'],
+                        n_cpus=2, verbose=False, window=60)
+        norm = genome.get_chromosome('chrT').get_experiment('exp2').norm
+        self.assertTrue(norm[0].hic is genome.get_chromosome(
+            'chrT').get_experiment('exp2').hic_data[0])
+
+
+    def test_30_chromosome_store(self):
+        """
+        experiments written and loaded one at a time in a store directory
+        """
+        system('rm -rf lolo_store')
+        test_chr = Chromosome(name='Test Chromosome')
+        test_chr.add_experiment('exp1', 20000,
+                                hic_data='20Kb/chrT/chrT_B.tsv')
+        test_chr.add_experiment('exp2', 20000,
+                                hic_data='20Kb/chrT/chrT_D.tsv')
+        test_chr.find_tad(['exp1', 'exp2'], verbose=False)
+        write_chromosome_store(test_chr, 'lolo_store', experiments=['exp1'])
+        exp1_files = sorted(listdir(path.join('lolo_store', 'xpr0')))
+        write_chromosome_store(test_chr, 'lolo_store', experiments=['exp2'])
+        self.assertEqual(sorted(listdir(path.join('lolo_store', 'xpr0'))),
+                         exp1_files)
+        # hic_data and weights are memory-mapped
+        new_chr = load_chromosome_store('lolo_store')
+        self.assertEqual([xpr.name for xpr in new_chr.experiments],
+                         ['exp1', 'exp2'])
+        for xpr in test_chr.experiments:
+            new_xpr = new_chr.get_experiment(xpr.name)
+            self.assertEqual(new_xpr.tads, xpr.tads)
+            self.assertEqual(new_xpr.size, xpr.size)
+            self.assertEqual(list(new_xpr.hic_data[0][:]),
+                             list(xpr.hic_data[0]))
+            self.assertEqual(list(new_xpr.norm[0][:500]),
+                             list(xpr.norm[0][:500]))
+        # replace one experiment, load one field of another
+        test_chr.find_tad('exp2', verbose=False, window=60)
+        write_chromosome_store(test_chr, 'lolo_store', experiments=['exp2'])
+        # readers of the previous index still find its files, until the
+        # store is compacted
+        old = load_hic_store(path.join('lolo_store', 'xpr1', 'hic_0.hic'))
+        self.assertEqual(list(old[:]),
+                         list(test_chr.get_experiment('exp2').hic_data[0]))
+        self.assertEqual(compact_chromosome_store('lolo_store'), 1)
+        self.assertFalse(path.exists(path.join('lolo_store', 'xpr1')))
+        self.assertEqual(compact_chromosome_store('lolo_store'), 0)
+        new_chr = load_chromosome_store('lolo_store', experiments=['exp2'],
+                                        fields=['tads'])
+        new_xpr = new_chr.get_experiment('exp2')
+        self.assertEqual(new_xpr.tads, test_chr.get_experiment('exp2').tads)
+        self.assertEqual(new_xpr.hic_data, None)
+        self.assertEqual(len(new_chr.experiments), 1)
+        new_chr = load_chromosome_store('lolo_store', experiments=['exp2'])
+        norm = new_chr.get_experiment('exp2').norm[0]
+        self.assertTrue(norm.hic is new_chr.get_experiment('exp2').hic_data[0])
+        # counts overflowing 32 bits
+        test_chr.add_experiment('exp3', 20000,
+                                hic_data='20Kb/chrT/chrT_B.tsv')
+        xpr = test_chr.get_experiment('exp3')
+        xpr.hic_data = [xpr.hic_data[0].astype('int64')]
+        xpr.hic_data[0][0] = 3 * 2**31
+        write_chromosome_store(test_chr, 'lolo_store', experiments=['exp3'])
+        new_chr = load_chromosome_store('lolo_store', experiments=['exp3'])
+        hic = new_chr.get_experiment('exp3').hic_data[0]
+        self.assertEqual(hic[0], 3 * 2**31)
+        self.assertEqual(list(hic[:]), list(xpr.hic_data[0]))
+        system('rm -rf lolo_store')
+
+
+    def test_31_tad_index(self):
+        """
+        TADs at, overlapping and closest to genomic positions
+        """
+        test_chr = Chromosome(name='Test Chromosome')
+        test_chr.add_experiment('exp1', 20000,
+                                hic_data='20Kb/chrT/chrT_B.tsv')
+        test_chr.add_experiment('exp2', 20000,
+                                hic_data='20Kb/chrT/chrT_D.tsv')
+        test_chr.find_tad(['exp1', 'exp2'], verbose=False)
+        index = test_chr.tad_index
+        positions = range(0, 20000 * 120, 7000)
+        for xpr in test_chr.experiments:
+            tads = xpr.tads
+            bounds = [(tads[k]['end'] + 1) * 20000 for k in tads]
+            for pos in positions:
+                found = [k for k in tads if
+                         tads[k]['start'] * 20000 <= pos <
+                         (tads[k]['end'] + 1) * 20000]
+                self.assertEqual(index.tad_at(pos)[xpr.name],
+                                 found[0] if found else None)
+                self.assertEqual(
+                    index.overlapping(pos, pos + 100000, [xpr.name])[xpr.name],
+                    [k for k in sorted(tads) if
+                     tads[k]['start'] * 20000 < pos + 100000 and
+                     (tads[k]['end'] + 1) * 20000 > pos])
+                dist = min([abs(pos - b) for b in bounds])
+                key, diff = index.nearest_boundary(pos)[xpr.name]
+                self.assertEqual(abs(diff), dist)
+                self.assertEqual((tads[key]['end'] + 1) * 20000, pos - diff)
+            self.assertEqual(list(index.tad_at(positions)[xpr.name]),
+                             [index.tad_at(pos)[xpr.name] or 0
+                              for pos in positions])
+        # rebuilt when TADs change
+        test_chr.find_tad('exp2', verbose=False, window=60)
+        self.assertFalse(test_chr.tad_index is index)
+        self.assertEqual(test_chr.tad_index.overlapping(
+            0, 20000 * 200, ['exp2'])['exp2'],
+                         sorted(test_chr.get_experiment('exp2').tads))
+
+
+    def test_32_boundary_enrichment(self):
+        """
+        features crossed by TAD boundaries, against randomized features
+        """
+        test_chr = Chromosome(name='Test Chromosome')
+        test_chr.add_experiment('exp1', 20000,
+                                hic_data='20Kb/chrT/chrT_B.tsv')
+        test_chr.find_tad('exp1', verbose=False)
+        tads = test_chr.get_experiment('exp1').tads
+        bounds = [(tads[k]['end'] + 1) * 20000 for k in tads][:-1]
+        # features around each boundary, and between boundaries
+        features = ([(b - 30000, b + 30000) for b in bounds] +
+                    [(b + 50000, b + 60000) for b in bounds])
+        result = boundary_enrichment(test_chr, features, bins=5, n_rand=200,
+                                     batch=30)
+        self.assertEqual(result['boundary'],
+                         len([1 for s, e in features
+                              if any([s < b < e for b in bounds])]))
+        points = [[tads[k]['start'] * 20000 + i / 4. *
+                   (tads[k]['end'] + 1 - tads[k]['start']) * 20000
+                   for k in tads] for i in xrange(5)]
+        self.assertEqual(result['profile'],
+                         [len([1 for s, e in features
+                               if any([s < p < e for p in pts])])
+                          for pts in points])
+        self.assertTrue(result['boundary_exp'] < result['boundary'])
+        self.assertTrue(result['boundary_pval_high'] < 0.05)
+        # randomizations do not depend on the number of processes
+        for method in ('rotate', 'shuffle'):
+            result1 = boundary_enrichment(test_chr, features, bins=5,
+                                          n_rand=200, batch=30, method=method)
+            result2 = boundary_enrichment(test_chr, features, bins=5,
+                                          n_rand=200, batch=30, method=method,
+                                          n_cpus=3)
+            self.assertEqual(result1, result2)
+
+
+    def test_33_global_aligner(self):
+        """
+        Needleman-Wunsch score matrix filled by anti-diagonals
+        """
+        tads1 = [0.0, 4, 9, 10, 17, 21, 30, 31, 40]
+        tads2 = [0.0, 3, 9, 11, 12, 22, 29, 41, 43, 50]
+        scores = score_matrix(tads1, tads2, -6., -5.6, 5)
+        # cell by cell
+        pen = -6.
+        for i in xrange(1, len(tads1)):
+            for j in xrange(1, len(tads2)):
+                d_dist = log(1. / (abs(tads2[j] - tads1[i]) + 1))
+                cell = max(scores[i-1][j] + pen, scores[i][j-1] + pen)
+                if d_dist >= log(1. / 6):
+                    cell = max(d_dist + scores[i-1][j-1], cell)
+                self.assertEqual(scores[i][j], cell)
+                pen = -5.6
+        [align1, align2], score = needleman_wunsch(tads1[1:], tads2[1:],
+                                                   max_dist=5)
+        self.assertEqual(align1, [4, 9, 10, 17, 21, 30, 31, 40, '-', '-'])
+        self.assertEqual(align2, [3, 9, 11, 12, 22, 29, '-', 41, 43, 50])
+        self.assertEqual(round(score, 4), -0.6931)
+
+
+
+    def test_34_banded_memory(self):
+        """
+        banded mode on a matrix too large for n*n copies in the C module
+        """
+        def run(size, band, gap):
+            tri = zeros(size * (size + 1) / 2, dtype=int32)
+            rnd = RandomState(1)
+            for beg in xrange(0, len(tri), 2**22):
+                end = min(beg + 2**22, len(tri))
+                tri[beg:end] = rnd.poisson(2, end - beg)
+            # non-zero diagonal, but for a gap of removed rows
+            tri[[i * (2 * size - i + 1) / 2 for i in xrange(size)]] += 1
+            tri[[i * (2 * size - i + 1) / 2 for i in xrange(*gap)]] = 0
+            kept = range(gap[0]) + range(gap[1], size)
+            prior = zeros(size, dtype=int32)
+            for num, brk in enumerate(xrange(500, size, 500), 1):
+                prior[brk - 2:brk + 3] = num
+            # the triangle itself and O(size * band) arrays fit, not the
+            # size * size doubles of the weights (~3 Gb), nor the back
+            # pointers of all the numbers of breaks (kept * kept / 5 int,
+            # ~260 Mb), nor a band of log-likelihoods widened by the gap
+            # (size * (gap + band) doubles, ~320 Mb)
+            pages = int(open('/proc/self/statm').read().split()[0])
+            setrlimit(RLIMIT_AS, (pages * getpagesize() + 200 * 2**20,
+                                  RLIM_INFINITY))
+            res = _tadbit_wrapper([tri], size, 1, 1, 0, band, 1, 0, prior,
+                                  None, None, 1)
+            ok = (len(frombuffer(res[3])) == len(kept) * (band + 1) and
+                  list(frombuffer(res[8], dtype=intc)) == kept and
+                  len(frombuffer(res[6][0])) == size)
+            exit(0 if ok else 1)
+        proc = Process(target=run, args=(20000, 20, (10000, 12000)))
+        proc.start()
+        proc.join()
+        self.assertEqual(proc.exitcode, 0)
+
+
+
+    def test_35_diagonal_sums(self):
+        """
+        log-likelihoods from the prefix sums along the diagonals (full band)
+        and from the sums of the cells per distance (narrow band)
+        """
+        nums, size = read_matrix('20Kb/chrT/chrT_B.tsv')
+        num = nums[0].reshape(size, size).copy()
+        # removed rows/columns are not counted
+        num[30, :] = num[:, 30] = 0
+        num = num.astype(int32).ravel()
+        full = _tadbit_wrapper([num], size, 1, 1, 0, size, 1, 0)
+        band = _tadbit_wrapper([num], size, 1, 1, 0, size / 2, 1, 0)
+        # (log-likelihoods of the rows/columns kept only)
+        kept = [i for i in xrange(size) if num[i * size + i] > 0]
+        self.assertFalse(30 in kept)
+        self.assertEqual(list(frombuffer(full[8], dtype=intc)), kept)
+        llik_full = frombuffer(full[3]).reshape(len(kept), -1)
+        llik_band = frombuffer(band[3]).reshape(len(kept), -1)
+        llik_full = llik_full[:, :llik_band.shape[1]]
+        done = ~isnan(llik_band)
+        self.assertTrue(done.sum() > size * size / 4)
+        self.assertTrue((abs(llik_full[done] - llik_band[done]) <
+                         1e-6 * abs(llik_full[done])).all())
+
+
+
+    def test_36_windowed_empty_rows(self):
+        """
+        windows with less than 6 rows with non-zero diagonal are skipped
+        """
+        nums, size = read_matrix('20Kb/chrT/chrT_D.tsv')
+        num = nums[0].reshape(size, size).copy()
+        num[20:60, :] = num[:, 20:60] = 0
+        res = tadbit(num.ravel(), window=30, overlap=10, verbose=False,
+                     get_stats=True)
+        # second window (bins 20 to 49) is empty
+        self.assertEqual(res['stats']['windows'][1], None)
+        self.assertEqual(len([1 for end in res['end'] if 20 <= end < 59]), 0)
+        self.assertEqual(res['end'][-1], size - 1)
+        self.assertRaises(ValueError, tadbit, num[15:50, 15:50].ravel(),
+                          verbose=False)
+
+
+    def test_37_sparse_detection(self):
+        """
+        files with three integer columns are read as sparse only if they do
+        not hold a 3x3 matrix, or when asked to
+        """
+        out = open('lala.tsv', 'w')
+        out.write('5 1 0\n1 6 2\n0 2 7\n')
+        out.close()
+        nums, size = read_matrix('lala.tsv')
+        self.assertEqual(size, 3)
+        self.assertEqual(list(nums[0]), [5, 1, 0, 1, 6, 2, 0, 2, 7])
+        out = open('lala.tsv', 'w')
+        out.write('1 1 5\n1 2 1\n2 2 6\n')
+        out.close()
+        nums, size = read_matrix('lala.tsv', sparse=True)
+        self.assertEqual(size, 2)
+        self.assertEqual(list(nums[0]), [5, 1, 1, 6])
+        out = open('lala.tsv', 'w')
+        out.write('# comment\n1 1 5\n1 2 1\n2 2 6\n2 3 2\n')
+        out.close()
+        nums, size = read_matrix('lala.tsv')
+        system('rm -f lala.tsv')
+        self.assertTrue(isinstance(nums[0], SparseHiC))
+        self.assertEqual(size, 3)
+        self.assertEqual(list(nums[0]), [5, 1, 0, 1, 6, 2, 0, 2, 0])
+
+
+    def test_38_llik_cache_processes(self):
+        """
+        processes saving log-likelihoods under the same key at the same time
+        """
+        system('rm -rf lolo_cache; mkdir lolo_cache')
+        size = 1000
+        start = Event()
+        def run(val):
+            llikmat = zeros(size * 100) + val
+            start.wait()
+            for _ in xrange(50):
+                _save_llik('lolo_cache', 'key', None, llikmat, size)
+            exit(0)
+        procs = [Process(target=run, args=(val, )) for val in (1, 2)]
+        for proc in procs:
+            proc.start()
+        start.set()
+        for proc in procs:
+            proc.join()
+        self.assertEqual([proc.exitcode for proc in procs], [0, 0])
+        self.assertEqual(listdir('lolo_cache'), ['key.npy'])
+        cached = load(path.join('lolo_cache', 'key.npy'))
+        system('rm -rf lolo_cache')
+        self.assertEqual(cached.shape, (size, 100))
+        self.assertTrue(cached.min() == cached.max() in (1, 2))
+
+
 if __name__ == "__main__":
     unittest.main()
     